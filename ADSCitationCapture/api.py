@@ -1,10 +1,14 @@
 
 import os
-import requests
 import ADSCitationCapture.url as url
+import ADSCitationCapture.http_client as http_client
 import urllib.request, urllib.parse, urllib.error
 import math
+import concurrent.futures
+from collections import OrderedDict
 from adsputils import setup_logging
+from ADSCitationCapture import cache
+from ADSCitationCapture import batcher
 
 # ============================= INITIALIZATION ==================================== #
 # - Use app logger:
@@ -18,6 +22,51 @@ logger = setup_logging(__name__, proj_home=proj_home,
                         level=config.get('LOGGING_LEVEL', 'INFO'),
                         attach_stdout=config.get('LOG_STDOUT', False))
 
+# Canonical bibcode resolutions (None for bibcodes unknown to the system)
+canonical_bibcode_cache = cache.LRUCache('canonical_bibcode',
+                        maxsize=config.get('CANONICAL_BIBCODE_CACHE_SIZE', 100000),
+                        ttl=config.get('CANONICAL_BIBCODE_CACHE_TTL', 24*60*60),
+                        negative_ttl=config.get('CANONICAL_BIBCODE_CACHE_NEGATIVE_TTL', 60*60),
+                        shared_backend=cache.build_shared_backend(config.get('CACHE_SHARED_BACKEND_URL', None)))
+
+def _resolve_canonical_bibcodes(bibcodes, app, timeout=30):
+    """
+    Bulk request used by the canonical bibcode batcher, it returns a dictionary
+    that maps each input bibcode to its canonical bibcode (or None)
+    """
+    resolved = _disambiguate_canonical_bibcodes(app, bibcodes, timeout)
+    canonical_bibcode_cache.set_many(resolved)
+    return resolved
+
+def _disambiguate_canonical_bibcodes(app, bibcodes, timeout=30):
+    """
+    Request the canonical form of the bibcodes and match every one of them
+    with its answer. Bibcodes that could not be matched while some answers
+    remained unmatched are requested again split in two halves, and only the
+    halves that still get unmatched answers are split again (a single
+    bibcode request can only correspond to its answer). For k unmatched
+    answers, this takes O(k log n) requests instead of one per bibcode.
+    """
+    resolved, unmapped_canonical_bibcodes, uncertain_bibcodes = _fetch_canonical_bibcodes(app, bibcodes, timeout)
+    if uncertain_bibcodes:
+        if len(bibcodes) == 1:
+            # Single bibcode request, the answer can only correspond to it
+            resolved[bibcodes[0]] = unmapped_canonical_bibcodes[0]
+        else:
+            uncertain_bibcodes = [bibcode for bibcode in bibcodes if bibcode in uncertain_bibcodes]
+            half = (len(uncertain_bibcodes) + 1) // 2
+            for bibcodes_half in (uncertain_bibcodes[:half], uncertain_bibcodes[half:]):
+                if bibcodes_half:
+                    resolved.update(_disambiguate_canonical_bibcodes(app, bibcodes_half, timeout))
+    return resolved
+
+# Single bibcode resolutions requested concurrently by the threads of this
+# process are sent together to the API (other processes only share the
+# answers through the shared cache backend, see CACHE_SHARED_BACKEND_URL)
+canonical_bibcode_batcher = batcher.MicroBatcher('canonical_bibcode', _resolve_canonical_bibcodes,
+                        window=config.get('CANONICAL_BIBCODE_BATCH_WINDOW', 0.05),
+                        max_size=config.get('CANONICAL_BIBCODE_BATCH_SIZE', 2000))
+
 
 # =============================== FUNCTIONS ======================================= #
 def _request_citations_page(app, bibcode, start, rows):
@@ -33,7 +82,7 @@ def _request_citations_page(app, bibcode, start, rows):
     url = app.conf['ADS_API_URL']+"search/query?"+params
     r_json = {}
     try:
-        r = requests.get(url, headers=headers)
+        r = http_client.get(url, headers=headers, endpoint='ads_api.search')
     except:
         logger.error("Search API request failed for citations (start: %i): %s", start, bibcode)
         raise
@@ -58,19 +107,12 @@ def request_existing_citations(app, bibcode):
     existing_citation_bibcodes = []
     n_existing_citations = None
     while True:
-        retries = 0
-        while True:
-            try:
-                answer = _request_citations_page(app, bibcode, start, rows)
-            except:
-                if retries < 3:
-                    logger.info("Retrying Search API request for citations (start: %i): %s", start, bibcode)
-                    retries += 1
-                else:
-                    logger.exception("Failed Search API request for citations (start: %i): %s", start, bibcode)
-                    raise
-            else:
-                break
+        try:
+            # Transient failures are already re-tried by the HTTP client
+            answer = _request_citations_page(app, bibcode, start, rows)
+        except:
+            logger.exception("Failed Search API request for citations (start: %i): %s", start, bibcode)
+            raise
         existing_citation_bibcodes += answer['response']['docs']
         if n_existing_citations is None:
             n_existing_citations = answer['response']['numFound']
@@ -81,36 +123,110 @@ def request_existing_citations(app, bibcode):
     existing_citation_bibcodes = [b['bibcode'] for b in existing_citation_bibcodes]
     return existing_citation_bibcodes
 
-def get_canonical_bibcodes(app, bibcodes, timeout=30):
+def get_canonical_bibcodes(app, bibcodes, timeout=30, use_cache=True):
     """
     Convert input bibcodes into their canonical form if they exist, hence
     the returned list can be smaller than the input bibcode list
+
+    Resolutions (including unknown bibcodes) are cached, only the bibcodes
+    that are not in the cache are sent to the API. If use_cache is False,
+    all the bibcodes are sent to the API and the cache is refreshed with the
+    answers (e.g., to detect merged bibcodes during maintenance).
+    """
+    unique_bibcodes = list(OrderedDict.fromkeys(bibcodes))
+    if use_cache:
+        resolved = canonical_bibcode_cache.get_many(unique_bibcodes)
+    else:
+        resolved = {}
+    missing_bibcodes = [bibcode for bibcode in unique_bibcodes if bibcode not in resolved]
+    unmapped_canonical_bibcodes = []
+    if missing_bibcodes:
+        fetched, unmapped_canonical_bibcodes, uncertain_bibcodes = _fetch_canonical_bibcodes(app, missing_bibcodes, timeout)
+        _cache_canonical_bibcodes(fetched, uncertain_bibcodes)
+        resolved.update(fetched)
+    canonical_bibcodes = []
+    for bibcode in unique_bibcodes:
+        canonical_bibcode = resolved.get(bibcode)
+        if canonical_bibcode is not None and canonical_bibcode not in canonical_bibcodes:
+            canonical_bibcodes.append(canonical_bibcode)
+    for canonical_bibcode in unmapped_canonical_bibcodes:
+        if canonical_bibcode not in canonical_bibcodes:
+            canonical_bibcodes.append(canonical_bibcode)
+    return canonical_bibcodes
+
+def _fetch_canonical_bibcodes(app, bibcodes, timeout=30):
+    """
+    Request the canonical form of the bibcodes to the API. It returns a
+    dictionary that maps each input bibcode to its canonical bibcode (or None
+    if it does not exist), a list of canonical bibcodes returned by the
+    API that could not be matched to any input bibcode and the set of input
+    bibcodes without a match that may correspond to one of those (they
+    belong to a chunk where some answers could not be matched).
     """
     chunk_size = 2000 # Max number of records supported by bigquery
     bibcodes_chunks = [bibcodes[i * chunk_size:(i + 1) * chunk_size] for i in range(int(round(((len(bibcodes) + chunk_size - 1))) / chunk_size ))]
-    canonical_bibcodes = []
+    resolved = {}
+    unmapped_canonical_bibcodes = []
+    uncertain_bibcodes = set()
     total_n_chunks = len(bibcodes_chunks)
-    # Execute multiple requests to bigquery if the list of bibcodes is longer than the accepted maximum
+    # Execute multiple requests to bigquery if the list of bibcodes is longer
+    # than the accepted maximum, up to CANONICAL_BIBCODE_FETCH_CONCURRENCY at the same time
+    max_workers = min(total_n_chunks, config.get('CANONICAL_BIBCODE_FETCH_CONCURRENCY', 4))
+    if max_workers > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_get_canonical_bibcodes, app, n_chunk, total_n_chunks, bibcodes_chunk, timeout) for n_chunk, bibcodes_chunk in enumerate(bibcodes_chunks)]
+            concurrent.futures.wait(futures)
+    else:
+        futures = None
+    # Results are merged following the chunks order (independently of the order in which they completed)
     for n_chunk, bibcodes_chunk in enumerate(bibcodes_chunks):
-        retries = 0
-        while True:
-            try:
-                canonical_bibcodes += _get_canonical_bibcodes(app, n_chunk, total_n_chunks, bibcodes_chunk, timeout)
-            except:
-                if retries < 3:
-                    logger.info("Retrying BigQuery API request for bibcodes (chunk: %i/%i): %s", n_chunk+1, total_n_chunks, " ".join(bibcodes_chunk))
-                    retries += 1
-                else:
-                    logger.exception("Failed BigQuery API request for bibcodes (chunk: %i/%i): %s", n_chunk+1, total_n_chunks, " ".join(bibcodes_chunk))
-                    raise
+        try:
+            # Transient failures are already re-tried by the HTTP client
+            if futures is None:
+                docs = _get_canonical_bibcodes(app, n_chunk, total_n_chunks, bibcodes_chunk, timeout)
             else:
-                break
-    return canonical_bibcodes
+                docs = futures[n_chunk].result()
+        except:
+            logger.exception("Failed BigQuery API request for bibcodes (chunk: %i/%i): %s", n_chunk+1, total_n_chunks, " ".join(bibcodes_chunk))
+            raise
+        chunk_resolved, chunk_unmapped_canonical_bibcodes = _map_canonical_bibcodes(bibcodes_chunk, docs)
+        resolved.update(chunk_resolved)
+        unmapped_canonical_bibcodes += chunk_unmapped_canonical_bibcodes
+        if chunk_unmapped_canonical_bibcodes:
+            uncertain_bibcodes.update(bibcode for bibcode, canonical_bibcode in chunk_resolved.items() if canonical_bibcode is None)
+    return resolved, unmapped_canonical_bibcodes, uncertain_bibcodes
+
+def _cache_canonical_bibcodes(resolved, uncertain_bibcodes):
+    """
+    Cache the resolutions except the unknown bibcodes that may correspond to
+    an answer of the API that could not be matched (they are not cached as
+    unknown, the next request will ask the API again)
+    """
+    canonical_bibcode_cache.set_many({bibcode: canonical_bibcode for bibcode, canonical_bibcode in resolved.items()
+                                      if canonical_bibcode is not None or bibcode not in uncertain_bibcodes})
+
+def _map_canonical_bibcodes(bibcodes, docs):
+    """
+    Match the documents returned by the API (canonical bibcode plus
+    identifiers, which include alternate and deprecated bibcodes, arXiv ids,
+    etc.) with the requested bibcodes
+    """
+    resolved = dict.fromkeys(bibcodes)
+    unmapped_canonical_bibcodes = []
+    for doc in docs:
+        mapped = False
+        for bibcode in [doc['bibcode']] + doc.get('identifier', []):
+            if bibcode in resolved:
+                resolved[bibcode] = doc['bibcode']
+                mapped = True
+        if not mapped:
+            unmapped_canonical_bibcodes.append(doc['bibcode'])
+    return resolved, unmapped_canonical_bibcodes
 
 def _get_canonical_bibcodes(app, n_chunk, total_n_chunks, bibcodes_chunk, timeout):
-    canonical_bibcodes = []
+    docs = []
     params = urllib.parse.urlencode({
-                'fl': 'bibcode',
+                'fl': 'bibcode,identifier',
                 'q': '*:*',
                 'wt': 'json',
                 'fq':'{!bitset}',
@@ -123,7 +239,7 @@ def _get_canonical_bibcodes(app, n_chunk, total_n_chunks, bibcodes_chunk, timeou
     r_json = {}
     data = "bibcode\n" + "\n".join(bibcodes_chunk)
     try:
-        r = requests.post(url, headers=headers, data=data, timeout=timeout)
+        r = http_client.post(url, headers=headers, data=data, timeout=timeout, endpoint='ads_api.bigquery', idempotent=True) # Read-only query
     except:
         logger.error("BigQuery API request failed for bibcodes (chunk: %i/%i): %s", n_chunk+1, total_n_chunks, " ".join(bibcodes_chunk))
         raise
@@ -140,18 +256,20 @@ def _get_canonical_bibcodes(app, n_chunk, total_n_chunks, bibcodes_chunk, timeou
             raise Exception(msg)
         else:
             for paper in r_json.get('response', {}).get('docs', []):
-                canonical_bibcodes.append(paper['bibcode'])
-    return canonical_bibcodes
+                docs.append({'bibcode': paper['bibcode'], 'identifier': paper.get('identifier', [])})
+    return docs
 
 def get_canonical_bibcode(app, bibcode, timeout=30):
     """
-    Convert input bibcodes into their canonical form if they exist
+    Convert input bibcode into its canonical form if it exists
+
+    If the resolution is not cached, the request is coalesced with the ones
+    issued concurrently by other callers into a single API request.
     """
-    canonical = get_canonical_bibcodes(app, [bibcode], timeout=timeout)
-    if len(canonical) == 0:
-        return None
-    else:
-        return canonical[0]
+    found, canonical_bibcode = canonical_bibcode_cache.get(bibcode)
+    if found:
+        return canonical_bibcode
+    return canonical_bibcode_batcher.get(bibcode, app, timeout)
 
 def get_github_metadata(app, citation_url):
     """
@@ -175,7 +293,7 @@ def get_github_metadata(app, citation_url):
         
         if github_api:
             try:
-                git_return = requests.get(github_api, headers=headers)
+                git_return = http_client.get(github_api, headers=headers, endpoint='github_api')
                 json_return = git_return.json()
                 license_name = json_return["license"]["key"] 
                 license_url = json_return["license"]["url"] if json_return["license"]["url"] is not None else ""
@@ -1,10 +1,48 @@
+from contextlib import contextmanager
+from multiprocessing.util import register_after_fork
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, scoped_session
 from adsputils import ADSCelery
 from .models import *
 
 class ADSCitationCaptureCelery(ADSCelery):
+    def __init__(self, app_name, *args, **kwargs):
+        ADSCelery.__init__(self, app_name, *args, **kwargs)
+        # Optional read replica for the read-only db helpers
+        self._replica_engine = self._replica_session = None
+        if self._config.get('SQLALCHEMY_REPLICA_URL', None):
+            self._replica_engine = create_engine(self._config.get('SQLALCHEMY_REPLICA_URL'),
+                                                 echo=self._config.get('SQLALCHEMY_ECHO', False))
+            self._replica_session = scoped_session(sessionmaker())
+            self._replica_session.configure(bind=self._replica_engine)
+            register_after_fork(self._replica_engine, self._replica_engine.dispose)
+
     def attempt_recovery(self, task, args=None, kwargs=None, einfo=None, retval=None):
         """
         If task fails after 3 attempts...
         """
         #task.apply_async(args=args, kwargs=kwargs)
         pass
+
+    def close_app(self):
+        """Closes the app"""
+        ADSCelery.close_app(self)
+        self._replica_session = self._replica_engine = None
+
+    @contextmanager
+    def replica_session_scope(self):
+        """
+        Same as session_scope but connected to the read replica
+        (SQLALCHEMY_REPLICA_URL), or to the primary database if there is none.
+        Only meant for reads: the transaction is always rolled back.
+        """
+        if self._replica_session is None:
+            with self.session_scope() as session:
+                yield session
+            return
+        s = self._replica_session()
+        try:
+            yield s
+        finally:
+            s.rollback()
+            s.close()
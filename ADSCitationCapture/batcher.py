@@ -0,0 +1,116 @@
+import os
+import threading
+from collections import OrderedDict
+
+# ============================= INITIALIZATION ==================================== #
+# - Use app logger:
+#import logging
+#logger = logging.getLogger('ads-citation-capture')
+# - Or individual logger for this file:
+from adsputils import setup_logging, load_config
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+config = load_config(proj_home=proj_home)
+logger = setup_logging(__name__, proj_home=proj_home,
+                        level=config.get('LOGGING_LEVEL', 'INFO'),
+                        attach_stdout=config.get('LOG_STDOUT', False))
+
+
+# =============================== CLASSES ========================================= #
+class _PendingBatch():
+    def __init__(self):
+        self.keys = OrderedDict()
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = {}
+        self.error = None
+
+
+class MicroBatcher():
+    """
+    Coalesce single-key requests issued concurrently by the threads of a
+    worker process into one bulk request. Requests issued by different
+    processes (e.g., prefork pool or several workers) are not coalesced.
+
+    The first caller opens a batch and, if other callers are in flight (i.e.,
+    the worker runs several threads), waits up to 'window' seconds (or until
+    'max_size' keys have been collected), then it executes the bulk request
+    on behalf of all the callers that joined the batch and fans the answers
+    back to them. If the bulk request fails, all of them get the exception.
+    A caller alone in its process (e.g., prefork pool) does not wait.
+
+    Only callers that pass the same arguments share a batch.
+    """
+
+    def __init__(self, name, fetch_many, window=0.05, max_size=2000):
+        """
+        :param name: Batcher name (used in logs).
+        :param fetch_many: Function that receives a list of keys plus the
+            arguments given to 'get' (they must be hashable) and returns a
+            dictionary key -> value (missing keys are answered with None).
+        :param window: Seconds to wait for other requests before executing
+            the bulk request (0 disables coalescing).
+        :param max_size: Maximum number of keys per bulk request.
+        """
+        self.name = name
+        self.fetch_many = fetch_many
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}
+        self._callers = 0
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+
+    def get(self, key, *args):
+        """
+        Return the value for a key, executing the bulk request together with
+        the rest of keys requested during the same window
+        """
+        with self._lock:
+            self.requests += 1
+            self._callers += 1
+            batch = self._pending.get(args)
+            leader = batch is None
+            if leader:
+                batch = self._pending[args] = _PendingBatch()
+            batch.keys[key] = None
+            if len(batch.keys) >= self.max_size:
+                # No more keys accepted, execute it without waiting for the window
+                del self._pending[args]
+                batch.full.set()
+            # Nobody else could join the batch if this is the only caller
+            wait = leader and self.window > 0 and self._callers > 1
+
+        try:
+            if leader:
+                if wait:
+                    batch.full.wait(self.window)
+                with self._lock:
+                    if self._pending.get(args) is batch:
+                        del self._pending[args]
+                    self.batches += 1
+                keys = list(batch.keys)
+                logger.debug("Executing batch '%s' with %i keys", self.name, len(keys))
+                try:
+                    batch.results = self.fetch_many(keys, *args)
+                except Exception as e:
+                    batch.error = e
+                finally:
+                    batch.done.set()
+            else:
+                batch.done.wait()
+        finally:
+            with self._lock:
+                self._callers -= 1
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.results.get(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'requests': self.requests,
+                'batches': self.batches,
+            }
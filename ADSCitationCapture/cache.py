@@ -0,0 +1,340 @@
+import os
+import json
+import hashlib
+import time
+import threading
+from collections import OrderedDict
+
+# ============================= INITIALIZATION ==================================== #
+# - Use app logger:
+#import logging
+#logger = logging.getLogger('ads-citation-capture')
+# - Or individual logger for this file:
+from adsputils import setup_logging, load_config
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+config = load_config(proj_home=proj_home)
+logger = setup_logging(__name__, proj_home=proj_home,
+                        level=config.get('LOGGING_LEVEL', 'INFO'),
+                        attach_stdout=config.get('LOG_STDOUT', False))
+
+
+# =============================== CLASSES ========================================= #
+class LocalCacheBackend():
+    """
+    Process-wide key/value store with expiration. It offers the same interface
+    as the shared backends (e.g., RedisCacheBackend) and it is used as a
+    stand-in for them in development/testing environments.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the stored string or None if missing/expired"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCacheBackend():
+    """
+    Key/value store shared by all the workers, backed by redis.
+    """
+
+    def __init__(self, url):
+        import redis
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(key)
+        if value is not None:
+            value = value.decode('utf-8')
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._client.set(key, value, ex=int(ttl) if ttl else None)
+
+    def delete(self, key):
+        self._client.delete(key)
+
+    def clear(self):
+        # Never flush a shared database, entries will expire by themselves
+        pass
+
+
+_local_backend = LocalCacheBackend()
+
+def build_shared_backend(url):
+    """
+    Build the shared cache backend for a given URL:
+        - None or empty: no shared backend
+        - 'local://': process-wide stand-in (LocalCacheBackend)
+        - 'redis://...': RedisCacheBackend
+    """
+    if not url:
+        return None
+    elif url.startswith("local://"):
+        return _local_backend
+    elif url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisCacheBackend(url)
+    else:
+        raise Exception("Unknown shared cache backend: {}".format(url))
+
+
+class LRUCache():
+    """
+    In-process least recently used cache with a per-entry time to live and
+    an optional second level shared with other workers.
+
+    A None value is a valid entry (negative caching: e.g., a bibcode that is
+    not known by the system) and it expires after 'negative_ttl' seconds
+    (if 'negative_ttl' is 0, negative results are not cached).
+    """
+
+    def __init__(self, name, maxsize=10000, ttl=None, negative_ttl=None, shared_backend=None):
+        """
+        :param name: Cache name, used as a key prefix in the shared backend.
+        :param maxsize: Maximum number of entries kept in memory.
+        :param ttl: Seconds an entry is valid (None: no expiration).
+        :param negative_ttl: Seconds a None entry is valid (None: same as ttl).
+        :param shared_backend: Optional backend shared between workers (see
+            build_shared_backend).
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.shared_backend = shared_backend
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _shared_key(self, key):
+        return "{}:{}".format(self.name, key)
+
+    def _entry_ttl(self, value, ttl):
+        if ttl is not None:
+            return ttl
+        return self.negative_ttl if value is None else self.ttl
+
+    def _set_local(self, key, value, ttl):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, key):
+        """
+        Return a tuple (found, value). Found is False if the key is not
+        cached or it has expired.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    if value is None:
+                        self.negative_hits += 1
+                    return True, value
+                del self._data[key]
+        if self.shared_backend is not None:
+            try:
+                serialized_value = self.shared_backend.get(self._shared_key(key))
+            except Exception:
+                logger.exception("Shared cache backend failed for '%s' in cache '%s'", key, self.name)
+                serialized_value = None
+            if serialized_value is not None:
+                value = json.loads(serialized_value)
+                self._set_local(key, value, self._entry_ttl(value, None))
+                with self._lock:
+                    self.hits += 1
+                    self.shared_hits += 1
+                    if value is None:
+                        self.negative_hits += 1
+                return True, value
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def get_many(self, keys):
+        """
+        Return a dictionary with the cached entries for the given keys (keys
+        that are not cached are not included).
+        """
+        entries = {}
+        for key in keys:
+            found, value = self.get(key)
+            if found:
+                entries[key] = value
+        return entries
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value (None is a negative entry) using the default TTL for its
+        type unless a specific 'ttl' is provided.
+        """
+        ttl = self._entry_ttl(value, ttl)
+        if value is None and ttl == 0:
+            # Negative caching disabled
+            return
+        self._set_local(key, value, ttl)
+        if self.shared_backend is not None:
+            try:
+                self.shared_backend.set(self._shared_key(key), json.dumps(value), ttl=ttl)
+            except Exception:
+                logger.exception("Shared cache backend failed storing '%s' in cache '%s'", key, self.name)
+
+    def set_many(self, entries, ttl=None):
+        for key, value in entries.items():
+            self.set(key, value, ttl=ttl)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+        if self.shared_backend is not None:
+            self.shared_backend.delete(self._shared_key(key))
+
+    def clear(self):
+        """Empty the in-process cache and reset the counters"""
+        with self._lock:
+            self._data.clear()
+            self.hits = self.negative_hits = self.shared_hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'size': len(self._data),
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class RawContentCache():
+    """
+    On-disk content-addressed cache for raw payloads (e.g., DataCite XML)
+    shared by all the workers of a host.
+
+    Payloads are stored once per SHA-256 hash under 'objects/' and each key
+    has an index entry under 'index/' with the hash of its payload, the HTTP
+    validators (ETag/Last-Modified) and the time it was fetched. Files are
+    written to a temporary file and renamed, so readers never see partial
+    files.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def _object_path(self, sha256):
+        return os.path.join(self.directory, 'objects', sha256[:2], sha256)
+
+    def _index_path(self, key):
+        return os.path.join(self.directory, 'index', hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, key):
+        """
+        Return the cached entry for a key (dictionary with 'content', 'size'
+        in bytes, 'etag', 'last_modified' and 'fetched_at') or None if it is
+        not cached
+        """
+        try:
+            with open(self._index_path(key), 'r') as f:
+                entry = json.load(f)
+            with open(self._object_path(entry['sha256']), 'rb') as f:
+                data = f.read()
+            entry['content'] = data.decode('utf-8')
+            entry['size'] = len(data)
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        return entry
+
+    def set(self, key, content, etag=None, last_modified=None):
+        """
+        Store the payload for a key together with its HTTP validators
+        """
+        data = content.encode('utf-8')
+        sha256 = hashlib.sha256(data).hexdigest()
+        object_path = self._object_path(sha256)
+        try:
+            if not os.path.exists(object_path):
+                self._write(object_path, data)
+            entry = {'sha256': sha256, 'etag': etag, 'last_modified': last_modified, 'fetched_at': time.time()}
+            self._write(self._index_path(key), json.dumps(entry).encode('utf-8'))
+        except (IOError, OSError):
+            logger.exception("Failed storing '%s' in raw content cache '%s'", key, self.directory)
+
+    def touch(self, key, entry):
+        """
+        Mark a cached entry as fetched now (e.g., after a successful revalidation)
+        """
+        self.set(key, entry['content'], etag=entry.get('etag'), last_modified=entry.get('last_modified'))
+
+    def record(self, hit=False, revalidation=False, saved_bytes=0):
+        """
+        Account for a request served locally (hit), a conditional request
+        answered with 'not modified' (revalidation) or a full download (miss)
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            elif revalidation:
+                self.revalidations += 1
+            else:
+                self.misses += 1
+            self.bytes_saved += saved_bytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                'directory': self.directory,
+                'hits': self.hits,
+                'revalidations': self.revalidations,
+                'misses': self.misses,
+                'requests_saved': self.hits,
+                'bytes_saved': self.bytes_saved,
+            }
@@ -1,13 +1,21 @@
 import os
+import glob
+import time
+import threading
+import contextlib
 from typing import OrderedDict
 from psycopg2 import IntegrityError
 from dateutil.tz import tzutc
-from ADSCitationCapture.models import Citation, CitationTarget, Event, Reader
+from ADSCitationCapture.models import Citation, CitationTarget, CitationTargetAggregate, CitationTargetAlternateBibcode, Event, MaintenanceProgress, NonbibExportState, NonbibExportTarget, Reader, versioning_manager
 from ADSCitationCapture import doi
+from ADSCitationCapture import output_files
 from adsmsg import CitationChange
 import datetime
-from adsputils import setup_logging
+import concurrent.futures
+from adsputils import setup_logging, get_date
 from sqlalchemy_continuum import version_class
+from sqlalchemy import tuple_, any_, literal, select, union, exists, and_, or_, Text, Boolean, DateTime, func, distinct
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, insert as pg_insert
 
 # ============================= INITIALIZATION ==================================== #
 # - Use app logger:
@@ -31,14 +39,197 @@ file_names['authors'] = proj_home+'/logs/output/facet_authors_CC.list.'
 env_name = config.get('ENVIRONMENT', 'back-dev') 
 for key in file_names.keys():
     file_names[key] = file_names[key] + str(env_name)
+#Manifest with row counts and checksums of the output files
+manifest_file_name = proj_home+'/logs/output/manifest_CC.json.' + str(env_name)
+
+# Session shared by the db helpers called within a unit of work (per thread)
+_unit_of_work = threading.local()
+# New citations buffered by store_citation within a citation write buffer (per thread)
+_citation_write_buffer = threading.local()
+# Outcomes of the citation changes applied by a citation change batch (per thread)
+_citation_change_batch = threading.local()
+# History mode set by history_mode, overriding HISTORY_MODE (per thread)
+_history_mode = threading.local()
+# Whether the task in progress (one entry per nested task) has written to the
+# primary database, so that its reads are not routed to the replica (per thread)
+_primary_writes = threading.local()
+HISTORY_MODES = ('orm', 'commit', 'off')
 
 # =============================== FUNCTIONS ======================================= #
+@contextlib.contextmanager
+def unit_of_work(app):
+    """
+    Run all the db helpers called within the block (by the current thread) in
+    a single session: one connection checkout and one transaction, committed
+    at the end of the block or rolled back if an exception is raised.
+
+    Helpers that commit on their own only release a savepoint of the unit of
+    work (their error handling keeps working without aborting the whole
+    transaction). Callbacks registered with after_commit are executed once
+    the unit of work has been committed. Nested units of work join the
+    outer one.
+    """
+    if getattr(_unit_of_work, 'session', None) is not None:
+        yield _unit_of_work.session
+        return
+    callbacks = []
+    _record_primary_write()
+    with app.session_scope() as session:
+        _configure_history_session(app, session)
+        session.info['pending_history'] = {}
+        _unit_of_work.session = session
+        _unit_of_work.callbacks = callbacks
+        try:
+            yield session
+            _write_pending_history_session(session)
+        finally:
+            _unit_of_work.session = None
+            _unit_of_work.callbacks = None
+            session.info.pop('pending_history', None)
+    for callback in callbacks:
+        callback()
+
+def after_commit(callback):
+    """
+    Execute callback once the current unit of work has been committed
+    (immediately if there is no unit of work in progress). Within the
+    processing of a citation change of a citation write buffer (see
+    CitationWriteBuffer.citation_change_scope), it is only executed if the
+    citation stored by it turns out to be new.
+    """
+    write_buffer = getattr(_citation_write_buffer, 'buffer', None)
+    if write_buffer is not None and write_buffer.callbacks is not None:
+        write_buffer.callbacks.append(callback)
+        return
+    callbacks = getattr(_unit_of_work, 'callbacks', None)
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+@contextlib.contextmanager
+def _session_scope(app, savepoint=False):
+    """
+    Session for db helpers: the one of the unit of work in progress (within a
+    savepoint if the helper commits or rolls back on its own) or a new
+    session scope if there is none
+    """
+    session = getattr(_unit_of_work, 'session', None)
+    if savepoint:
+        _record_primary_write()
+    if session is None:
+        with app.session_scope() as session:
+            _configure_history_session(app, session)
+            yield session
+    elif not savepoint:
+        _configure_history_session(app, session)
+        yield session
+    else:
+        _configure_history_session(app, session)
+        # History collected within the savepoint is discarded if it is rolled back
+        pending_history = session.info.get('pending_history', {})
+        previous_pending_history = {model_key: dict(keys) for model_key, keys in pending_history.items()}
+        nested = session.begin_nested()
+        try:
+            yield session
+        except:
+            if session.transaction is nested:
+                nested.rollback()
+            session.info['pending_history'] = previous_pending_history
+            raise
+        else:
+            # Release the savepoint if the helper did not commit (e.g., no changes)
+            if session.transaction is nested:
+                if nested.is_active:
+                    nested.commit()
+                else:
+                    nested.rollback()
+                    session.info['pending_history'] = previous_pending_history
+
+@contextlib.contextmanager
+def _read_session_scope(app):
+    """
+    Session for read-only db helpers: a replica session (see
+    SQLALCHEMY_REPLICA_URL) unless there is a unit of work in progress or the
+    current task has already written to the primary database, in which case
+    the primary is used so that the task reads its own writes
+    """
+    if getattr(_unit_of_work, 'session', None) is not None or _task_wrote_to_primary():
+        with _session_scope(app) as session:
+            yield session
+    else:
+        with app.replica_session_scope() as session:
+            yield session
+
+def _primary_writes_stack():
+    stack = getattr(_primary_writes, 'stack', None)
+    if stack is None:
+        stack = _primary_writes.stack = []
+    return stack
+
+def _task_wrote_to_primary():
+    stack = _primary_writes_stack()
+    return bool(stack) and stack[-1]
+
+def _record_primary_write():
+    # Writes are only tracked within tasks (see begin_task_reads), a write
+    # outside of them must not route the reads of later tasks to the primary
+    stack = _primary_writes_stack()
+    if stack:
+        stack[-1] = True
+
+def begin_task_reads():
+    """
+    Start tracking the writes of a task (see _read_session_scope). Tasks
+    executed eagerly within another task inherit its state.
+    """
+    stack = _primary_writes_stack()
+    stack.append(_task_wrote_to_primary())
+
+def end_task_reads():
+    """
+    Stop tracking the writes of the task started by begin_task_reads
+    """
+    stack = _primary_writes_stack()
+    if stack:
+        stack.pop()
+
+def _get_history_mode(app):
+    mode = getattr(_history_mode, 'mode', None) or app.conf.get('HISTORY_MODE', 'orm')
+    if mode not in HISTORY_MODES:
+        raise Exception("Unknown history mode '{}' (expected one of {})".format(mode, ", ".join(HISTORY_MODES)))
+    return mode
+
+def _configure_history_session(app, session):
+    """
+    Apply the history mode to the session, SQLAlchemy-Continuum only versions
+    the flushes of the sessions in 'orm' mode (see models.HistoryModeUnitOfWork)
+    """
+    session.info['history_mode'] = _get_history_mode(app)
+
+@contextlib.contextmanager
+def history_mode(app, mode):
+    """
+    Override the history mode (see HISTORY_MODE) of the db helpers called by
+    the current thread within the block (e.g., 'off' to suspend the history
+    of updates during bulk maintenance). If mode is None, the current mode
+    is kept.
+    """
+    if mode is not None and mode not in HISTORY_MODES:
+        raise Exception("Unknown history mode '{}' (expected one of {})".format(mode, ", ".join(HISTORY_MODES)))
+    previous_mode = getattr(_history_mode, 'mode', None)
+    _history_mode.mode = mode or previous_mode
+    try:
+        yield _get_history_mode(app)
+    finally:
+        _history_mode.mode = previous_mode
+
 def store_event(app, data):
     """
     Stores a new event in the DB
     """
     stored = False
-    with app.session_scope() as session:
+    with _session_scope(app, savepoint=True) as session:
         event = Event()
         event.data = data
         session.add(event)
@@ -54,28 +245,139 @@ def store_citation_target(app, citation_change, content_type, raw_metadata, pars
     """
     Stores a new citation target in the DB
     """
-    stored = False
-    with app.session_scope() as session:
-        citation_target = CitationTarget()
-        citation_target.content = citation_change.content
-        citation_target.content_type = content_type
-        citation_target.raw_cited_metadata = raw_metadata
-        citation_target.parsed_cited_metadata = parsed_metadata
-        citation_target.curated_metadata = {}
-        citation_target.status = status
-        citation_target.bibcode = parsed_metadata.get("bibcode", None)
-        citation_target.associated_works = associated
-        session.add(citation_target)
-        try:
+    stored = store_citation_targets(app, [(citation_change, content_type, raw_metadata, parsed_metadata, status, associated)])[0]
+    return stored
+
+def store_citation_targets(app, citation_targets):
+    """
+    Bulk version of store_citation_target: a batch of new citation targets is
+    stored with a single INSERT ... ON CONFLICT DO NOTHING RETURNING statement,
+    thus targets that already exist (e.g., stored by another worker) do not
+    abort the transaction.
+
+    :param citation_targets: list of (citation_change, content_type,
+        raw_metadata, parsed_metadata, status, associated) tuples
+    :return: list of booleans following the order of citation_targets (True
+        if the target was new and it has been stored)
+    """
+    rows = OrderedDict()
+    for citation_change, content_type, raw_metadata, parsed_metadata, status, associated in citation_targets:
+        if citation_change.content in rows:
+            continue
+        rows[citation_change.content] = {
+            'content': citation_change.content,
+            'content_type': content_type,
+            'raw_cited_metadata': raw_metadata,
+            'raw_cited_metadata_hash': doi.raw_metadata_hash(raw_metadata),
+            'parsed_cited_metadata': parsed_metadata,
+            'curated_metadata': {},
+            'status': status,
+            'bibcode': parsed_metadata.get("bibcode", None),
+            'associated_works': associated,
+            'created': get_date(),
+        }
+    stored_contents = set()
+    if rows:
+        with _session_scope(app, savepoint=True) as session:
+            table = CitationTarget.__table__
+            statement = pg_insert(table).values(list(rows.values())).on_conflict_do_nothing(index_elements=['content']).returning(table.c.content)
+            stored_contents = set(content for content, in session.execute(statement))
+            _record_history_session(session, CitationTarget, CitationTarget.content, stored_contents)
+            alternate_bibcodes = set((content, alternate_bibcode) for content in stored_contents
+                                     for alternate_bibcode in (rows[content]['parsed_cited_metadata'] or {}).get('alternate_bibcode', None) or [])
+            if alternate_bibcodes:
+                session.execute(pg_insert(CitationTargetAlternateBibcode.__table__)
+                                .values([{'content': content, 'alternate_bibcode': alternate_bibcode} for content, alternate_bibcode in alternate_bibcodes])
+                                .on_conflict_do_nothing())
+            _refresh_read_counts_session(session, stored_contents)
             session.commit()
-        except IntegrityError as e:
-            # IntegrityError: (psycopg2.IntegrityError) duplicate key value violates unique constraint "citing_content_unique_constraint"
-            logger.error("Ignoring new citation target (citing '%s', content '%s' and timestamp '%s') because it already exists in the database (another new citation may have been processed before this one): '%s'", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString(), str(e))
-        else:
+    stored = []
+    for citation_change, content_type, raw_metadata, parsed_metadata, status, associated in citation_targets:
+        if citation_change.content in stored_contents:
+            # Duplicates in the same batch are reported as already existing
+            stored_contents.discard(citation_change.content)
             logger.info("Stored new citation target (citing '%s', content '%s' and timestamp '%s')", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
-            stored = True
+            stored.append(True)
+        else:
+            logger.error("Ignoring new citation target (citing '%s', content '%s' and timestamp '%s') because it already exists in the database (another new citation may have been processed before this one)", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
+            stored.append(False)
     return stored
 
+def _record_history_session(session, model, key_column, keys, operation_type=0, versioned_by_orm=False):
+    """
+    Record the history (SQLAlchemy-Continuum version rows) of rows inserted
+    (operation_type 0) or updated (operation_type 1) by the db helpers,
+    following the history mode of the session (see HISTORY_MODE):
+
+    - 'orm': Continuum versions the rows written via the ORM when they are
+      flushed, rows written with bulk statements are recorded right away
+    - 'commit': all the rows written within a unit of work are recorded
+      set-based (one transaction record and one statement per table) right
+      before it is committed
+    - 'off': only the first version of new rows is recorded
+
+    :param versioned_by_orm: True if the rows were written via the ORM
+    """
+    keys = list(keys)
+    if not keys:
+        return
+    mode = getattr(_history_mode, 'mode', None) or session.info.get('history_mode', 'orm')
+    if (mode == 'orm' and versioned_by_orm) or (mode == 'off' and operation_type != 0):
+        return
+    pending_history = session.info.get('pending_history', None)
+    if mode == 'commit' and pending_history is not None and getattr(_unit_of_work, 'session', None) is session:
+        pending_keys = pending_history.setdefault((model, key_column), {})
+        for key in keys:
+            # Rows inserted and updated within the unit of work are recorded as inserted
+            pending_keys[key] = min(pending_keys.get(key, operation_type), operation_type)
+        return
+    if versioned_by_orm:
+        session.flush()
+    _insert_version_rows_session(session, model, key_column, keys, operation_type)
+
+def _write_pending_history_session(session):
+    """
+    Record the history collected in 'commit' history mode by the unit of
+    work of the session
+    """
+    pending_history = session.info.get('pending_history', None)
+    if not pending_history:
+        return
+    session.flush()
+    transaction_id = None
+    for (model, key_column), pending_keys in pending_history.items():
+        for operation_type in sorted(set(pending_keys.values())):
+            keys = [key for key, key_operation_type in pending_keys.items() if key_operation_type == operation_type]
+            transaction_id = _insert_version_rows_session(session, model, key_column, keys, operation_type, transaction_id=transaction_id)
+    pending_history.clear()
+
+def _insert_version_rows_session(session, model, key_column, keys, operation_type=0, transaction_id=None):
+    """
+    Record the version rows (SQLAlchemy-Continuum history) of rows inserted
+    (operation_type 0) or updated (operation_type 1) with bulk statements,
+    which bypass the ORM: one transaction record and a single
+    INSERT ... SELECT for all of them. For updates, the current versions of
+    the rows are closed first (validity strategy).
+
+    :return: id of the transaction record (created if transaction_id is None)
+    """
+    if not keys:
+        return transaction_id
+    if transaction_id is None:
+        transaction_table = versioning_manager.transaction_cls.__table__
+        transaction_id = session.execute(transaction_table.insert().values(issued_at=datetime.datetime.utcnow()).returning(transaction_table.c.id)).scalar()
+    table = model.__table__
+    version_table = version_class(model).__table__
+    if operation_type != 0:
+        session.execute(version_table.update()
+                        .where(version_table.c[key_column.name].in_(list(keys)))
+                        .where(version_table.c.end_transaction_id.is_(None))
+                        .values(end_transaction_id=transaction_id))
+    column_names = [column.name for column in table.columns]
+    rows = select([table.c[name] for name in column_names] + [literal(transaction_id), literal(operation_type)]).where(key_column.in_(list(keys)))
+    session.execute(version_table.insert().from_select(column_names + ['transaction_id', 'operation_type'], rows))
+    return transaction_id
+
 def _update_citation_target_metadata_session(session, content, raw_metadata, parsed_metadata, curated_metadata={}, status=None, bibcode=None, associated=None):
     """
     Actual calls to database session for update_citation_target_metadata
@@ -86,10 +388,17 @@ def _update_citation_target_metadata_session(session, content, raw_metadata, par
             raw_metadata = raw_metadata.decode('utf-8')
         except UnicodeEncodeError:
             pass
-    if citation_target.raw_cited_metadata != raw_metadata or citation_target.parsed_cited_metadata != parsed_metadata or \
+    raw_metadata_hash = doi.raw_metadata_hash(raw_metadata)
+    if citation_target.raw_cited_metadata_hash is not None:
+        # Compare hashes instead of the full raw metadata
+        raw_metadata_changed = citation_target.raw_cited_metadata_hash != raw_metadata_hash
+    else:
+        raw_metadata_changed = citation_target.raw_cited_metadata != raw_metadata
+    if raw_metadata_changed or citation_target.parsed_cited_metadata != parsed_metadata or \
             (status is not None and citation_target.status != status) or citation_target.curated_metadata != curated_metadata or \
         citation_target.bibcode != bibcode or citation_target.associated_works != associated:
         citation_target.raw_cited_metadata = raw_metadata
+        citation_target.raw_cited_metadata_hash = raw_metadata_hash
         citation_target.parsed_cited_metadata = parsed_metadata
         citation_target.curated_metadata = curated_metadata
         citation_target.bibcode = bibcode
@@ -99,18 +408,37 @@ def _update_citation_target_metadata_session(session, content, raw_metadata, par
         if status is not None:
             citation_target.status = status
         session.add(citation_target)
+        _sync_alternate_bibcodes_session(session, content, parsed_metadata)
+        _record_history_session(session, CitationTarget, CitationTarget.content, [content], operation_type=1, versioned_by_orm=True)
+        # Main/alternate bibcodes may have changed
+        session.flush()
+        _refresh_read_counts_session(session, [content])
         session.commit()
         logger.info("Updated metadata for citation target '%s' (alternative bibcodes '%s')", content, ", ".join(curated_metadata.get('alternate_bibcode', [])))
         metadata_updated = True
         return metadata_updated
 
+def _sync_alternate_bibcodes_session(session, content, parsed_metadata):
+    """
+    Make the alternate bibcode lookup table reflect the alternate bibcodes in
+    the parsed metadata of a citation target
+    """
+    alternate_bibcodes = set((parsed_metadata or {}).get('alternate_bibcode', None) or [])
+    existing_alternate_bibcodes = set(r.alternate_bibcode for r in session.query(CitationTargetAlternateBibcode.alternate_bibcode).filter_by(content=content).all())
+    stale_alternate_bibcodes = existing_alternate_bibcodes - alternate_bibcodes
+    if stale_alternate_bibcodes:
+        session.query(CitationTargetAlternateBibcode).filter(CitationTargetAlternateBibcode.content == content) \
+                .filter(CitationTargetAlternateBibcode.alternate_bibcode.in_(stale_alternate_bibcodes)).delete(synchronize_session=False)
+    for alternate_bibcode in alternate_bibcodes - existing_alternate_bibcodes:
+        session.add(CitationTargetAlternateBibcode(alternate_bibcode=alternate_bibcode, content=content))
+
 def update_citation_target_metadata(app, content, raw_metadata, parsed_metadata, curated_metadata={}, status=None, bibcode=None, associated=None):
     """
     Update metadata for a citation target
     """
     metadata_updated = False
     if not bibcode: bibcode = parsed_metadata.get('bibcode', None)
-    with app.session_scope() as session:
+    with _session_scope(app, savepoint=True) as session:
         metadata_updated =  _update_citation_target_metadata_session(session, content, raw_metadata, parsed_metadata, curated_metadata, status=status, bibcode=bibcode, associated=associated)
     return metadata_updated
 
@@ -121,67 +449,229 @@ def write_citation_target_data(app, only_status=None):
              Citation Network File
              Canonical Bibcodes File
              Facet Authors File
+
+    Each file is produced by a single query whose rows are streamed from a
+    server-side cursor directly to disk (constant memory). The queries run
+    concurrently (one session each) and, only if all of them succeed, the
+    files are published with atomic renames (plus optional compressed
+    siblings, see NONBIB_COMPRESSION) and a manifest with their row counts
+    and checksums is written.
+
+    The queries run against the read replica if there is one (snapshots and
+    deltas use the primary database instead, where their watermark is taken).
     """
-    with app.session_scope() as session:
-        if only_status:
-            records_db = session.query(CitationTarget).filter_by(status=only_status).all()
-            disable_filter = only_status in ['DISCARDED','EMITTABLE']
-        else:
-            records_db = session.query(CitationTarget).all()
-            disable_filter = True
-        bibcodes = [r.bibcode for r in records_db]
-        records = _extract_key_citation_target_data(records_db, disable_filter=disable_filter)
-        #writes canonical bibcodes to file.
-        with open(file_names['bibcode']+".tmp", 'w') as f:
-            f.write("\n".join(bibcodes))
-        logger.info("Writing Citation/Reference Network Files.")
-        _write_key_citation_reference_data(app, bibcodes)
-        logger.info("Writing author data for {} records".format(len(records)))
-        _write_key_citation_target_authors(app, records)
-        for file in file_names:
-            status = os.system('cp {} {}'.format(file_names[file]+".tmp", file_names[file]))
-            if status == 0:    
-                logger.info("Copied {}.tmp to {}".format(file_names[file], file_names[file]))
-                os.system('rm {}'.format(file_names[file]+".tmp"))
-                logger.debug('Removed {}.tmp file from /app/logs/output/'.format(file_names[file]))
-            else:
-                logger.warning("Copying file: {} Failed with exit code: {}".format(file_names[file], status))
+    _write_output_files(app, file_names, manifest_file_name, only_status=only_status, replica=True)
+
+def _write_output_files(app, paths, manifest_path, only_status=None, bibcodes=None, replica=False, **manifest_extra):
+    """
+    Write (and publish) one output file per entry of paths (same keys as
+    file_names), optionally restricted to the citation targets with the
+    given bibcodes. If replica is True, the files are written from the read
+    replica (see SQLALCHEMY_REPLICA_URL).
+    """
+    compression = app.conf.get('NONBIB_COMPRESSION', None)
+    output = OrderedDict((key, output_files.OutputFile(key, paths[key], compression=compression)) for key in paths)
+    writers = [
+        (_write_key_citation_target_bibcodes, (output['bibcode'],)),
+        (_write_key_citation_reference_data, (output['citations'], output['references'])),
+        (_write_key_citation_target_authors, (output['authors'],)),
+    ]
+    try:
+        for output_file in output.values():
+            output_file.open()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(writers)) as executor:
+            futures = [executor.submit(_write_in_session, app, writer, writer_output_files, only_status, bibcodes, replica) for writer, writer_output_files in writers]
+            for future in futures:
+                future.result()
+    except:
+        for output_file in output.values():
+            output_file.discard()
+        raise
+    for output_file in output.values():
+        output_file.publish()
+    return output_files.write_manifest(manifest_path, output.values(), **manifest_extra)
+
+def write_citation_target_snapshot(app):
+    """
+    Write the full DataPipeline files (REGISTERED records) and reset the
+    incremental export: the watermark is set to the start of the snapshot,
+    the bibcodes written for each citation target are recorded and the
+    delta files superseded by the snapshot are removed.
+    """
+    with _session_scope(app, savepoint=True) as session:
+        state = _get_nonbib_export_state_session(session) or {}
+        sequence = state.get('sequence', 0) + 1
+        watermark = session.query(func.now()).scalar()
+        session.query(NonbibExportTarget).delete(synchronize_session=False)
+        registered_targets = session.query(CitationTarget.content, CitationTarget.bibcode) \
+                .filter(CitationTarget.status == 'REGISTERED').filter(CitationTarget.bibcode.isnot(None))
+        session.execute(NonbibExportTarget.__table__.insert().from_select(['content', 'bibcode'], registered_targets))
+        _write_output_files(app, file_names, manifest_file_name, only_status='REGISTERED',
+                            type='snapshot', sequence=sequence, watermark=watermark.isoformat())
+        _set_nonbib_export_state_session(session, sequence, watermark, 0)
+        session.commit()
+    for file_name in list(file_names.values()) + [manifest_file_name]:
+        for path in glob.glob(glob.escape(file_name) + '.delta.*'):
+            os.remove(path)
+    logger.info("Wrote nonbib snapshot {} (watermark {})".format(sequence, watermark.isoformat()))
+
+def write_citation_target_delta_data(app):
+    """
+    Incremental version of write_citation_target_data: only the citation
+    targets (or their citations) modified since the last export are written.
+
+    For each output file two delta files are published:
+      - '<file>.delta.<sequence>.remove': bibcodes whose lines must be removed
+        (previously exported and current bibcodes of the modified targets)
+      - '<file>.delta.<sequence>.add': current lines of those bibcodes
+    so that applying the remove list and then the add file to the previous
+    version of the file results in the current full file. Applying a delta
+    more than once is harmless, which allows re-exporting the records
+    modified close to the watermark (NONBIB_DELTA_OVERLAP seconds) to cover
+    transactions that were not committed yet when the watermark was taken.
+
+    A full snapshot is written instead if there is no previous export or
+    after NONBIB_DELTA_COMPACTION_INTERVAL deltas (compaction).
+    """
+    state = get_nonbib_export_state(app)
+    if state is None or state['deltas_since_snapshot'] >= app.conf.get('NONBIB_DELTA_COMPACTION_INTERVAL', 24):
+        return write_citation_target_snapshot(app)
+    sequence = state['sequence'] + 1
+    since = state['watermark'] - datetime.timedelta(seconds=app.conf.get('NONBIB_DELTA_OVERLAP', 300))
+    with _session_scope(app, savepoint=True) as session:
+        watermark = session.query(func.now()).scalar()
+        modified_targets = session.query(CitationTarget.content) \
+                .filter(func.coalesce(CitationTarget.updated, CitationTarget.created) > since) \
+                .union(session.query(Citation.content).filter(func.coalesce(Citation.updated, Citation.created) > since)) \
+                .subquery()
+        previous_bibcodes = session.query(NonbibExportTarget.bibcode) \
+                .filter(NonbibExportTarget.content.in_(modified_targets))
+        current_bibcodes = session.query(CitationTarget.bibcode) \
+                .filter(CitationTarget.content.in_(modified_targets)).filter(CitationTarget.bibcode.isnot(None))
+        bibcodes = sorted(bibcode for bibcode, in previous_bibcodes.union(current_bibcodes))
+        delta_names = OrderedDict((key, "{}.delta.{:06d}".format(file_names[key], sequence)) for key in file_names)
+        for delta_name in delta_names.values():
+            remove_file = output_files.OutputFile('remove', delta_name + '.remove').open()
+            try:
+                for bibcode in bibcodes:
+                    remove_file.write(bibcode+"\n")
+            except:
+                remove_file.discard()
+                raise
+            remove_file.publish()
+        _write_output_files(app, OrderedDict((key, delta_names[key] + '.add') for key in delta_names),
+                            "{}.delta.{:06d}".format(manifest_file_name, sequence),
+                            only_status='REGISTERED', bibcodes=bibcodes, type='delta', sequence=sequence,
+                            since=since.isoformat(), watermark=watermark.isoformat(), removed=len(bibcodes))
+        # Record the bibcodes with which the modified targets have been exported
+        session.query(NonbibExportTarget).filter(NonbibExportTarget.content.in_(modified_targets)).delete(synchronize_session=False)
+        exported_targets = session.query(CitationTarget.content, CitationTarget.bibcode) \
+                .filter(CitationTarget.content.in_(modified_targets)) \
+                .filter(CitationTarget.status == 'REGISTERED').filter(CitationTarget.bibcode.isnot(None))
+        session.execute(NonbibExportTarget.__table__.insert().from_select(['content', 'bibcode'], exported_targets))
+        _set_nonbib_export_state_session(session, sequence, watermark, state['deltas_since_snapshot'] + 1)
+        session.commit()
+    logger.info("Wrote nonbib delta {} with {} modified bibcodes (watermark {})".format(sequence, len(bibcodes), watermark.isoformat()))
+
+def get_nonbib_export_state(app):
+    """
+    Return the sequence number, watermark and number of deltas since the last
+    snapshot of the last incremental export (None if there is none)
+    """
+    with _session_scope(app) as session:
+        return _get_nonbib_export_state_session(session)
+
+def _get_nonbib_export_state_session(session):
+    state = session.query(NonbibExportState).get(1)
+    if state is None:
+        return None
+    return {'sequence': state.sequence, 'watermark': state.watermark, 'deltas_since_snapshot': state.deltas_since_snapshot}
+
+def _set_nonbib_export_state_session(session, sequence, watermark, deltas_since_snapshot):
+    table = NonbibExportState.__table__
+    statement = pg_insert(table).values(id=1, sequence=sequence, watermark=watermark, deltas_since_snapshot=deltas_since_snapshot)
+    statement = statement.on_conflict_do_update(index_elements=['id'],
+                                                set_={'sequence': statement.excluded.sequence,
+                                                      'watermark': statement.excluded.watermark,
+                                                      'deltas_since_snapshot': statement.excluded.deltas_since_snapshot})
+    session.execute(statement)
 
-def _write_key_citation_target_authors(app, records):
+def _write_in_session(app, writer, writer_output_files, only_status, bibcodes, replica=False):
     """
-    Writes facet author data to file.
+    Run an output file writer in its own session (sessions are thread-local)
     """
+    session_scope = app.replica_session_scope if replica else app.session_scope
+    with session_scope() as session:
+        writer(app, session, *writer_output_files, only_status=only_status, bibcodes=bibcodes)
+
+def _filter_by_target_status(query, only_status, bibcodes=None):
+    if only_status:
+        query = query.filter(CitationTarget.status == only_status)
+    if bibcodes is not None:
+        query = query.filter(CitationTarget.bibcode == any_(_text_array(bibcodes)))
+    return query
+
+def _write_key_citation_target_bibcodes(app, session, f, only_status=None, bibcodes=None):
+    """
+    Writes canonical bibcodes to file.
+    """
+    query = session.query(CitationTarget.bibcode).filter(CitationTarget.bibcode.isnot(None))
+    query = _filter_by_target_status(query, only_status, bibcodes)
+    for bibcode, in query.yield_per(app.conf.get('NONBIB_EXPORT_BATCH_SIZE', 10000)):
+        f.write(bibcode if f.rows == 0 else "\n"+bibcode)
+    logger.info("Wrote file {} to disk ({} bibcodes).".format('bibcode', f.rows))
+
+def _write_key_citation_target_authors(app, session, f, only_status=None, bibcodes=None):
+    """
+    Writes facet author data to file (normalized authors, or their curated
+    version if it exists).
+    """
+    query = session.query(CitationTarget.bibcode,
+                          CitationTarget.parsed_cited_metadata['normalized_authors'],
+                          CitationTarget.curated_metadata['normalized_authors'])
+    query = _filter_by_target_status(query, only_status, bibcodes)
+    disable_filter = only_status in (None, 'DISCARDED', 'EMITTABLE')
+    if not disable_filter:
+        query = query.filter(CitationTarget.parsed_cited_metadata['bibcode'].astext.isnot(None))
     try:
-        with open(file_names['authors']+".tmp", 'w') as f:
-            for rec in records:
-                parsed_metadata = get_citation_target_metadata(app, rec['content']).get('parsed', {})
-                if parsed_metadata:
-                    f.write(str(rec['bibcode'])+"\t"+"\t".join(parsed_metadata.get('normalized_authors',''))+"\n")
+        for bibcode, parsed_authors, curated_authors in query.yield_per(app.conf.get('NONBIB_EXPORT_BATCH_SIZE', 10000)):
+            # Same as generate_modified_metadata: curated values only replace existing keys
+            authors = curated_authors if curated_authors is not None and parsed_authors is not None else parsed_authors
+            f.write(str(bibcode)+"\t"+"\t".join(authors or [])+"\n")
 
         logger.info("Wrote file {} to disk.".format('authors'))
     except Exception as e:
-        logger.exception("Failed to write file {}.".format(file_names['authors']+".tmp"))
-        raise Exception("Failed to write file {}.".format(file_names['authors']+".tmp"))
+        logger.exception("Failed to write file {}.".format(f.path))
+        raise Exception("Failed to write file {}.".format(f.path))
 
-def _write_key_citation_reference_data(app, bibcodes):
+def _write_key_citation_reference_data(app, session, f, g, only_status=None, bibcodes=None):
     """
     Write the two network files:
     Citation Network File: X cites software record
     Reference Network File: software record is cited by X
 
     Both are needed to integrate software records into classic record metrics.
-    """
+    Only REGISTERED citations to REGISTERED citation targets are included.
+    """
+    query = session.query(CitationTarget.bibcode, Citation.citing) \
+            .join(Citation, Citation.content == CitationTarget.content) \
+            .filter(CitationTarget.status == "REGISTERED").filter(Citation.status == "REGISTERED") \
+            .filter(CitationTarget.bibcode.isnot(None))
+    if only_status and only_status != "REGISTERED":
+        # Registered targets that share bibcode with the requested ones
+        selected_bibcodes = session.query(CitationTarget.bibcode).filter(CitationTarget.status == only_status)
+        query = query.filter(CitationTarget.bibcode.in_(selected_bibcodes.subquery()))
+    if bibcodes is not None:
+        query = query.filter(CitationTarget.bibcode == any_(_text_array(bibcodes)))
+    query = query.order_by(CitationTarget.bibcode, Citation.citing)
     try:
-        with open(file_names['citations']+".tmp", 'w') as f, open(file_names['references']+".tmp", 'w') as g:
-            for bib in bibcodes:
-                cites=get_citations_by_bibcode(app, bib)
-                for cite in cites:
-                    g.write(str(cite)+"\t"+str(bib)+"\n")
-                    f.write(str(bib)+"\t"+str(cite)+"\n")
-        logger.info("Wrote files {} and {} to disk.".format(file_names['citations'], file_names['references']))
+        for bib, cite in query.yield_per(app.conf.get('NONBIB_EXPORT_BATCH_SIZE', 10000)):
+            g.write(str(cite)+"\t"+str(bib)+"\n")
+            f.write(str(bib)+"\t"+str(cite)+"\n")
+        logger.info("Wrote files {} and {} to disk.".format(f.path, g.path))
     except Exception as e:
-        logger.exception("Failed to write files {} and {}.".format(file_names['citations']+".tmp", file_names['references']+".tmp"))
-        raise Exception("Failed to write files {} and {}.".format(file_names['citations']+".tmp", file_names['references']+".tmp"))
+        logger.exception("Failed to write files {} and {}.".format(f.path, g.path))
+        raise Exception("Failed to write files {} and {}.".format(f.path, g.path))
 
 def _update_citation_target_curator_message_session(session, content, msg):
     """
@@ -191,6 +681,7 @@ def _update_citation_target_curator_message_session(session, content, msg):
     if citation_target:
         citation_target.curated_metadata = msg
         session.add(citation_target)
+        _record_history_session(session, CitationTarget, CitationTarget.content, [content], operation_type=1, versioned_by_orm=True)
         session.commit()
         msg_updated = True
         return msg_updated
@@ -200,40 +691,164 @@ def update_citation_target_curator_message(app, content, msg):
     Update metadata for a citation target
     """
     msg_updated = False
-    with app.session_scope() as session:
+    with _session_scope(app, savepoint=True) as session:
         msg_updated =  _update_citation_target_curator_message_session(session, content, msg)
     return msg_updated
 
 def store_citation(app, citation_change, content_type, raw_metadata, parsed_metadata, status):
     """
     Stores a new citation in the DB
+    (if a citation write buffer is in progress, it is only buffered and None is returned)
     """
-    stored = False
-    with app.session_scope() as session:
-        citation = Citation()
-        citation.citing = citation_change.citing
-        citation.cited = citation_change.cited
-        citation.content = citation_change.content
-        citation.resolved = citation_change.resolved
-        citation.timestamp = citation_change.timestamp.ToDatetime().replace(tzinfo=tzutc())
-        citation.status = status
-        session.add(citation)
-        try:
+    write_buffer = getattr(_citation_write_buffer, 'buffer', None)
+    if write_buffer is not None:
+        write_buffer.add(citation_change, status)
+        return None
+    stored = store_citations(app, [(citation_change, status)])[0]
+    return stored
+
+def store_citations(app, citations):
+    """
+    Bulk version of store_citation: a batch of new citations is stored with a
+    single INSERT ... ON CONFLICT DO NOTHING RETURNING statement, thus
+    citations that already exist do not abort the transaction.
+
+    :param citations: list of (citation_change, status) tuples
+    :return: list of booleans following the order of citations (True if the
+        citation was new and it has been stored)
+    """
+    rows = OrderedDict()
+    for citation_change, status in citations:
+        key = (citation_change.citing, citation_change.content)
+        if key in rows:
+            continue
+        rows[key] = {
+            'citing': citation_change.citing,
+            'cited': citation_change.cited,
+            'content': citation_change.content,
+            'resolved': citation_change.resolved,
+            'timestamp': citation_change.timestamp.ToDatetime().replace(tzinfo=tzutc()),
+            'status': status,
+            'created': get_date(),
+        }
+    stored_keys = {}
+    if rows:
+        with _session_scope(app, savepoint=True) as session:
+            table = Citation.__table__
+            statement = pg_insert(table).values(list(rows.values())) \
+                    .on_conflict_do_nothing(constraint='citing_content_unique_constraint') \
+                    .returning(table.c.id, table.c.citing, table.c.content)
+            stored_keys = {(citing, content): citation_id for citation_id, citing, content in session.execute(statement)}
+            _record_history_session(session, Citation, Citation.id, stored_keys.values())
+            _adjust_citation_counts_session(session, [content for citing, content in stored_keys if rows[(citing, content)]['status'] == "REGISTERED"])
             session.commit()
-        except IntegrityError as e:
-            # IntegrityError: (psycopg2.IntegrityError) duplicate key value violates unique constraint "citing_content_unique_constraint"
-            logger.error("Ignoring new citation (citing '%s', content '%s' and timestamp '%s') because it already exists in the database when it is not supposed to (race condition?): '%s'", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString(), str(e))
-        else:
+    stored = []
+    for citation_change, status in citations:
+        if stored_keys.pop((citation_change.citing, citation_change.content), None) is not None:
             logger.info("Stored new citation (citing '%s', content '%s' and timestamp '%s')", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
-            stored = True
+            stored.append(True)
+        else:
+            logger.error("Ignoring new citation (citing '%s', content '%s' and timestamp '%s') because it already exists in the database when it is not supposed to (race condition?)", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
+            stored.append(False)
     return stored
 
+class CitationWriteBuffer():
+    """
+    New citations collected by store_citation within citation_write_buffer
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.pending = []
+        self.results = []
+        # after_commit callbacks of the citation change in progress
+        self.callbacks = None
+
+    def add(self, citation_change, status):
+        callbacks = []
+        if self.callbacks is not None:
+            callbacks, self.callbacks = self.callbacks, []
+        self.pending.append((citation_change, status, callbacks))
+
+    def registered_citing(self, content):
+        return [citation_change.citing for citation_change, status, callbacks in self.pending
+                if citation_change.content == content and status == "REGISTERED"]
+
+    @contextlib.contextmanager
+    def citation_change_scope(self):
+        """
+        Process a citation change within the block: the callbacks registered
+        with after_commit before its citation is buffered are held until the
+        buffer is flushed and only executed if the citation turns out to be
+        new. The rest of callbacks are executed as usual.
+
+        The block runs in a savepoint of the unit of work: if an exception is
+        raised, its changes, its buffered citation and its callbacks are
+        discarded without affecting the rest of the batch.
+        """
+        n_pending = len(self.pending)
+        self.callbacks = []
+        try:
+            with _session_scope(self.app, savepoint=True):
+                yield
+        except:
+            del self.pending[n_pending:]
+            raise
+        finally:
+            callbacks, self.callbacks = self.callbacks, None
+        for callback in callbacks:
+            after_commit(callback)
+
+    def flush(self):
+        """
+        Store the pending citations with a single bulk statement, the outcome
+        (True if new) of each of them is appended to results. The callbacks
+        held for the citations that already existed are discarded.
+        """
+        pending, self.pending = self.pending, []
+        stored = store_citations(self.app, [(citation_change, status) for citation_change, status, callbacks in pending])
+        for (citation_change, status, callbacks), new in zip(pending, stored):
+            self.results.append((citation_change, status, new))
+            if new:
+                for callback in callbacks:
+                    after_commit(callback)
+            elif callbacks:
+                logger.info("Discarding %i events/forwards of citation (citing '%s', content '%s') because it already exists", len(callbacks), citation_change.citing, citation_change.content)
+        return stored
+
+@contextlib.contextmanager
+def citation_write_buffer(app):
+    """
+    Buffer the citations stored with store_citation (by the current thread)
+    within the block and store all of them with a single bulk statement at
+    the end of it. get_citations includes the buffered REGISTERED citations
+    so that records forwarded within the block count them.
+    Yields the CitationWriteBuffer, whose results report which citations
+    were new.
+
+    It is meant to be used within a unit of work, so that the citations are
+    written in the same transaction as the rest of changes of the batch and
+    before the after_commit callbacks are executed. If an exception is
+    raised, the buffered citations are discarded (the unit of work is rolled
+    back).
+    """
+    if getattr(_citation_write_buffer, 'buffer', None) is not None:
+        yield _citation_write_buffer.buffer
+        return
+    write_buffer = CitationWriteBuffer(app)
+    _citation_write_buffer.buffer = write_buffer
+    try:
+        yield write_buffer
+        write_buffer.flush()
+    finally:
+        _citation_write_buffer.buffer = None
+
 def store_reader_data(app, reader_change, status):
     """
     Stores a new citation in the DB
     """
     stored = False
-    with app.session_scope() as session:
+    with _session_scope(app, savepoint=True) as session:
         reads = Reader()
         reads.bibcode = reader_change['bibcode']
         reads.reader = reader_change['reader']
@@ -241,6 +856,8 @@ def store_reader_data(app, reader_change, status):
         reads.status = status
         session.add(reads)
         try:
+            session.flush()
+            _refresh_read_counts_session(session, _get_citation_target_contents_by_bibcode_session(session, [reads.bibcode]))
             session.commit()
         except IntegrityError as e:
             # IntegrityError: (psycopg2.IntegrityError) duplicate key value violates unique constraint "citing_content_unique_constraint"
@@ -250,13 +867,86 @@ def store_reader_data(app, reader_change, status):
             stored = True
     return stored
 
+def _adjust_citation_counts_session(session, contents, delta=1):
+    """
+    Add delta to the aggregated number of REGISTERED citations of each
+    occurrence of a content (e.g., one per citation stored/deleted) with a
+    single INSERT ... ON CONFLICT DO UPDATE statement
+    """
+    deltas = {}
+    for content in contents:
+        deltas[content] = deltas.get(content, 0) + delta
+    if not deltas:
+        return
+    table = CitationTargetAggregate.__table__
+    # Same row order in all the transactions to avoid deadlocks
+    statement = pg_insert(table).values([{'content': content, 'citation_count': deltas[content], 'updated': get_date()} for content in sorted(deltas)])
+    statement = statement.on_conflict_do_update(index_elements=['content'],
+                                                set_={'citation_count': table.c.citation_count + statement.excluded.citation_count,
+                                                      'updated': statement.excluded.updated})
+    session.execute(statement)
+
+def _refresh_read_counts_session(session, contents):
+    """
+    Recompute the aggregated number of distinct REGISTERED readers of the
+    given citation targets (readers are stored by main or alternate bibcode,
+    thus only the affected targets are counted again) with a single
+    INSERT ... SELECT ... ON CONFLICT DO UPDATE statement
+    """
+    contents = sorted(set(contents))
+    if not contents:
+        return
+    target = CitationTarget.__table__
+    alternate = CitationTargetAlternateBibcode.__table__
+    reader = Reader.__table__
+    # Main and alternate bibcodes of the targets, so that readers are joined
+    # by equality (index on readers bibcode/status)
+    target_bibcodes = union(
+        select([target.c.content, target.c.bibcode.label('bibcode')]).where(target.c.content == any_(_text_array(contents))),
+        select([alternate.c.content, alternate.c.alternate_bibcode.label('bibcode')]).where(alternate.c.content == any_(_text_array(contents))),
+    ).alias('target_bibcode')
+    rows = select([target_bibcodes.c.content, func.count(distinct(reader.c.reader)), literal(get_date(), type_=DateTime(timezone=True))]) \
+            .select_from(target_bibcodes.outerjoin(reader, and_(reader.c.bibcode == target_bibcodes.c.bibcode, reader.c.status == "REGISTERED"))) \
+            .group_by(target_bibcodes.c.content) \
+            .order_by(target_bibcodes.c.content)
+    table = CitationTargetAggregate.__table__
+    statement = pg_insert(table).from_select(['content', 'read_count', 'updated'], rows)
+    statement = statement.on_conflict_do_update(index_elements=['content'],
+                                                set_={'read_count': statement.excluded.read_count,
+                                                      'updated': statement.excluded.updated})
+    session.execute(statement)
+
+def _get_citation_target_contents_by_bibcode_session(session, bibcodes):
+    """
+    Return the contents of the citation targets (any status) that have one
+    of the bibcodes as main or alternate bibcode
+    """
+    bibcodes = _text_array(bibcodes)
+    by_bibcode = session.query(CitationTarget.content).filter(CitationTarget.bibcode == any_(bibcodes))
+    by_alt_bibcode = session.query(CitationTargetAlternateBibcode.content).filter(CitationTargetAlternateBibcode.alternate_bibcode == any_(bibcodes))
+    return [content for content, in by_bibcode.union(by_alt_bibcode).all()]
+
+def get_citation_target_aggregates(app, contents):
+    """
+    Return the number of REGISTERED citations and distinct REGISTERED readers
+    of the given citation targets, keyed by content (one row per target is
+    read from the aggregate table, targets without counts are not included)
+    """
+    aggregates = {}
+    with _read_session_scope(app) as session:
+        query = session.query(CitationTargetAggregate.content, CitationTargetAggregate.citation_count, CitationTargetAggregate.read_count) \
+                .filter(CitationTargetAggregate.content == any_(_text_array(contents)))
+        for content, citation_count, read_count in query.all():
+            aggregates[content] = {'citation_count': citation_count, 'read_count': read_count}
+    return aggregates
+
 def get_citation_target_count(app):
     """
     Return the number of citation targets registered in the database
     """
     citation_target_count = 0
-    with app.session_scope() as session:
-        citation_target_count = session.query(CitationTarget).count()
+    with _session_scope(app) as session:
+        citation_target_count = session.query(func.count(CitationTarget.content)).scalar()
     return citation_target_count
 
 def get_citation_count(app):
@@ -264,13 +954,31 @@ def get_citation_count(app):
     Return the number of citations registered in the database
     """
     citation_count = 0
-    with app.session_scope() as session:
-        citation_count = session.query(Citation).count()
+    with _session_scope(app) as session:
+        citation_count = session.query(func.count(Citation.id)).scalar()
     return citation_count
 
+def _query_key_citation_target_data(session, *entities):
+    """
+    Query that only loads the columns used by _extract_key_citation_target_data
+    (optionally preceded by other entities): the raw metadata is not
+    transferred and only the used keys of the parsed metadata are.
+    """
+    parsed_cited_metadata = CitationTarget.parsed_cited_metadata
+    # Null keys are stripped so that missing keys still get their default values
+    key_parsed_cited_metadata = func.jsonb_strip_nulls(func.jsonb_build_object(
+        'bibcode', parsed_cited_metadata['bibcode'],
+        'alternate_bibcode', parsed_cited_metadata['alternate_bibcode'],
+        'version', parsed_cited_metadata['version'],
+    ), type_=JSONB).label('parsed_cited_metadata')
+    return session.query(*(entities + (CitationTarget.bibcode, key_parsed_cited_metadata, CitationTarget.content,
+                                       CitationTarget.content_type, CitationTarget.raw_cited_metadata_hash,
+                                       CitationTarget.curated_metadata, CitationTarget.associated_works)))
+
 def _extract_key_citation_target_data(records_db, disable_filter=False):
     """
-    Convert list of CitationTarget to a list of dictionaries with key data
+    Convert list of CitationTarget (or rows from _query_key_citation_target_data)
+    to a list of dictionaries with key data
     """
     records = [
         {
@@ -279,6 +987,7 @@ def _extract_key_citation_target_data(records_db, disable_filter=False):
             'version': record_db.parsed_cited_metadata.get('version', None),
             'content': record_db.content,
             'content_type': record_db.content_type,
+            'raw_cited_metadata_hash': record_db.raw_cited_metadata_hash,
             'curated_metadata': record_db.curated_metadata if record_db.curated_metadata is not None else {},
             'associated_works': record_db.associated_works,
         }
@@ -287,46 +996,86 @@ def _extract_key_citation_target_data(records_db, disable_filter=False):
     ]
     return records
 
-def get_citation_targets_by_bibcode(app, bibcodes, only_status='REGISTERED'):
+def _text_array(values):
     """
-    Return a list of dict with the requested citation targets based on their bibcode
+    Bind a list of strings as a single PostgreSQL array parameter (to be used
+    with ANY/?| operators) instead of one parameter per element
     """
-    with app.session_scope() as session:
-        records_db = []
-        for bibcode in bibcodes:
-            if only_status:
-                record_db = session.query(CitationTarget).filter(CitationTarget.bibcode == bibcode).filter_by(status=only_status).first()
-            else:
-                record_db = session.query(CitationTarget).filter(CitationTarget.bibcode == bibcode).first()
-            if record_db:
-                records_db.append(record_db)
+    return literal(list(values), type_=ARRAY(Text()))
+
+def _get_citation_targets_by_bibcode_session(session, bibcodes, only_status='REGISTERED'):
+    """
+    Actual calls to database session for get_citation_targets_by_bibcode:
+    a single query that returns a dict requested bibcode -> key data row
+    """
+    records_db = {}
+    bibcodes = list(OrderedDict.fromkeys(bibcodes))
+    if bibcodes:
+        query = _query_key_citation_target_data(session).filter(CitationTarget.bibcode == any_(_text_array(bibcodes)))
+        if only_status:
+            query = query.filter(CitationTarget.status == only_status)
+        for record_db in query.all():
+            records_db.setdefault(record_db.bibcode, record_db)
+    return records_db
 
+def _get_citation_targets_by_alt_bibcode_session(session, alt_bibcodes, only_status='REGISTERED'):
+    """
+    Actual calls to database session for get_citation_targets_by_alt_bibcode:
+    a single query that returns a dict requested alternate bibcode -> key data row
+    (resolved via the indexed alternate bibcode table)
+    """
+    records_db = {}
+    alt_bibcodes = list(OrderedDict.fromkeys(alt_bibcodes))
+    if alt_bibcodes:
+        query = _query_key_citation_target_data(session, CitationTargetAlternateBibcode.alternate_bibcode.label('requested_alternate_bibcode')) \
+                .select_from(CitationTargetAlternateBibcode) \
+                .join(CitationTarget, CitationTarget.content == CitationTargetAlternateBibcode.content) \
+                .filter(CitationTargetAlternateBibcode.alternate_bibcode == any_(_text_array(alt_bibcodes)))
         if only_status:
-            disable_filter = only_status == 'DISCARDED'
-        else:
-            disable_filter = True
-        records = _extract_key_citation_target_data(records_db, disable_filter=disable_filter)
-    return records
+            query = query.filter(CitationTarget.status == only_status)
+        for record_db in query.all():
+            records_db.setdefault(record_db.requested_alternate_bibcode, record_db)
+    return records_db
 
-def get_citation_targets_by_alt_bibcode(app, alt_bibcodes, only_status='REGISTERED'):
+def _key_citation_target_data_by_identifier(identifiers, records_db, only_status, keyed):
+    """
+    Convert the CitationTarget found for each requested identifier to their
+    key data following the order of the request (identifiers without a
+    citation target are skipped). If keyed is True, a dict identifier -> key
+    data is returned instead of a list.
+    """
+    if only_status:
+        disable_filter = only_status == 'DISCARDED'
+    else:
+        disable_filter = True
+    records = OrderedDict()
+    for identifier in identifiers:
+        if identifier in records_db and identifier not in records:
+            record = _extract_key_citation_target_data([records_db[identifier]], disable_filter=disable_filter)
+            if record:
+                records[identifier] = record[0]
+    if keyed:
+        return records
+    return [records[identifier] for identifier in identifiers if identifier in records]
+
+def get_citation_targets_by_bibcode(app, bibcodes, only_status='REGISTERED', keyed=False):
     """
     Return a list of dict with the requested citation targets based on their bibcode
+    (or a dict bibcode -> citation target if keyed is True)
     """
-    with app.session_scope() as session:
-        records_db = []
-        for alt_bibcode in alt_bibcodes:
-            if only_status:
-                record_db = session.query(CitationTarget).filter(CitationTarget.parsed_cited_metadata['alternate_bibcode'].contains([alt_bibcode])).filter_by(status=only_status).first()
-            else:
-                record_db = session.query(CitationTarget).filter(CitationTarget.parsed_cited_metadata['alternate_bibcode'].contains([alt_bibcode])).first()
-            if record_db:
-                records_db.append(record_db)
+    with _read_session_scope(app) as session:
+        records_db = _get_citation_targets_by_bibcode_session(session, bibcodes, only_status)
+        records = _key_citation_target_data_by_identifier(bibcodes, records_db, only_status, keyed)
+    return records
 
-        if only_status:
-            disable_filter = only_status == 'DISCARDED'
-        else:
-            disable_filter = True
-        records = _extract_key_citation_target_data(records_db, disable_filter=disable_filter)
+def get_citation_targets_by_alt_bibcode(app, alt_bibcodes, only_status='REGISTERED', keyed=False):
+    """
+    Return a list of dict with the requested citation targets based on their alternate bibcode
+    (or a dict alternate bibcode -> citation target if keyed is True)
+    """
+    with _read_session_scope(app) as session:
+        records_db = _get_citation_targets_by_alt_bibcode_session(session, alt_bibcodes, only_status)
+        records = _key_citation_target_data_by_identifier(alt_bibcodes, records_db, only_status, keyed)
     return records
 
 def get_citation_targets_by_doi(app, dois, only_status='REGISTERED'):
@@ -334,12 +1083,12 @@ def get_citation_targets_by_doi(app, dois, only_status='REGISTERED'):
     Return a list of dict with the requested citation targets based on their DOI
     - Records without a bibcode in the database will not be returned
     """
-    with app.session_scope() as session:
+    with _read_session_scope(app) as session:
         if only_status:
-            records_db = session.query(CitationTarget).filter(CitationTarget.content.in_(dois)).filter_by(status=only_status).all()
+            records_db = _query_key_citation_target_data(session).filter(CitationTarget.content.in_(dois)).filter(CitationTarget.status == only_status).all()
             disable_filter = only_status == 'DISCARDED'
         else:
-            records_db = session.query(CitationTarget).filter(CitationTarget.content.in_(dois)).all()
+            records_db = _query_key_citation_target_data(session).filter(CitationTarget.content.in_(dois)).all()
             disable_filter = True
         records = _extract_key_citation_target_data(records_db, disable_filter=disable_filter)
     return records
@@ -349,10 +1098,10 @@ def _get_citation_targets_session(session, only_status='REGISTERED'):
     Actual calls to database session for get_citation_targets
     """
     if only_status:
-        records_db = session.query(CitationTarget).filter_by(status=only_status).all()
+        records_db = _query_key_citation_target_data(session).filter(CitationTarget.status == only_status).all()
         disable_filter = only_status in ['DISCARDED', 'EMITTABLE']
     else:
-        records_db = session.query(CitationTarget).all()
+        records_db = _query_key_citation_target_data(session).all()
         disable_filter = True
     records = _extract_key_citation_target_data(records_db, disable_filter=disable_filter)
     return records
@@ -380,7 +1129,7 @@ def get_citation_targets(app, only_status='REGISTERED'):
     Return a list of dict with all citation targets (or only the registered ones)
     - Records without a bibcode in the database will not be returned
     """
-    with app.session_scope() as session:
+    with _read_session_scope(app) as session:
         records = _get_citation_targets_session(session, only_status)
     return records
 
@@ -402,7 +1151,11 @@ def _get_citation_target_metadata_session(session, doi, citation_in_db, metadata
         else:
             metadata['parsed'] = citation_target.parsed_cited_metadata if citation_target.parsed_cited_metadata is not None else {}
         if concept:
-            metadata['parsed']['pubdate']=citation_target.versions[0].parsed_cited_metadata.get('pubdate')
+            # Only the pubdate of the first version is needed (not the full version rows with their raw metadata)
+            CitationTargetVersion = version_class(CitationTarget)
+            first_version = session.query(CitationTargetVersion.parsed_cited_metadata['pubdate'].astext.label('pubdate')) \
+                    .filter(CitationTargetVersion.content == doi).order_by(CitationTargetVersion.transaction_id).first()
+            metadata['parsed']['pubdate'] = first_version.pubdate if first_version else None
         metadata['associated'] = citation_target.associated_works
     return metadata
 
@@ -415,7 +1168,7 @@ def get_citation_target_metadata(app, doi, curate=True, concept=False):
     """
     citation_in_db = False
     metadata = {}
-    with app.session_scope() as session:
+    with _session_scope(app) as session:
         metadata = _get_citation_target_metadata_session(session, doi, citation_in_db, metadata, curate, concept) 
     return metadata
 
@@ -426,8 +1179,8 @@ def get_citation_target_entry_date(app, doi):
     """
     citation_in_db = False
     entry_date = None
-    with app.session_scope() as session:
-        citation_target = session.query(CitationTarget).filter_by(content=doi).first()
+    with _session_scope(app) as session:
+        citation_target = session.query(CitationTarget.created).filter(CitationTarget.content == doi).first()
         citation_target_in_db = citation_target is not None
         if citation_target_in_db:
             entry_date = citation_target.created
@@ -440,9 +1193,9 @@ def get_citations_by_bibcode(app, bibcode):
     """
     citations = []
     if bibcode is not None:
-        with app.session_scope() as session:
+        with _read_session_scope(app) as session:
             #bibcode = "2015zndo.....14475J"
-            citation_target = session.query(CitationTarget).filter(CitationTarget.bibcode == bibcode).filter_by(status="REGISTERED").first()
+            citation_target = session.query(CitationTarget.content).filter(CitationTarget.bibcode == bibcode).filter(CitationTarget.status == "REGISTERED").first()
             if citation_target:
                 dummy_citation_change = CitationChange(content=citation_target.content)
                 citations = get_citations(app, dummy_citation_change)
@@ -453,19 +1206,31 @@ def get_citations(app, citation_change):
     Return all the citations (bibcodes) to a given content.
     It will ignore DELETED and DISCARDED citations.
     """
-    with app.session_scope() as session:
-        citation_bibcodes = [r.citing for r in session.query(Citation).filter_by(content=citation_change.content, status="REGISTERED").all()]
+    with _read_session_scope(app) as session:
+        citation_bibcodes = [r.citing for r in session.query(Citation.citing).filter(Citation.content == citation_change.content).filter(Citation.status == "REGISTERED").all()]
+    write_buffer = getattr(_citation_write_buffer, 'buffer', None)
+    if write_buffer is not None:
+        # Citations stored but not written yet
+        citation_bibcodes += [citing for citing in write_buffer.registered_citing(citation_change.content) if citing not in citation_bibcodes]
     return citation_bibcodes
 
-def get_citation_target_readers(app, bibcode, alt_bibcodes):
+def get_citation_target_readers(app, bibcode, alt_bibcodes, count_only=False):
     """
-    Return all the Reader hashes for a given content.
+    Return all the distinct Reader hashes for a given content (main and
+    alternate bibcodes are resolved in a single query).
     It will ignore DELETED and DISCARDED hashes.
+    If count_only is True, only the number of distinct readers is returned.
     """
-    with app.session_scope() as session:
-        reader_hashes = [r.reader for r in session.query(Reader).filter_by(bibcode=bibcode, status="REGISTERED").all()]
-        for alt_bibcode in alt_bibcodes:
-            reader_hashes = reader_hashes + [r.reader for r in session.query(Reader).filter_by(bibcode=alt_bibcode, status="REGISTERED").all()]
+    bibcodes = [bibcode] + list(alt_bibcodes or [])
+    with _read_session_scope(app) as session:
+        if count_only:
+            query = session.query(func.count(distinct(Reader.reader)))
+        else:
+            query = session.query(Reader.reader).distinct().order_by(Reader.reader)
+        query = query.filter(Reader.bibcode == any_(_text_array(bibcodes))).filter(Reader.status == "REGISTERED")
+        if count_only:
+            return query.scalar()
+        reader_hashes = [r.reader for r in query.all()]
 
     return reader_hashes
 
@@ -496,53 +1261,185 @@ def citation_already_exists(app, citation_change):
     Is this citation already stored in the DB?
     """
     citation_in_db = False
-    with app.session_scope() as session:
-        citation = session.query(Citation).filter_by(citing=citation_change.citing, content=citation_change.content).first()
+    with _session_scope(app) as session:
+        citation = session.query(Citation.id).filter(Citation.citing == citation_change.citing).filter(Citation.content == citation_change.content).first()
         citation_in_db = citation is not None
     return citation_in_db
 
+def citations_already_exist(app, citation_changes):
+    """
+    Bulk version of citation_already_exists: for every citation change in the
+    batch, is this citation already stored in the DB?
+    All the (citing, content) pairs are resolved in a single query and a list
+    of booleans is returned following the order of the citation changes.
+    """
+    pairs = [(citation_change.citing, citation_change.content) for citation_change in citation_changes]
+    existing_pairs = set()
+    if pairs:
+        with _session_scope(app) as session:
+            existing_pairs = set(session.query(Citation.citing, Citation.content).filter(tuple_(Citation.citing, Citation.content).in_(set(pairs))).all())
+    citations_in_db = [pair in existing_pairs for pair in pairs]
+    return citations_in_db
+
 def update_citation(app, citation_change):
     """
     Update cited information
     """
-    updated = False
-    with app.session_scope() as session:
-        citation = session.query(Citation).with_for_update().filter_by(citing=citation_change.citing, content=citation_change.content).first()
-        change_timestamp = citation_change.timestamp.ToDatetime().replace(tzinfo=tzutc()) # Consider it as UTC to be able to compare it
-        if citation.timestamp < change_timestamp:
-            #citation.citing = citation_change.citing # This should not change
-            #citation.content = citation_change.content # This should not change
-            citation.cited = citation_change.cited
-            citation.resolved = citation_change.resolved
-            citation.timestamp = change_timestamp
-            session.add(citation)
-            session.commit()
-            updated = True
+    updated, previous_status = _citation_change_outcome(app, citation_change, deleted=False)
+    return updated
+
+def update_citations(app, citation_changes):
+    """
+    Bulk version of update_citation: the cited information of a batch of
+    citations is updated with a single set-based statement, the timestamp
+    guard (only changes more recent than the stored ones are applied) is
+    evaluated by the database.
+
+    :return: list of (updated, previous_status) tuples following the order
+        of citation_changes
+    """
+    outcomes = _apply_citation_changes(app, citation_changes, deleted=False)
+    for citation_change, (updated, previous_status) in zip(citation_changes, outcomes):
+        if updated:
             logger.info("Updated citation (citing '%s', content '%s' and timestamp '%s')", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
+        elif previous_status is None:
+            logger.error("Ignoring citation update (citing '%s', content '%s' and timestamp '%s') because it does not exist in the database", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
         else:
             logger.info("Ignoring citation update (citing '%s', content '%s' and timestamp '%s') because received timestamp is equal/older than timestamp in database", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
-    return updated
+    return outcomes
 
 def mark_citation_as_deleted(app, citation_change):
     """
     Update status to DELETED for a given citation
     """
-    marked_as_deleted = False
-    previous_status = None
-    with app.session_scope() as session:
-        citation = session.query(Citation).with_for_update().filter_by(citing=citation_change.citing, content=citation_change.content).first()
-        previous_status = citation.status
-        change_timestamp = citation_change.timestamp.ToDatetime().replace(tzinfo=tzutc()) # Consider it as UTC to be able to compare it
-        if citation.timestamp < change_timestamp:
-            citation.status = "DELETED"
-            citation.timestamp = change_timestamp
-            session.add(citation)
-            session.commit()
-            marked_as_deleted = True
+    marked_as_deleted, previous_status = _citation_change_outcome(app, citation_change, deleted=True)
+    return marked_as_deleted, previous_status
+
+def mark_citations_as_deleted(app, citation_changes):
+    """
+    Bulk version of mark_citation_as_deleted: a batch of citations is marked
+    as deleted with a single set-based statement, the timestamp guard (only
+    changes more recent than the stored ones are applied) is evaluated by
+    the database.
+
+    :return: list of (marked_as_deleted, previous_status) tuples following
+        the order of citation_changes
+    """
+    outcomes = _apply_citation_changes(app, citation_changes, deleted=True)
+    for citation_change, (marked_as_deleted, previous_status) in zip(citation_changes, outcomes):
+        if marked_as_deleted:
             logger.info("Marked citation as deleted (citing '%s', content '%s' and timestamp '%s')", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
+        elif previous_status is None:
+            logger.error("Ignoring citation deletion (citing '%s', content '%s' and timestamp '%s') because it does not exist in the database", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
         else:
             logger.info("Ignoring citation deletion (citing '%s', content '%s' and timestamp '%s') because received timestamp is equal/older than timestamp in database", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
-    return marked_as_deleted, previous_status
+    return outcomes
+
+def _apply_citation_changes(app, citation_changes, deleted=False):
+    """
+    Apply updated (or deleted) citation changes with a single
+    UPDATE ... FROM (SELECT unnest(...)) statement: the changes are bound as
+    one array parameter per column and joined with the citation table, the
+    rows are only updated if the change is more recent than the stored
+    timestamp. The rows are locked beforehand (in id order, to avoid
+    deadlocks between concurrent batches) to collect their previous status.
+
+    If a batch contains several changes for the same citation, only the most
+    recent one can be applied (as if they had been processed in order).
+
+    :return: list of (applied, previous_status) tuples following the order
+        of citation_changes (previous_status is None if the citation does
+        not exist)
+    """
+    latest = {}
+    for i, citation_change in enumerate(citation_changes):
+        key = (citation_change.citing, citation_change.content)
+        change_timestamp = citation_change.timestamp.ToDatetime().replace(tzinfo=tzutc()) # Consider it as UTC to be able to compare it
+        if key not in latest or latest[key][1] < change_timestamp:
+            latest[key] = (i, change_timestamp)
+    previous_statuses = {}
+    applied = {}
+    if latest:
+        with _session_scope(app, savepoint=True) as session:
+            previous_statuses = {(citing, content): status for citing, content, status in
+                                 session.query(Citation.citing, Citation.content, Citation.status)
+                                 .filter(tuple_(Citation.citing, Citation.content).in_(list(latest.keys())))
+                                 .order_by(Citation.id).with_for_update()}
+            table = Citation.__table__
+            changes = select([
+                func.unnest(_text_array(citing for citing, content in latest)).label('citing'),
+                func.unnest(_text_array(content for citing, content in latest)).label('content'),
+                func.unnest(_text_array(citation_changes[i].cited for i, change_timestamp in latest.values())).label('cited'),
+                func.unnest(literal([citation_changes[i].resolved for i, change_timestamp in latest.values()], type_=ARRAY(Boolean()))).label('resolved'),
+                func.unnest(literal([change_timestamp for i, change_timestamp in latest.values()], type_=ARRAY(DateTime(timezone=True)))).label('timestamp'),
+            ]).alias('citation_change')
+            values = {'timestamp': changes.c.timestamp, 'updated': get_date()}
+            if deleted:
+                values['status'] = 'DELETED'
+            else:
+                values['cited'] = changes.c.cited
+                values['resolved'] = changes.c.resolved
+            statement = table.update() \
+                    .where(table.c.citing == changes.c.citing) \
+                    .where(table.c.content == changes.c.content) \
+                    .where(table.c.timestamp < changes.c.timestamp) \
+                    .values(**values) \
+                    .returning(table.c.id, table.c.citing, table.c.content)
+            applied = {(citing, content): citation_id for citation_id, citing, content in session.execute(statement)}
+            _record_history_session(session, Citation, Citation.id, applied.values(), operation_type=1)
+            if deleted:
+                _adjust_citation_counts_session(session, [content for citing, content in applied if previous_statuses.get((citing, content)) == "REGISTERED"], delta=-1)
+            session.commit()
+    outcomes = []
+    for i, citation_change in enumerate(citation_changes):
+        key = (citation_change.citing, citation_change.content)
+        outcomes.append((key in applied and latest[key][0] == i, previous_statuses.get(key)))
+    return outcomes
+
+def _citation_change_key(citation_change, deleted):
+    return ('DELETED' if deleted else 'UPDATED', citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
+
+def _citation_change_outcome(app, citation_change, deleted=False):
+    """
+    Outcome of a citation change already applied by the citation change
+    batch in progress (if any), otherwise apply it on its own
+    """
+    outcomes = getattr(_citation_change_batch, 'outcomes', None)
+    if outcomes is not None:
+        outcome = outcomes.pop(_citation_change_key(citation_change, deleted), None)
+        if outcome is not None:
+            return outcome
+    if deleted:
+        return mark_citations_as_deleted(app, [citation_change])[0]
+    return update_citations(app, [citation_change])[0]
+
+@contextlib.contextmanager
+def citation_change_batch(app, updated_citation_changes=(), deleted_citation_changes=()):
+    """
+    Apply a batch of updated and deleted citation changes with set-based
+    statements (see update_citations and mark_citations_as_deleted) at the
+    beginning of the block. Within it, update_citation and
+    mark_citation_as_deleted (called by the current thread) return the
+    outcome already computed for these changes instead of updating the
+    citations one by one.
+
+    It is meant to be used within a unit of work, so that the whole batch is
+    rolled back if the processing of one of its changes fails.
+    """
+    if getattr(_citation_change_batch, 'outcomes', None) is not None:
+        raise Exception("Citation change batches cannot be nested")
+    outcomes = {}
+    if updated_citation_changes:
+        for citation_change, outcome in zip(updated_citation_changes, update_citations(app, updated_citation_changes)):
+            outcomes.setdefault(_citation_change_key(citation_change, deleted=False), outcome)
+    if deleted_citation_changes:
+        for citation_change, outcome in zip(deleted_citation_changes, mark_citations_as_deleted(app, deleted_citation_changes)):
+            outcomes.setdefault(_citation_change_key(citation_change, deleted=True), outcome)
+    _citation_change_batch.outcomes = outcomes
+    try:
+        yield outcomes
+    finally:
+        _citation_change_batch.outcomes = None
 
 def mark_reader_as_deleted(app, reader_change):
     """
@@ -550,7 +1447,7 @@ def mark_reader_as_deleted(app, reader_change):
     """
     marked_as_deleted = False
     previous_status = None
-    with app.session_scope() as session:
+    with _session_scope(app, savepoint=True) as session:
         reader = session.query(Reader).with_for_update().filter_by(bibcode=reader_change['bibcode'], reader=reader_change['reader']).first()
         previous_status = reader.status
         change_timestamp = reader_change['timestamp']#.ToDatetime().replace(tzinfo=tzutc()) # Consider it as UTC to be able to compare it
@@ -558,6 +1455,8 @@ def mark_reader_as_deleted(app, reader_change):
             reader.status = "DELETED"
             reader.timestamp = reader_change['timestamp']
             session.add(reader)
+            session.flush()
+            _refresh_read_counts_session(session, _get_citation_target_contents_by_bibcode_session(session, [reader.bibcode]))
             session.commit()
             marked_as_deleted = True
             logger.info("Marked reader as deleted (citing '%s', content '%s')", reader_change['bibcode'], reader_change['reader'])#, reader_change.timestamp.ToJsonString())
@@ -568,44 +1467,193 @@ def mark_reader_as_deleted(app, reader_change):
 def mark_all_discarded_citations_as_registered(app, content):
     """
     Update status to REGISTERED for all discarded citations of a given content
+    (single set-based statement)
+    """
+    with _session_scope(app, savepoint=True) as session:
+        table = Citation.__table__
+        statement = table.update() \
+                .where(table.c.content == content) \
+                .where(table.c.status == 'DISCARDED') \
+                .values(status='REGISTERED', updated=get_date()) \
+                .returning(table.c.id)
+        citation_ids = [citation_id for citation_id, in session.execute(statement)]
+        _record_history_session(session, Citation, Citation.id, citation_ids, operation_type=1)
+        _adjust_citation_counts_session(session, [content]*len(citation_ids))
+        session.commit()
+    logger.info("Marked %i discarded citations of '%s' as registered", len(citation_ids), content)
+
+def populate_bibcode_column(app, chunk_size=None):
     """
-    marked_as_registered = False
-    previous_status = None
-    with app.session_scope() as session:
-        citations = session.query(Citation).with_for_update().filter_by(status='DISCARDED', content=content).all()
-        for citation in citations:
-            citation.status = 'REGISTERED'
-            session.add(citation)
+    Populates the bibcode column of all the citation targets using their
+    parsed (and curated) metadata.
+
+    Citation targets are streamed by primary key in chunks (see
+    POPULATE_BIBCODE_CHUNK_SIZE) and the bibcodes of each chunk are updated
+    with a single statement in its own transaction. The last processed
+    primary key is recorded after every chunk (see MaintenanceProgress), thus
+    the job resumes from there if it is interrupted, even from another
+    worker (the progress record is removed once the job is completed).
+
+    :return: tuple with the number of processed and updated citation targets
+    """
+    if chunk_size is None:
+        chunk_size = app.conf.get('POPULATE_BIBCODE_CHUNK_SIZE', 1000)
+    state = _get_maintenance_progress(app, 'populate_bibcode_column')
+    if state:
+        logger.info("Resuming bibcode column population after '%s' (%i citation targets already processed)", state['last_content'], state['rows'])
+    else:
+        state = {'last_content': None, 'rows': 0, 'updated': 0}
+    start = time.time()
+    n_rows = 0
+    while True:
+        last_content, n_chunk_rows, n_chunk_updated = _populate_bibcode_column_chunk(app, state['last_content'], chunk_size)
+        if n_chunk_rows == 0:
+            break
+        n_rows += n_chunk_rows
+        state = {'last_content': last_content, 'rows': state['rows'] + n_chunk_rows, 'updated': state['updated'] + n_chunk_updated}
+        _set_maintenance_progress(app, 'populate_bibcode_column', state)
+        elapsed = time.time() - start
+        logger.info("Populated bibcode column: %i citation targets processed (%i updated) at %.1f rows/s", state['rows'], state['updated'], n_rows / elapsed if elapsed > 0 else 0.)
+    _clear_maintenance_progress(app, 'populate_bibcode_column')
+    logger.info("Completed bibcode column population: %i citation targets processed (%i updated)", state['rows'], state['updated'])
+    return state['rows'], state['updated']
+
+def _get_maintenance_progress(app, job):
+    """
+    Return the progress recorded by an interrupted maintenance job (last
+    processed primary key and number of processed and updated rows) or None
+    """
+    with _session_scope(app) as session:
+        progress = session.query(MaintenanceProgress).get(job)
+        if progress is None:
+            return None
+        return {'last_content': progress.last_content, 'rows': progress.rows, 'updated': progress.updated_rows}
+
+def _set_maintenance_progress(app, job, state):
+    with _session_scope(app, savepoint=True) as session:
+        table = MaintenanceProgress.__table__
+        statement = pg_insert(table).values(job=job, last_content=state['last_content'], rows=state['rows'], updated_rows=state['updated'], updated=get_date())
+        statement = statement.on_conflict_do_update(index_elements=['job'],
+                                                    set_={'last_content': statement.excluded.last_content,
+                                                          'rows': statement.excluded.rows,
+                                                          'updated_rows': statement.excluded.updated_rows,
+                                                          'updated': statement.excluded.updated})
+        session.execute(statement)
         session.commit()
 
-def populate_bibcode_column(main_session):
-    """
-    Pulls all citation targets from DB and populates the bibcode column using parsed metadata
-    """
-    logger.debug("Collecting Citation Targets")
-    records = _get_citation_targets_session(main_session, only_status = None)
-    for record in records:
-        content = record.get('content', None)
-        bibcode = record.get('bibcode', None)
-        associated = record.get('associate_works', {})
-        logger.debug("Collecting metadata for {}".format(record.get('content')))
-        citation_in_db = False
-        metadata = {}
-        metadata = _get_citation_target_metadata_session(main_session, content, citation_in_db, metadata, curate=False)
-        if metadata:
-            logger.debug("Populating Bibcode field for {}".format(record.get('content')))
-            raw_metadata = metadata.get('raw', {})
-            parsed_metadata = metadata.get('parsed', {})
-            curated_metadata = metadata.get('curated',{})
-            modified_metadata = generate_modified_metadata(parsed_metadata, curated_metadata)
-            status = metadata.get('status', None)
-            #Allows for the column to be repopulated even if curated_metadata exists.
-            if curated_metadata:
-                zenodo_bibstem = "zndo"
-                bibcode = doi.build_bibcode(modified_metadata, doi.zenodo_doi_re, zenodo_bibstem)
-                bibcode = parsed_metadata['bibcode'][:4] + bibcode[4:]
-            else:
-                bibcode = parsed_metadata.get('bibcode',None)
+def _clear_maintenance_progress(app, job):
+    with _session_scope(app, savepoint=True) as session:
+        session.query(MaintenanceProgress).filter(MaintenanceProgress.job == job).delete(synchronize_session=False)
+        session.commit()
+
+def _populate_bibcode_column_chunk(app, last_content, chunk_size):
+    """
+    Populates the bibcode column of the next chunk of citation targets
+    (ordered by primary key, after last_content)
+
+    :return: tuple with the last processed primary key and the number of
+        processed and updated citation targets
+    """
+    with _session_scope(app, savepoint=True) as session:
+        query = session.query(CitationTarget.content, CitationTarget.parsed_cited_metadata, CitationTarget.curated_metadata)
+        if last_content is not None:
+            query = query.filter(CitationTarget.content > last_content)
+        records = query.order_by(CitationTarget.content).limit(chunk_size).all()
+        if not records:
+            return last_content, 0, 0
+        bibcodes = [(record.content, _canonical_bibcode(record.parsed_cited_metadata or {}, record.curated_metadata or {})) for record in records]
+        table = CitationTarget.__table__
+        changes = select([
+            func.unnest(_text_array(content for content, bibcode in bibcodes)).label('content'),
+            func.unnest(_text_array(bibcode for content, bibcode in bibcodes)).label('bibcode'),
+        ]).alias('populated_bibcode')
+        statement = table.update() \
+                .where(table.c.content == changes.c.content) \
+                .where(table.c.bibcode.is_distinct_from(changes.c.bibcode)) \
+                .values(bibcode=changes.c.bibcode, updated=get_date()) \
+                .returning(table.c.content)
+        updated_contents = [content for content, in session.execute(statement)]
+        _record_history_session(session, CitationTarget, CitationTarget.content, updated_contents, operation_type=1)
+        _refresh_read_counts_session(session, updated_contents)
+        session.commit()
+    return records[-1].content, len(records), len(updated_contents)
+
+def _canonical_bibcode(parsed_metadata, curated_metadata):
+    """
+    Bibcode of a citation target: the one built from the curated metadata
+    (respecting the year of the parsed bibcode) if there is curated
+    metadata, otherwise the parsed one
+    """
+    if curated_metadata:
+        modified_metadata = generate_modified_metadata(parsed_metadata, curated_metadata)
+        zenodo_bibstem = "zndo"
+        bibcode = doi.build_bibcode(modified_metadata, doi.zenodo_doi_re, zenodo_bibstem)
+        return parsed_metadata['bibcode'][:4] + bibcode[4:]
+    return parsed_metadata.get('bibcode', None)
+
+def prune_history(app, keep_days=None):
+    """
+    Prune and compact the version tables (SQLAlchemy-Continuum history) of
+    citations and citation targets:
+
+    - Versions identical to the previous version of the same row (e.g., only
+      the update date changed) are removed
+    - If keep_days is provided, versions that stopped being current more than
+      keep_days ago are removed (the first version of every row is always
+      kept, it is used for the publication date of concept DOIs)
+    - The validity ranges of the remaining versions are re-linked and the
+      transaction records that are no longer referenced are removed
+
+    :return: dictionary with the number of removed version rows per table
+    """
+    removed = {}
+    transaction_table = versioning_manager.transaction_cls.__table__
+    with app.session_scope() as session:
+        version_tables = []
+        for model, key_column in ((CitationTarget, CitationTarget.content), (Citation, Citation.id)):
+            version_table = version_class(model).__table__
+            version_tables.append(version_table)
+            removed[version_table.name] = _compact_version_table_session(session, version_table, key_column.name)
+            if keep_days is not None:
+                cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=keep_days)
+                expired_transaction_ids = select([transaction_table.c.id]).where(transaction_table.c.issued_at < cutoff)
+                removed[version_table.name] += session.execute(version_table.delete()
+                                                               .where(version_table.c.operation_type != 0)
+                                                               .where(version_table.c.end_transaction_id.in_(expired_transaction_ids))).rowcount
+            if removed[version_table.name]:
+                _relink_version_table_session(session, version_table, key_column.name)
+        unreferenced = [~exists().where(or_(version_table.c.transaction_id == transaction_table.c.id, version_table.c.end_transaction_id == transaction_table.c.id))
+                        for version_table in version_tables]
+        removed[transaction_table.name] = session.execute(transaction_table.delete().where(and_(*unreferenced))).rowcount
+        session.commit()
+    logger.info("Pruned history: %s", ", ".join("{} rows removed from '{}'".format(n_removed, table_name) for table_name, n_removed in removed.items()))
+    return removed
 
-            _update_citation_target_metadata_session(main_session, content, raw_metadata, parsed_metadata, curated_metadata, status, bibcode, associated)
+def _compact_version_table_session(session, version_table, key_name):
+    """
+    Remove the versions that are identical to the previous version of the
+    same row (the update date and the operation type are not compared)
+    """
+    ignored_columns = (key_name, 'transaction_id', 'end_transaction_id', 'operation_type', 'updated')
+    ordering = {'partition_by': version_table.c[key_name], 'order_by': version_table.c.transaction_id}
+    identical = and_(*[func.lag(column).over(**ordering).isnot_distinct_from(column)
+                       for column in version_table.columns if column.name not in ignored_columns])
+    ranked = select([version_table.c[key_name].label('key'), version_table.c.transaction_id,
+                     func.lag(version_table.c.transaction_id).over(**ordering).label('previous_transaction_id'),
+                     identical.label('identical')]).alias('ranked')
+    redundant = select([ranked.c.key, ranked.c.transaction_id]).where(ranked.c.previous_transaction_id.isnot(None)).where(ranked.c.identical)
+    return session.execute(version_table.delete().where(tuple_(version_table.c[key_name], version_table.c.transaction_id).in_(redundant))).rowcount
 
+def _relink_version_table_session(session, version_table, key_name):
+    """
+    Make every version valid until the next remaining version of the same
+    row (validity strategy), after versions have been removed
+    """
+    ordering = {'partition_by': version_table.c[key_name], 'order_by': version_table.c.transaction_id}
+    linked = select([version_table.c[key_name].label('key'), version_table.c.transaction_id,
+                     func.lead(version_table.c.transaction_id).over(**ordering).label('next_transaction_id')]).alias('linked')
+    session.execute(version_table.update()
+                    .where(version_table.c[key_name] == linked.c.key)
+                    .where(version_table.c.transaction_id == linked.c.transaction_id)
+                    .where(version_table.c.end_transaction_id.is_distinct_from(linked.c.next_transaction_id))
+                    .values(end_transaction_id=linked.c.next_transaction_id))
@@ -1,4 +1,5 @@
 import os
+import itertools
 from datetime import datetime
 import postgres_copy
 from sqlalchemy.orm import sessionmaker
@@ -53,6 +54,7 @@ class DeltaComputation():
         self.input_refids_filename = None
         self.group_changes_in_chunks_of=group_changes_in_chunks_of
         self.offset = 0
+        self.citation_changes_stream = None
         self.n_changes = 0
         self.force = force
         self.last_modification_date = None
@@ -65,6 +67,7 @@ class DeltaComputation():
         :param input_refids_filename: Path to the file to be imported.
         """
         self.offset = 0
+        self.citation_changes_stream = None
         self.input_refids_filename = input_refids_filename
         self._setup_schemas()
         if self.force or self.joint_table_name not in Inspector.from_engine(self.engine).get_table_names(schema=self.schema_name):
@@ -108,13 +111,25 @@ class DeltaComputation():
         return self
 
     def __next__(self): # Python 3: def __next__(self)
-        """Iterates over the results, grouping changes in chunks"""
+        """
+        Iterates over the results, grouping changes in chunks.
+
+        Citation changes are streamed from a single server-side cursor opened
+        on the first iteration, instead of re-issuing an OFFSET/LIMIT query
+        per chunk (which forces the DB to scan and discard all the previous
+        rows). Rows are returned in the same order as the full table scan.
+        """
         if self.offset >= self.n_changes or self.n_changes == 0:
             raise StopIteration
         else:
+            if self.citation_changes_stream is None:
+                # yield_per enables stream_results (psycopg2 named cursor),
+                # the cursor must survive until the last chunk is consumed so
+                # no commit is issued in between
+                self.citation_changes_stream = iter(self._citation_changes_query().yield_per(max(self.group_changes_in_chunks_of, 100)))
             citation_changes = adsmsg.CitationChanges()
             # Get citation changes from DB
-            for instance in self._citation_changes_query().offset(self.offset).limit(self.group_changes_in_chunks_of).yield_per(100):
+            for instance in itertools.islice(self.citation_changes_stream, self.group_changes_in_chunks_of):
                 ## Build protobuf message
                 citation_change = citation_changes.changes.add()
                 # Use new_ or previous_ fields depending if status is NEW/UPDATED or DELETED
@@ -133,11 +148,20 @@ class DeltaComputation():
                 citation_change.resolved = getattr(instance, prefix+"resolved")
                 citation_change.timestamp.FromDatetime(self.last_modification_date)
                 citation_change.status = getattr(adsmsg.Status, instance.status.lower())
-            self.session.commit()
 
             self.offset += self.group_changes_in_chunks_of
+            if self.offset >= self.n_changes or len(citation_changes.changes) == 0:
+                # Last chunk: release the server-side cursor
+                self._close_citation_changes_stream()
+                if len(citation_changes.changes) == 0:
+                    raise StopIteration
             return citation_changes
 
+    def _close_citation_changes_stream(self):
+        """Discard the server-side cursor (if any) and end its transaction"""
+        self.citation_changes_stream = None
+        self.session.commit()
+
     def _setup_schemas(self):
         """
         Create new schema, identify previous and drop older ones.
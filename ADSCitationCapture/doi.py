@@ -1,10 +1,15 @@
 import os
 from dateutil.parser import parse
-import requests
+import ADSCitationCapture.http_client as http_client
 import re
 import json
 import base64
+import copy
+import hashlib
+import time
+import concurrent.futures
 from pyingest.parsers.datacite import DataCiteParser
+from ADSCitationCapture import cache
 # ============================= INITIALIZATION ==================================== #
 # - Use app logger:
 #import logging
@@ -20,17 +25,24 @@ logger = setup_logging(__name__, proj_home=proj_home,
 dc = DataCiteParser()
 zenodo_doi_re = re.compile(r"^10.\d{4,9}/zenodo\.([0-9]*)$", re.IGNORECASE)
 upper_case_az_character_re = re.compile("[A-Z]")
+# Raw DOI metadata shared by all the workers of the host (None if disabled)
+raw_metadata_cache = cache.RawContentCache(config['DOI_METADATA_CACHE_DIR']) if config.get('DOI_METADATA_CACHE_DIR') else None
+# Parsed metadata for the most recent raw metadata (keyed by raw_metadata_hash)
+parsed_metadata_cache = cache.LRUCache('parsed_metadata', maxsize=config.get('PARSED_METADATA_CACHE_SIZE', 1000))
 
 
 # =============================== FUNCTIONS ======================================= #
-def _fetch_metadata(url, headers={}, timeout=30):
+def _fetch_metadata(url, headers={}, timeout=30, limiter=None):
     """
-    Fetches DOI metadata
+    Fetches DOI metadata, it also returns the HTTP validators of the answer
+    (ETag/Last-Modified) and if the server answered 'not modified' to a
+    conditional request
     """
     record_found = False
     try_later = False
+    validators = {'etag': None, 'last_modified': None, 'not_modified': False}
     try:
-        r = requests.get(url, headers=headers, timeout=timeout)
+        r = http_client.get(url, headers=headers, timeout=timeout, limiter=limiter)
     except:
         logger.exception("HTTP request failed: %s", url)
         try_later = True
@@ -47,11 +59,14 @@ def _fetch_metadata(url, headers={}, timeout=30):
             logger.error("HTTP request with error code '%s' for: %s", r.status_code, url)
         else:
             record_found = True
+            validators['etag'] = r.headers.get('ETag')
+            validators['last_modified'] = r.headers.get('Last-Modified')
+            validators['not_modified'] = r.status_code == 304
 
     content = None
-    if not try_later and record_found:
+    if not try_later and record_found and not validators['not_modified']:
         content = r.text
-    return try_later, record_found, content
+    return try_later, record_found, content, validators
 
 def _decode_datacite_content(alt_content):
     """
@@ -74,10 +89,14 @@ def _decode_datacite_content(alt_content):
                 pass
     return decoded_alt_content
 
-def fetch_metadata(base_doi_url, base_datacite_url, doi):
+def fetch_metadata(base_doi_url, base_datacite_url, doi, limiter=None, max_age=None):
     """
     Fetches DOI metadata in datacite format from doi.org or, alternatively,
     api.datacite.org if the former fails
+
+    If the raw metadata cache is enabled, entries fetched less than 'max_age'
+    seconds ago (DOI_METADATA_CACHE_TTL by default) are served locally and
+    older entries are revalidated with a conditional request to doi.org.
     """
     headers = {}
     ## https://support.datacite.org/docs/datacite-content-resolver
@@ -86,28 +105,84 @@ def fetch_metadata(base_doi_url, base_datacite_url, doi):
     #headers["Accept"] = "application/vnd.crossref.unixref+xml;q=1" # This format does not contain software type tag
     headers["Accept"] = "application/vnd.datacite.datacite+xml;q=1"
     doi_endpoint = base_doi_url + doi
-    try_later, record_found, content = _fetch_metadata(doi_endpoint, headers=headers, timeout=30)
+    cached = raw_metadata_cache.get(doi) if raw_metadata_cache is not None else None
+    if cached is not None:
+        if max_age is None:
+            max_age = config.get('DOI_METADATA_CACHE_TTL', 24*60*60)
+        if time.time() - cached['fetched_at'] < max_age:
+            raw_metadata_cache.record(hit=True, saved_bytes=cached['size'])
+            return cached['content']
+        if cached.get('etag'):
+            headers["If-None-Match"] = cached['etag']
+        if cached.get('last_modified'):
+            headers["If-Modified-Since"] = cached['last_modified']
+    try_later, record_found, content, validators = _fetch_metadata(doi_endpoint, headers=headers, timeout=30, limiter=limiter)
+    if cached is not None and validators['not_modified']:
+        raw_metadata_cache.touch(doi, cached)
+        raw_metadata_cache.record(revalidation=True, saved_bytes=cached['size'])
+        return cached['content']
 
     if try_later or not record_found or "<version/>" in content: # TODO: Temporary doi.org/crossref bug where version is not provided
         # Alternative source for metadata
         alt_doi_endpoint = base_datacite_url + doi
         alt_headers = {}
-        alt_try_later, alt_record_found, alt_content = _fetch_metadata(alt_doi_endpoint, headers=alt_headers, timeout=30)
+        alt_try_later, alt_record_found, alt_content, _ = _fetch_metadata(alt_doi_endpoint, headers=alt_headers, timeout=30, limiter=limiter)
         if not alt_try_later and alt_record_found:
             decoded_alt_content = _decode_datacite_content(alt_content)
             if decoded_alt_content:
                 try_later = False
                 record_found = True
                 content = decoded_alt_content
+                # The validators from doi.org do not correspond to this content
+                validators = {'etag': None, 'last_modified': None}
 
     if try_later:
         # Exceptions make the task to fail, and the framework will re-try automatically later on
         logger.error("HTTP request to DOI service failed: %s", doi_endpoint)
         raise Exception("HTTP request to DOI service failed: {}".format(doi_endpoint))
 
+    if raw_metadata_cache is not None and record_found:
+        raw_metadata_cache.record()
+        raw_metadata_cache.set(doi, content, etag=validators['etag'], last_modified=validators['last_modified'])
     return content if record_found else None
 
 
+def fetch_metadata_many(base_doi_url, base_datacite_url, dois, max_workers=None, max_per_host=None, max_age=None):
+    """
+    Fetches the metadata of multiple DOIs concurrently (see fetch_metadata),
+    generating tuples (doi, raw_metadata) as soon as each one is completed.
+
+    No more than 'max_per_host' requests are sent at the same time to the
+    same host (doi.org or api.datacite.org). If some DOIs could not be
+    fetched, the first exception is raised after all the other results have
+    been generated. See fetch_metadata for 'max_age'.
+    """
+    if max_workers is None:
+        max_workers = config.get('DOI_FETCH_CONCURRENCY', 16)
+    if max_per_host is None:
+        max_per_host = config.get('DOI_FETCH_CONCURRENCY_PER_HOST', 8)
+    limiter = http_client.HostLimiter(max_per_host)
+    failure = None
+    futures = {}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {executor.submit(fetch_metadata, base_doi_url, base_datacite_url, doi, limiter=limiter, max_age=max_age): doi for doi in dois}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                raw_metadata = future.result()
+            except Exception as e:
+                if failure is None:
+                    failure = e
+            else:
+                yield futures[future], raw_metadata
+    finally:
+        # Do not fetch anything else if the consumer stopped before the end
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+    if failure is not None:
+        raise failure
+
 def build_bibcode(metadata, doi_re, bibstem):
     """
     Builds a bibcode based on the parsed metadata received from datacite. The
@@ -165,14 +240,36 @@ def build_bibcode(metadata, doi_re, bibstem):
     bibcode = year + bibstem + doi_id + first_author_last_name_initial
     return bibcode
 
+def raw_metadata_hash(raw_metadata):
+    """
+    Hash of the raw metadata (same as PostgreSQL md5 function) or None if
+    there is no raw metadata
+    """
+    if raw_metadata is None:
+        return None
+    if type(raw_metadata) is not bytes:
+        raw_metadata = raw_metadata.encode('utf-8')
+    return hashlib.md5(raw_metadata).hexdigest()
+
 def parse_metadata(raw_metadata):
     """
     It expects metadata in datacite format [string] and returns the parsed
     metadata [dict] unless it does not correspond to a recongised source
     (only zenodo right now) or it is not a software record, in which case a
     None value is returned.
+
+    Results are memoized by the hash of the raw metadata, callers get their
+    own copy so they can modify it.
     """
-    return _parse_metadata_zenodo_doi(raw_metadata)
+    key = raw_metadata_hash(raw_metadata)
+    if key is not None:
+        found, parsed_metadata = parsed_metadata_cache.get(key)
+        if found:
+            return copy.deepcopy(parsed_metadata)
+    parsed_metadata = _parse_metadata_zenodo_doi(raw_metadata)
+    if key is not None and parsed_metadata:
+        parsed_metadata_cache.set(key, copy.deepcopy(parsed_metadata))
+    return parsed_metadata
 
 def renormalize_author_names(authors):
     """
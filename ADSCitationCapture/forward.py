@@ -22,7 +22,12 @@ logger = setup_logging(__name__, proj_home=proj_home,
 
 
 # =============================== FUNCTIONS ======================================= #
-def build_record(app, citation_change, parsed_metadata, citations, db_versions, readers=[], entry_date=None):
+def build_record(app, citation_change, parsed_metadata, citations, db_versions, readers=[], entry_date=None, citation_count=None):
+    """
+    Build the bib and nonbib records of a citation target. If citation_count
+    is given (e.g., from the citation target aggregates), it is used instead
+    of the number of elements of citations.
+    """
     if citation_change.content_type != CitationChangeContentType.doi:
         raise ValueError("Only DOI records can be forwarded to master")
     # Extract required values
@@ -75,7 +80,7 @@ def build_record(app, citation_change, parsed_metadata, citations, db_versions,
     # Count
     n_keywords = len(keywords)
     n_authors = len(authors)
-    n_citations = len(citations)
+    n_citations = len(citations) if citation_count is None else citation_count
     doi = citation_change.content
     record_dict = {
         'abstract': abstract,
@@ -0,0 +1,208 @@
+import os
+import time
+import random
+import threading
+import email.utils
+import http.cookiejar
+import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+# ============================= INITIALIZATION ==================================== #
+# - Use app logger:
+#import logging
+#logger = logging.getLogger('ads-citation-capture')
+# - Or individual logger for this file:
+from adsputils import setup_logging, load_config
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+config = load_config(proj_home=proj_home)
+logger = setup_logging(__name__, proj_home=proj_home,
+                        level=config.get('LOGGING_LEVEL', 'INFO'),
+                        attach_stdout=config.get('LOG_STDOUT', False))
+
+# Status codes that are worth re-trying (the server may answer later on)
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+# Methods that can be sent again without side effects if the server may have
+# received them (other requests are only re-tried if they could not be sent)
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_latencies = {}
+_latencies_lock = threading.Lock()
+
+
+# =============================== CLASSES ========================================= #
+class HostLimiter():
+    """
+    Limit the number of requests executed concurrently against the same host
+    (e.g., by the threads of a batch fetcher)
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def semaphore(self, url):
+        host = urllib.parse.urlparse(url).hostname
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return self._semaphores[host]
+
+
+# =============================== FUNCTIONS ======================================= #
+def get_session():
+    """
+    Return the HTTP session of the current worker process. Connections are
+    kept alive and pooled per host, a new session is created after a fork
+    so that connections are never shared between processes.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=config.get('HTTP_POOL_CONNECTIONS', 10),
+                                  pool_maxsize=config.get('HTTP_POOL_MAXSIZE', 10))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            # Same behaviour as bare requests calls: cookies are not kept between calls
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+def close_session():
+    """
+    Close the pooled connections of the current worker process
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _session_pid = None
+
+def _retry_after(response):
+    """
+    Seconds requested by the server via the Retry-After header (None if the
+    header is not present or it cannot be parsed)
+    """
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_date is None:
+        return None
+    return max(0., retry_date.timestamp() - time.time())
+
+def _backoff(attempt, response=None):
+    """
+    Seconds to wait before the next attempt: exponential backoff with full
+    jitter, unless the server asked for a specific delay (Retry-After)
+    """
+    backoff_max = config.get('HTTP_BACKOFF_MAX', 30)
+    retry_after = _retry_after(response)
+    if retry_after is not None:
+        return min(retry_after, backoff_max)
+    return random.uniform(0, min(backoff_max, config.get('HTTP_BACKOFF_FACTOR', 0.5) * (2 ** attempt)))
+
+def _record_latency(endpoint, elapsed, failed):
+    with _latencies_lock:
+        stats = _latencies.setdefault(endpoint, {'requests': 0, 'errors': 0, 'total_seconds': 0., 'max_seconds': 0.})
+        stats['requests'] += 1
+        stats['total_seconds'] += elapsed
+        stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+        if failed:
+            stats['errors'] += 1
+
+def latency_stats():
+    """
+    Return per-endpoint latency metrics of the current worker process
+    """
+    with _latencies_lock:
+        latencies = {}
+        for endpoint, stats in _latencies.items():
+            latencies[endpoint] = dict(stats)
+            latencies[endpoint]['mean_seconds'] = stats['total_seconds'] / stats['requests'] if stats['requests'] else 0.
+        return latencies
+
+def reset_latency_stats():
+    with _latencies_lock:
+        _latencies.clear()
+
+def _not_sent(exception):
+    """
+    Did the request fail before reaching the server (no connection could be
+    established)?
+    """
+    if isinstance(exception, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(exception.args[0], 'reason', None) if exception.args else None
+    return isinstance(reason, NewConnectionError)
+
+def request(method, url, endpoint=None, retries=None, timeout=None, limiter=None, idempotent=None, **kwargs):
+    """
+    Execute an HTTP request using the pooled session of the worker.
+
+    Connection errors, timeouts and answers with a status code in
+    RETRY_STATUS_CODES are re-tried up to 'retries' times (HTTP_RETRIES by
+    default). If all the attempts fail, the last exception is raised or the
+    last response is returned (callers keep checking 'response.ok').
+    Requests that are not idempotent are only re-tried if the connection
+    could not be established, so that the server never receives them twice.
+
+    :param endpoint: Name used for the latency metrics (hostname by default).
+    :param limiter: Optional HostLimiter (waiting for the backoff does not
+        count towards the limit).
+    :param idempotent: Whether the request can be sent again safely (by
+        default, only if the method is in IDEMPOTENT_METHODS).
+    """
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+    if retries is None:
+        retries = config.get('HTTP_RETRIES', 3)
+    if timeout is None:
+        timeout = config.get('HTTP_TIMEOUT', 30)
+    if endpoint is None:
+        endpoint = urllib.parse.urlparse(url).hostname
+    session = get_session()
+    attempt = 0
+    while True:
+        response = None
+        try:
+            if limiter is None:
+                start = time.time()
+                response = session.request(method, url, timeout=timeout, **kwargs)
+            else:
+                with limiter.semaphore(url):
+                    start = time.time()
+                    response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            _record_latency(endpoint, time.time() - start, True)
+            if attempt >= retries or not (idempotent or _not_sent(e)):
+                raise
+            logger.info("Retrying HTTP request (attempt %i/%i) after connection failure: %s", attempt+1, retries, url)
+        else:
+            _record_latency(endpoint, time.time() - start, not response.ok)
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= retries or not idempotent:
+                return response
+            logger.info("Retrying HTTP request (attempt %i/%i) after error code '%s': %s", attempt+1, retries, response.status_code, url)
+        time.sleep(_backoff(attempt, response))
+        attempt += 1
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
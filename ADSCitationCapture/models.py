@@ -1,13 +1,36 @@
-from sqlalchemy import Column, Boolean, DateTime, String, Text, Integer, func, UniqueConstraint, ForeignKey
+from sqlalchemy import Column, Boolean, DateTime, String, Text, Integer, func, UniqueConstraint, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy import orm
 from sqlalchemy.dialects.postgresql import ENUM, JSON, JSONB
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy_continuum import make_versioned
+from sqlalchemy_continuum import make_versioned, VersioningManager
+from sqlalchemy_continuum.unit_of_work import UnitOfWork
+from sqlalchemy_continuum.operation import Operations
 from adsputils import UTCDateTime, get_date
 
+
+class HistoryModeUnitOfWork(UnitOfWork):
+    """
+    SQLAlchemy-Continuum unit of work that only versions the flushes of the
+    sessions in 'orm' history mode (see db.history_mode), the rest of sessions
+    record their history on their own or not at all
+    """
+
+    def process_before_flush(self, session):
+        if session.info.get('history_mode', 'orm') == 'orm':
+            UnitOfWork.process_before_flush(self, session)
+
+    def process_after_flush(self, session):
+        if session.info.get('history_mode', 'orm') == 'orm':
+            UnitOfWork.process_after_flush(self, session)
+        else:
+            # Do not version the operations of this flush later on
+            self.operations = Operations()
+
+versioning_manager = VersioningManager(unit_of_work_cls=HistoryModeUnitOfWork)
+
 # Must be called before defining all the models
-make_versioned(user_cls=None)
+make_versioned(user_cls=None, manager=versioning_manager)
 
 Base = declarative_base()
 
@@ -101,6 +124,7 @@ class CitationTarget(Base):
     content_type = Column(citation_content_type)
     bibcode = Column(Text())
     raw_cited_metadata = Column(Text())
+    raw_cited_metadata_hash = Column(String(32))    # md5 of raw_cited_metadata, to detect unchanged metadata cheaply
     parsed_cited_metadata = Column(JSONB)
     curated_metadata = Column(JSONB)
     status = Column(target_status_type)
@@ -109,6 +133,64 @@ class CitationTarget(Base):
     updated = Column(UTCDateTime, onupdate=get_date)
     citations = relationship("Citation", primaryjoin="CitationTarget.content==Citation.content")
 
+class CitationTargetAlternateBibcode(Base):
+    __tablename__ = 'citation_target_alternate_bibcode'
+    __table_args__ = ({"schema": "public"})
+    # Copy of citation_target.parsed_cited_metadata['alternate_bibcode'] (kept
+    # in sync by the db module) so that alternate bibcodes are resolved with an index
+    alternate_bibcode = Column(Text(), primary_key=True)
+    content = Column(Text(), ForeignKey('public.citation_target.content', ondelete='CASCADE'), primary_key=True, index=True)
+
+class NonbibExportTarget(Base):
+    __tablename__ = 'nonbib_export_target'
+    __table_args__ = ({"schema": "public"})
+    # Bibcode with which each citation target was last written to the DataPipeline
+    # files, so that incremental exports can remove the lines of replaced bibcodes
+    content = Column(Text(), primary_key=True)
+    bibcode = Column(Text())
+
+class NonbibExportState(Base):
+    __tablename__ = 'nonbib_export_state'
+    __table_args__ = ({"schema": "public"})
+    # Sequence number and watermark of the last incremental export of the
+    # DataPipeline files (a single row, updated in the same transaction as
+    # nonbib_export_target)
+    id = Column(Integer, primary_key=True)
+    sequence = Column(Integer, nullable=False)
+    watermark = Column(UTCDateTime, nullable=False)
+    deltas_since_snapshot = Column(Integer, nullable=False, default=0, server_default='0')
+
+class MaintenanceProgress(Base):
+    __tablename__ = 'maintenance_progress'
+    __table_args__ = ({"schema": "public"})
+    # Progress of the maintenance jobs that resume where they were interrupted
+    # (e.g., the bibcode column population), removed once a job is completed
+    job = Column(Text(), primary_key=True)
+    last_content = Column(Text())
+    rows = Column(Integer, nullable=False, default=0, server_default='0')
+    updated_rows = Column(Integer, nullable=False, default=0, server_default='0')
+    updated = Column(UTCDateTime, default=get_date, onupdate=get_date)
+
+class CitationTargetAggregate(Base):
+    __tablename__ = 'citation_target_aggregate'
+    __table_args__ = ({"schema": "public"})
+    # Number of REGISTERED citations and distinct REGISTERED readers of each
+    # citation target (kept up to date incrementally by the db module) so that
+    # counts are read without fetching the citing bibcodes and reader hashes
+    content = Column(Text(), ForeignKey('public.citation_target.content', ondelete='CASCADE'), primary_key=True)
+    citation_count = Column(Integer, nullable=False, default=0, server_default='0')
+    read_count = Column(Integer, nullable=False, default=0, server_default='0')
+    updated = Column(UTCDateTime, default=get_date, onupdate=get_date)
+
+# Used by incremental exports to find the records modified since the last export
+Index('ix_public_citation_modified', func.coalesce(Citation.updated, Citation.created))
+Index('ix_public_citation_target_modified', func.coalesce(CitationTarget.updated, CitationTarget.created))
+# Used by the lookups of citations by target, targets by bibcode and readers
+# by bibcode (see benchmarks/bench_query_plans.py)
+Index('ix_public_citation_content_status', Citation.content, Citation.status)
+Index('ix_public_citation_target_bibcode', CitationTarget.bibcode)
+Index('ix_public_readers_bibcode_status', Reader.bibcode, Reader.status)
+
 class Event(Base):
     __tablename__ = 'event'
     __table_args__ = ({"schema": "public"})
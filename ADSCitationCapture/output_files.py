@@ -0,0 +1,161 @@
+import os
+import json
+import gzip
+import hashlib
+import datetime
+
+# ============================= INITIALIZATION ==================================== #
+# - Use app logger:
+#import logging
+#logger = logging.getLogger('ads-citation-capture')
+# - Or individual logger for this file:
+from adsputils import setup_logging, load_config
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+config = load_config(proj_home=proj_home)
+logger = setup_logging(__name__, proj_home=proj_home,
+                        level=config.get('LOGGING_LEVEL', 'INFO'),
+                        attach_stdout=config.get('LOG_STDOUT', False))
+
+COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+# =============================== CLASSES ========================================= #
+class OutputFile():
+    """
+    Text file that is written to a temporary file and published with an
+    atomic rename, so that readers never see a partially written file.
+
+    Row count and checksum are computed while writing, and an optional
+    compressed sibling (gzip or zstd) is written at the same time.
+    """
+
+    def __init__(self, name, path, compression=None):
+        if compression and compression not in COMPRESSION_EXTENSIONS:
+            raise Exception("Unknown compression '{}' for output file '{}'".format(compression, path))
+        self.name = name
+        self.path = path
+        self.compression = compression
+        self.compressed_path = path + COMPRESSION_EXTENSIONS[compression] if compression else None
+        self.rows = 0
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._compressed_sha256 = hashlib.sha256() if compression else None
+        self._file = None
+        self._compressed_file = None
+        self._compressor = None
+
+    def _tmp_path(self, path):
+        return "{}.{}.tmp".format(path, os.getpid())
+
+    def open(self):
+        self._file = open(self._tmp_path(self.path), 'wb')
+        if self.compression == 'gzip':
+            self._compressed_file = open(self._tmp_path(self.compressed_path), 'wb')
+            # mtime=0 so that identical content produces identical compressed files
+            self._compressor = gzip.GzipFile(filename='', mode='wb', fileobj=_HashingWriter(self._compressed_file, self._compressed_sha256), mtime=0)
+        elif self.compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception("The 'zstandard' package is required to compress output files with zstd")
+            self._compressed_file = open(self._tmp_path(self.compressed_path), 'wb')
+            self._compressor = zstandard.ZstdCompressor().stream_writer(_HashingWriter(self._compressed_file, self._compressed_sha256))
+        return self
+
+    def write(self, text, rows=1):
+        data = text.encode('utf-8')
+        self._file.write(data)
+        self._sha256.update(data)
+        self.size += len(data)
+        self.rows += rows
+        if self._compressor is not None:
+            self._compressor.write(data)
+
+    def close(self):
+        if self._compressor is not None:
+            self._compressor.close()
+            self._compressor = None
+        for f in (self._file, self._compressed_file):
+            if f is not None and not f.closed:
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+
+    def publish(self):
+        """
+        Atomically replace the published file (and its compressed sibling)
+        """
+        self.close()
+        os.replace(self._tmp_path(self.path), self.path)
+        if self.compressed_path:
+            os.replace(self._tmp_path(self.compressed_path), self.compressed_path)
+        logger.info("Published output file '%s' (%i rows)", self.path, self.rows)
+
+    def discard(self):
+        self.close()
+        for path in (self.path, self.compressed_path):
+            if path and os.path.exists(self._tmp_path(path)):
+                os.remove(self._tmp_path(path))
+
+    def manifest_entry(self):
+        entry = {
+            'path': os.path.basename(self.path),
+            'rows': self.rows,
+            'bytes': self.size,
+            'sha256': self._sha256.hexdigest(),
+        }
+        if self.compressed_path:
+            entry['compressed'] = {
+                'path': os.path.basename(self.compressed_path),
+                'compression': self.compression,
+                'sha256': self._compressed_sha256.hexdigest(),
+            }
+        return entry
+
+
+class _HashingWriter():
+    """
+    File-like wrapper that computes the checksum of what is written
+    """
+
+    def __init__(self, f, sha256):
+        self._file = f
+        self._sha256 = sha256
+
+    def write(self, data):
+        self._sha256.update(data)
+        return self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        pass
+
+
+# =============================== FUNCTIONS ======================================= #
+def write_manifest(path, output_files, **extra):
+    """
+    Atomically write a JSON manifest with the row count and checksum of each
+    published output file, so that downstream loaders can validate them
+    (extra keyword arguments are added to the manifest as they are)
+    """
+    manifest = {
+        'created': datetime.datetime.utcnow().isoformat() + 'Z',
+        'files': {output_file.name: output_file.manifest_entry() for output_file in output_files},
+    }
+    manifest.update(extra)
+    write_json(path, manifest)
+    logger.info("Published manifest '%s'", path)
+    return manifest
+
+def write_json(path, data):
+    """
+    Atomically write a JSON file
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
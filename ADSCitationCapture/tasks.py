@@ -1,5 +1,8 @@
 import os
+import sys
+import functools
 from kombu import Queue
+from celery.signals import task_prerun, task_postrun
 from google.protobuf.json_format import MessageToDict
 from datetime import datetime
 import ADSCitationCapture.app as app_module
@@ -29,15 +32,58 @@ app.conf.CELERY_QUEUES = (
     Queue('maintenance_resend', app.exchange, routing_key='maintenance_resend'),
     Queue('maintenance_reevaluate', app.exchange, routing_key='maintenance_reevaluate'),
     Queue('maintenance_associated_works', app.exchange, routing_key='maintenance_associated_works'),
+    Queue('maintenance_history', app.exchange, routing_key='maintenance_history'),
     Queue('output-results', app.exchange, routing_key='output-results'),
 )
 
 #limit github API queries to keep below rate limit
 github_api_limit = app.conf.get('GITHUB_API_LIMIT', '80/m')
 
+def _in_unit_of_work(task_function):
+    """
+    Run the task in a single database unit of work (see db.unit_of_work):
+    one connection checkout and one transaction for all its db calls
+    """
+    @functools.wraps(task_function)
+    def wrapper(*args, **kwargs):
+        with db.unit_of_work(app):
+            return task_function(*args, **kwargs)
+    return wrapper
+
+def _in_maintenance_history_mode(task_function):
+    """
+    Run the task with the history mode for bulk maintenance
+    (HISTORY_MAINTENANCE_MODE, see db.history_mode)
+    """
+    @functools.wraps(task_function)
+    def wrapper(*args, **kwargs):
+        with db.history_mode(app, app.conf.get('HISTORY_MAINTENANCE_MODE', None)):
+            return task_function(*args, **kwargs)
+    return wrapper
+
+@task_prerun.connect
+def _begin_task_reads(**kwargs):
+    """
+    Read-only db helpers use the read replica until the task writes to the
+    primary database (see db._read_session_scope)
+    """
+    db.begin_task_reads()
+
+@task_postrun.connect
+def _end_task_reads(**kwargs):
+    db.end_task_reads()
+
+def _delay_after_commit(task, *args, **kwargs):
+    """
+    Queue a task once the unit of work of the current task (if any) has been
+    committed, so that it never reads uncommitted or rolled back changes
+    """
+    db.after_commit(lambda: task.delay(*args, **kwargs))
+
 # ============================= TASKS ============================================= #
 
 @app.task(queue='process-new-citation')
+@_in_unit_of_work
 def task_process_new_citation(citation_change, force=False):
     """
     Process new citation:
@@ -94,7 +140,7 @@ def task_process_new_citation(citation_change, force=False):
         license_info = {'license_name': "", 'license_url': ""}
         #If link is alive, attempt to get license info from github. Else return empty license.
         if url.is_github(citation_change.content):
-            task_process_github_urls.delay(citation_change, metadata)
+            _delay_after_commit(task_process_github_urls, citation_change, metadata)
         else:
             status = "DISCARDED"
         parsed_metadata = {'link_alive': is_link_alive, 'doctype': 'unknown', 'license_name': license_info.get('license_name', ""), 'license_url': license_info.get('license_url', "") }
@@ -122,7 +168,7 @@ def task_process_new_citation(citation_change, force=False):
                     if event_data:
                         dump_prefix = citation_change.timestamp.ToDatetime().strftime("%Y%m%d_%H%M%S")
                         logger.debug("Calling 'task_emit_event' for '%s' IsIdenticalTo '%s'", citation_change.citing, canonical_citing_bibcode)
-                        task_emit_event.delay(event_data, dump_prefix)
+                        _delay_after_commit(task_emit_event, event_data, dump_prefix)
 
                 citation_target_bibcode = parsed_metadata.get('bibcode')
 
@@ -131,7 +177,7 @@ def task_process_new_citation(citation_change, force=False):
                 if event_data:
                     dump_prefix = citation_change.timestamp.ToDatetime().strftime("%Y%m%d_%H%M%S")
                     logger.debug("Calling 'task_emit_event' for '%s' IsIdenticalTo '%s'", citation_target_bibcode, citation_change.content)
-                    task_emit_event.delay(event_data, dump_prefix)
+                    _delay_after_commit(task_emit_event, event_data, dump_prefix)
 
                 # Get citations from the database and transform the stored bibcodes into their canonical ones as registered in Solr.
                 original_citations = db.get_citations_by_bibcode(app, citation_target_bibcode)
@@ -144,7 +190,7 @@ def task_process_new_citation(citation_change, force=False):
                     citations.append(canonical_citing_bibcode)
 
                 logger.debug("Calling 'task_output_results' with '%s'", citation_change)
-                task_output_results.delay(citation_change, parsed_metadata, citations, associated_version_bibcodes, readers=readers)
+                _delay_after_commit(task_output_results, citation_change, parsed_metadata, citations, associated_version_bibcodes, readers=readers)
             logger.debug("Calling '_emit_citation_change' with '%s'", citation_change)
 
             _emit_citation_change(citation_change, parsed_metadata)
@@ -153,6 +199,7 @@ def task_process_new_citation(citation_change, force=False):
         stored = db.store_citation(app, citation_change, content_type, raw_metadata, parsed_metadata, status)
     
 @app.task(queue='process-github-urls', rate_limit=github_api_limit)
+@_in_unit_of_work
 def task_process_github_urls(citation_change, metadata):
     """
     Process new github urls
@@ -195,6 +242,7 @@ def task_process_github_urls(citation_change, metadata):
         stored = db.store_citation(app, citation_change, content_type, raw_metadata, parsed_metadata, status)
 
 @app.task(queue='process-updated-citation')
+@_in_unit_of_work
 def task_process_updated_citation(citation_change, force=False):
     """
     Update citation record
@@ -215,7 +263,7 @@ def task_process_updated_citation(citation_change, force=False):
             original_citations = db.get_citations_by_bibcode(app, citation_target_bibcode)
             citations = api.get_canonical_bibcodes(app, original_citations)
             logger.debug("Calling 'task_output_results' with '%s'", citation_change)
-            task_output_results.delay(citation_change, parsed_metadata, citations, db_versions=no_self_ref_versions, readers=readers)
+            _delay_after_commit(task_output_results, citation_change, parsed_metadata, citations, db_versions=no_self_ref_versions, readers=readers)
         logger.debug("Calling '_emit_citation_change' with '%s'", citation_change)
         _emit_citation_change(citation_change, parsed_metadata)
 
@@ -256,9 +304,10 @@ def _update_associated_citation_targets(citation_change, parsed_metadata, versio
                                     )
             #update associated works for all versions in db
             logger.info('Calling task process_updated_associated_works')
-            task_process_updated_associated_works.delay(associated_citation_change, associated_version_bibcodes)    
+            _delay_after_commit(task_process_updated_associated_works, associated_citation_change, associated_version_bibcodes)    
 
 @app.task(queue='process-updated-citation')
+@_in_unit_of_work
 def task_process_updated_associated_works(citation_change, associated_versions, force=False):
     """
     Update associated works in citation record
@@ -282,11 +331,12 @@ def task_process_updated_associated_works(citation_change, associated_versions,
                 original_citations = db.get_citations_by_bibcode(app, citation_target_bibcode)
                 citations = api.get_canonical_bibcodes(app, original_citations)
                 logger.debug("Calling 'task_output_results' with '%s'", citation_change)
-                task_output_results.delay(citation_change, parsed_metadata, citations, db_versions=no_self_ref_versions)
+                _delay_after_commit(task_output_results, citation_change, parsed_metadata, citations, db_versions=no_self_ref_versions)
                 logger.info("Updating associated works for %s", citation_change.content)
                 db.update_citation_target_metadata(app, citation_change.content, raw_metadata, parsed_metadata, curated_metadata=curated_metadata, associated=no_self_ref_versions, bibcode=citation_target_bibcode)
         
 @app.task(queue='process-deleted-citation')
+@_in_unit_of_work
 def task_process_deleted_citation(citation_change, force=False):
     """
     Mark a citation as deleted
@@ -304,7 +354,7 @@ def task_process_deleted_citation(citation_change, force=False):
             readers = db.get_citation_target_readers(app, citation_target_bibcode, parsed_metadata.get('alternate_bibcode', []))
             associated_works = db.get_citation_targets_by_doi(app, [citation_change.content])[0].get('associated_works', {"":""})
             logger.debug("Calling 'task_output_results' with '%s'", citation_change)
-            task_output_results.delay(citation_change, parsed_metadata, citations, db_versions=associated_works, readers=readers)
+            _delay_after_commit(task_output_results, citation_change, parsed_metadata, citations, db_versions=associated_works, readers=readers)
         logger.debug("Calling '_emit_citation_change' with '%s'", citation_change)
         _emit_citation_change(citation_change, parsed_metadata)
 
@@ -336,34 +386,130 @@ def _protobuf_to_adsmsg_citation_change(pure_protobuf):
 def task_process_citation_changes(citation_changes, force=False):
     """
     Process citation changes
+    - Changes are routed by status and dispatched as one task per batch
+      (new, updated and deleted) instead of one task per change
     """
     logger.debug('Checking content: %s', citation_changes)
 
-    for citation_change in citation_changes.changes:
-        citation_change = _protobuf_to_adsmsg_citation_change(citation_change)
-        # Check: Is this citation already stored in the DB?
-        citation_in_db = db.citation_already_exists(app, citation_change)
-
+    new_citation_changes = adsmsg.CitationChanges()
+    updated_citation_changes = adsmsg.CitationChanges()
+    deleted_citation_changes = adsmsg.CitationChanges()
+    adsmsg_citation_changes = [_protobuf_to_adsmsg_citation_change(pure_citation_change) for pure_citation_change in citation_changes.changes]
+    # Check: Are these citations already stored in the DB? (single query for the whole batch)
+    citations_in_db = db.citations_already_exist(app, adsmsg_citation_changes)
+    for pure_citation_change, citation_change, citation_in_db in zip(citation_changes.changes, adsmsg_citation_changes, citations_in_db):
         if citation_change.status == adsmsg.Status.new:
             if citation_in_db:
                 logger.error("Ignoring new citation (citing '%s', content '%s' and timestamp '%s') because it already exists in the database", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
             else:
-                logger.debug("Calling 'task_process_new_citation' with '%s'", citation_change)
-                task_process_new_citation.delay(citation_change, force=force)
+                new_citation_changes.changes.add().CopyFrom(pure_citation_change)
         elif citation_change.status == adsmsg.Status.updated:
             if not citation_in_db:
                 logger.error("Ignoring updated citation (citing '%s', content '%s' and timestamp '%s') because it does not exist in the database", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
             else:
-                logger.debug("Calling 'task_process_updated_citation' with '%s'", citation_change)
-                task_process_updated_citation.delay(citation_change, force=force)
+                updated_citation_changes.changes.add().CopyFrom(pure_citation_change)
         elif citation_change.status == adsmsg.Status.deleted:
             if not citation_in_db:
                 logger.error("Ignoring deleted citation (citing '%s', content '%s' and timestamp '%s') because it does not exist in the database", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
             else:
-                logger.debug("Calling 'task_process_deleted_citation' with '%s'", citation_change)
-                task_process_deleted_citation.delay(citation_change)
+                deleted_citation_changes.changes.add().CopyFrom(pure_citation_change)
+
+    if len(new_citation_changes.changes) > 0:
+        logger.debug("Calling 'task_process_new_citations' with %i changes", len(new_citation_changes.changes))
+        task_process_new_citations.delay(new_citation_changes, force=force)
+    if len(updated_citation_changes.changes) > 0:
+        logger.debug("Calling 'task_process_updated_citations' with %i changes", len(updated_citation_changes.changes))
+        task_process_updated_citations.delay(updated_citation_changes, force=force)
+    if len(deleted_citation_changes.changes) > 0:
+        logger.debug("Calling 'task_process_deleted_citations' with %i changes", len(deleted_citation_changes.changes))
+        task_process_deleted_citations.delay(deleted_citation_changes)
+
+def _requeue_citation_changes(citation_changes, single_change_task, **kwargs):
+    """
+    Queue every citation change of a batch that could not be processed in
+    bulk on its own, so that the framework processes (and retries) each of
+    them individually and only once
+    """
+    for citation_change in citation_changes:
+        single_change_task.delay(citation_change, **kwargs)
+
+@app.task(queue='process-new-citation')
+def task_process_new_citations(citation_changes, force=False):
+    """
+    Process a batch of new citations
+    - The citing bibcodes are resolved to their canonical form in a single
+      API request (answers are cached and used by each citation)
+    - The new citations are stored together with a single bulk statement in
+      the unit of work of the batch, and only the ones that did not exist
+      are emitted and forwarded. If the processing of one of them fails, only
+      its changes are rolled back and it is re-queued individually. If the
+      bulk statement fails, all the changes are re-queued individually.
+    """
+    citing_bibcodes = [citation_change.citing for citation_change in citation_changes.changes]
+    try:
+        api.get_canonical_bibcodes(app, citing_bibcodes)
+    except Exception:
+        logger.exception("Failed resolving canonical bibcodes for a batch of %i new citations, they will be resolved individually", len(citing_bibcodes))
+    adsmsg_citation_changes = [_protobuf_to_adsmsg_citation_change(pure_citation_change) for pure_citation_change in citation_changes.changes]
+    failed_citation_changes = []
+    try:
+        with db.unit_of_work(app):
+            with db.citation_write_buffer(app) as write_buffer:
+                for citation_change in adsmsg_citation_changes:
+                    try:
+                        with write_buffer.citation_change_scope():
+                            task_process_new_citation(citation_change, force=force)
+                    except Exception:
+                        logger.exception("Failed processing new citation (citing '%s', content '%s' and timestamp '%s') of a batch, it will be re-queued individually", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
+                        failed_citation_changes.append(citation_change)
+    except Exception:
+        logger.exception("Failed storing a batch of %i new citations in bulk, they will be re-queued individually", len(adsmsg_citation_changes))
+        _requeue_citation_changes(adsmsg_citation_changes, task_process_new_citation, force=force)
+        return
+    _requeue_citation_changes(failed_citation_changes, task_process_new_citation, force=force)
+    n_stored = sum(1 for citation_change, status, new in write_buffer.results if new)
+    logger.info("Stored %i new citations out of %i buffered", n_stored, len(write_buffer.results))
+
+def _process_citation_changes_batch_in_bulk(citation_changes, single_change_task, deleted=False, **kwargs):
+    """
+    Apply the database changes of a batch of updated (or deleted) citations
+    with a single set-based statement and process every change with the
+    outcome already computed, all of it in a single unit of work. If the
+    processing of one of them fails, the unit of work is rolled back (nothing
+    is emitted) and the changes are re-queued individually.
+    """
+    adsmsg_citation_changes = [_protobuf_to_adsmsg_citation_change(pure_citation_change) for pure_citation_change in citation_changes.changes]
+    try:
+        with db.unit_of_work(app):
+            if deleted:
+                batch = db.citation_change_batch(app, deleted_citation_changes=adsmsg_citation_changes)
+            else:
+                batch = db.citation_change_batch(app, updated_citation_changes=adsmsg_citation_changes)
+            with batch:
+                for citation_change in adsmsg_citation_changes:
+                    single_change_task(citation_change, **kwargs)
+    except Exception:
+        logger.exception("Failed processing a batch of %i citation changes in bulk, they will be re-queued individually", len(adsmsg_citation_changes))
+        _requeue_citation_changes(adsmsg_citation_changes, single_change_task, **kwargs)
+
+@app.task(queue='process-updated-citation')
+def task_process_updated_citations(citation_changes, force=False):
+    """
+    Process a batch of updated citations
+    - The citations are updated with a single set-based statement
+    """
+    _process_citation_changes_batch_in_bulk(citation_changes, task_process_updated_citation, force=force)
+
+@app.task(queue='process-deleted-citation')
+def task_process_deleted_citations(citation_changes, force=False):
+    """
+    Process a batch of deleted citations
+    - The citations are marked as deleted with a single set-based statement
+    """
+    _process_citation_changes_batch_in_bulk(citation_changes, task_process_deleted_citation, deleted=True)
 
 @app.task(queue='process-citation-changes')
+@_in_unit_of_work
 def task_process_reader_updates(reader_changes, **kwargs):
     for change in reader_changes:
         registered_records = db.get_citation_targets_by_bibcode(app, [change['bibcode']])
@@ -417,18 +563,22 @@ def task_process_reader_updates(reader_changes, **kwargs):
                                                         )
         parsed_metadata = db.get_citation_target_metadata(app, custom_citation_change.content).get('parsed', {})
 
-        citations = db.get_citations_by_bibcode(app, registered_record['bibcode'])   
+        # Only the nonbib record is forwarded, which does not need the list of citations
         readers = db.get_citation_target_readers(app, registered_record['bibcode'], parsed_metadata.get('alternate_bibcode', []))
         associated_works = registered_record.get('associated_works', {"":""})
         logger.debug("Calling 'task_output_results' with '%s'", custom_citation_change)    
-        task_output_results.delay(custom_citation_change, parsed_metadata, citations, readers=readers, only_nonbib=True, db_versions=associated_works)
+        _delay_after_commit(task_output_results, custom_citation_change, parsed_metadata, [], readers=readers, only_nonbib=True, db_versions=associated_works)
     else:
         logger.warning("Bibcode: {} is not a target in the database. Cannot forward nonbib record to master.".format(reader_changes[0]['bibcode']))
 
 @app.task(queue='process-citation_changes')
 def task_write_nonbib_files(results):
-    logger.info("Writing nonbib files to disk")
-    db.write_citation_target_data(app, only_status='REGISTERED')
+    if app.conf.get('NONBIB_EXPORT_MODE', 'full') == 'incremental':
+        logger.info("Writing nonbib delta files to disk")
+        db.write_citation_target_delta_data(app)
+    else:
+        logger.info("Writing nonbib files to disk")
+        db.write_citation_target_data(app, only_status='REGISTERED')
 
 def _emit_citation_change(citation_change, parsed_metadata):
     """
@@ -443,14 +593,14 @@ def _emit_citation_change(citation_change, parsed_metadata):
         if event_data:
             dump_prefix = citation_change.timestamp.ToDatetime().strftime("%Y%m%d_%H%M%S")
             logger.debug("Calling 'task_emit_event' for '%s'", citation_change)
-            task_emit_event.delay(event_data, dump_prefix)
+            _delay_after_commit(task_emit_event, event_data, dump_prefix)
 
     elif is_emittable and is_link_alive:
         event_data = webhook.citation_change_to_event_data(citation_change, parsed_metadata)
         if event_data:
             dump_prefix = citation_change.timestamp.ToDatetime().strftime("%Y%m%d_%H%M%S")
             logger.debug("Calling 'task_emit_event' for EMITTABLE citation '%s'", citation_change)
-            task_emit_event.delay(event_data, dump_prefix)
+            _delay_after_commit(task_emit_event, event_data, dump_prefix)
 
 @app.task(queue='process-emit-event')
 def task_emit_event(event_data, dump_prefix):
@@ -503,7 +653,8 @@ def task_maintenance_canonical(dois, bibcodes):
         try:
             # Get citations from the database and transform the stored bibcodes into their canonical ones as registered in Solr.
             original_citations = db.get_citations_by_bibcode(app, registered_record['bibcode'])
-            existing_citation_bibcodes = api.get_canonical_bibcodes(app, original_citations)
+            # Bypass cached resolutions since the goal is to detect recently merged bibcodes
+            existing_citation_bibcodes = api.get_canonical_bibcodes(app, original_citations, use_cache=False)
 
         except:
             logger.exception("Failed API request to retreive existing citations for bibcode '{}'".format(registered_record['bibcode']))
@@ -521,6 +672,7 @@ def task_maintenance_canonical(dois, bibcodes):
             task_output_results.delay(custom_citation_change, parsed_metadata, existing_citation_bibcodes, db_versions=registered_record.get('associated_works', {"":""}), readers=readers)
    
 @app.task(queue='maintenance_metadata')
+@_in_maintenance_history_mode
 def task_maintenance_metadata(dois, bibcodes, reset=False):
     """
     Maintenance operation:
@@ -528,6 +680,8 @@ def task_maintenance_metadata(dois, bibcodes, reset=False):
     - For each, retreive metadata and if it is different to what we have in our database:
         - Get the citations bibcodes and transform them to their canonical form
         - Send to master an update with the new metadata and the current list of citations canonical bibcodes
+    - Records with identical raw metadata (and no curated metadata) are not
+      parsed again unless 'reset' is True (e.g., after a parser update)
     """
     n_requested = len(dois) + len(bibcodes)
     if n_requested == 0:
@@ -537,16 +691,25 @@ def task_maintenance_metadata(dois, bibcodes, reset=False):
         registered_records += db.get_citation_targets_by_doi(app, dois, only_status='REGISTERED')
         registered_records = _remove_duplicated_dict_in_list(registered_records)
 
-    for registered_record in registered_records:
+    registered_records_by_doi = {registered_record['content']: registered_record for registered_record in registered_records}
+    # Fetch DOI metadata concurrently, records are processed as soon as their
+    # metadata is available (if HTTP requests fail, an exception is raised
+    # once the rest of records are processed and the task will be re-queued
+    # (see app.py and adsputils)). Cached metadata is always revalidated with
+    # doi.org to detect changes.
+    for content, raw_metadata in doi.fetch_metadata_many(app.conf['DOI_URL'], app.conf['DATACITE_URL'], list(registered_records_by_doi), max_age=0):
+        registered_record = registered_records_by_doi[content]
         updated = False
         bibcode_replaced = {}
-        # Fetch DOI metadata (if HTTP request fails, an exception is raised
-        # and the task will be re-queued (see app.py and adsputils))
 
         curated_metadata = registered_record.get('curated_metadata', {})
 
+        if not reset and raw_metadata and not curated_metadata \
+                and registered_record.get('raw_cited_metadata_hash') == doi.raw_metadata_hash(raw_metadata):
+            logger.debug("Raw metadata for '%s' has not changed", registered_record['content'])
+            continue
+
         logger.debug("Curated metadata for {} is {}".format(registered_record['content'], registered_record['curated_metadata']))    
-        raw_metadata = doi.fetch_metadata(app.conf['DOI_URL'], app.conf['DATACITE_URL'], registered_record['content'])
         if raw_metadata:
             parsed_metadata = doi.parse_metadata(raw_metadata)
             is_software = parsed_metadata.get('doctype', '').lower() == "software"
@@ -837,7 +1000,8 @@ def task_maintenance_curation(dois, bibcodes, curated_entries, reset=False):
 
 def maintenance_show_metadata(curated_entries):
     """
-    Print current metadata for a given citation target to standard output.
+    Print current metadata (and citation/reader counts) for a given citation
+    target to standard output.
     """
     for curated_entry in curated_entries:
 
@@ -860,6 +1024,11 @@ def maintenance_show_metadata(curated_entries):
                 curated = metadata.get('curated', None)
                 if parsed:
                     print(json.dumps(parsed))
+                # Counts of REGISTERED citations and readers (without fetching them),
+                # to standard error so that the metadata can still be used as curation input
+                aggregates = db.get_citation_target_aggregates(app, [custom_citation_change.content]).get(custom_citation_change.content)
+                if aggregates:
+                    print("Citations: {citation_count}, reads: {read_count}".format(**aggregates), file=sys.stderr)
                 if "error" in curated.keys():
                     print("\n The most recent attempt to curate metadata failed with the following error: {}".format(curated.get("error", "")))
 
@@ -887,6 +1056,11 @@ def maintenance_show_metadata(curated_entries):
                 curated = metadata.get('curated', None)
                 if parsed:
                     print(json.dumps(parsed))
+                # Counts of REGISTERED citations and readers (without fetching them),
+                # to standard error so that the metadata can still be used as curation input
+                aggregates = db.get_citation_target_aggregates(app, [custom_citation_change.content]).get(custom_citation_change.content)
+                if aggregates:
+                    print("Citations: {citation_count}, reads: {read_count}".format(**aggregates), file=sys.stderr)
                 if "error" in curated.keys():
                     print("\n The most recent attempt to curate metadata failed with the following error: {}".format(curated.get("error", "")))
 
@@ -895,12 +1069,23 @@ def maintenance_show_metadata(curated_entries):
                 logger.exception(msg)
 
 @app.task(queue='maintenance_metadata')
+@_in_maintenance_history_mode
 def task_maintenance_repopulate_bibcode_columns():
     """
     Re-populates bibcode column with current canonical bibcode
+    (in chunks, resuming from the last completed chunk if a previous run was interrupted)
+    """
+    db.populate_bibcode_column(app)
+
+@app.task(queue='maintenance_history')
+def task_maintenance_prune_history(keep_days=None):
+    """
+    Maintenance operation:
+    - Remove versions identical to the previous version of the same record
+    - Remove superseded versions older than keep_days (if provided)
+    - Remove the transaction records that are not referenced anymore
     """
-    with app.session_scope() as session:
-        db.populate_bibcode_column(session)
+    db.prune_history(app, keep_days=keep_days)
 
 @app.task(queue='maintenance_resend')
 def task_maintenance_resend(dois, bibcodes, broker, only_nonbib=False):
@@ -929,7 +1114,6 @@ def task_maintenance_resend(dois, bibcodes, broker, only_nonbib=False):
             emittable_records = []
 
     for registered_record in registered_records:
-        citations = db.get_citations_by_bibcode(app, registered_record['bibcode'])
         custom_citation_change = adsmsg.CitationChange(content=registered_record['content'],
                                                        content_type=getattr(adsmsg.CitationChangeContentType, registered_record['content_type'].lower()),
                                                        status=adsmsg.Status.updated,
@@ -937,6 +1121,11 @@ def task_maintenance_resend(dois, bibcodes, broker, only_nonbib=False):
                                                        )
         parsed_metadata = db.get_citation_target_metadata(app, custom_citation_change.content).get('parsed', {})
         if parsed_metadata:
+            if broker or not only_nonbib:
+                citations = db.get_citations_by_bibcode(app, registered_record['bibcode'])
+            else:
+                # Only the nonbib record is forwarded, which does not need the list of citations
+                citations = []
             if not broker:
                 # Only update master
                 readers = db.get_citation_target_readers(app, parsed_metadata.get('bibcode',''), parsed_metadata.get('alternate_bibcode', []))
@@ -1046,7 +1235,11 @@ def task_maintenance_generate_nonbib_files():
     Write DataPipeline files based on the current state of the CC database.
     """
     logger.info("Rewriting nonbib files to disk")
-    db.write_citation_target_data(app, only_status='REGISTERED')                                                     
+    if app.conf.get('NONBIB_EXPORT_MODE', 'full') == 'incremental':
+        # Also resets the incremental export (compaction)
+        db.write_citation_target_snapshot(app)
+    else:
+        db.write_citation_target_data(app, only_status='REGISTERED')
 
 @app.task(queue='maintenance_associated_works')
 def task_maintenance_reevaluate_associated_works(dois, bibcodes):
@@ -1068,7 +1261,6 @@ def task_maintenance_reevaluate_associated_works(dois, bibcodes):
 
     #convert record into citation_change message
     for registered_record in registered_records:
-        citations = db.get_citations_by_bibcode(app, registered_record['bibcode'])
         custom_citation_change = adsmsg.CitationChange(content=registered_record['content'],
                                                        content_type=getattr(adsmsg.CitationChangeContentType, registered_record['content_type'].lower()),
                                                        status=adsmsg.Status.updated,
@@ -1121,6 +1313,13 @@ def task_output_results(citation_change, parsed_metadata, citations, db_versions
         except Exception as e:
             logger.error("Failed to retrieve entry date for {}".format(citation_change))
 
+    citation_count = None
+    if only_nonbib:
+        # The bib record with the list of citations is not forwarded, the
+        # number of citations of the nonbib record is read from the aggregates
+        aggregates = db.get_citation_target_aggregates(app, [citation_change.content]).get(citation_change.content, {})
+        citation_count = aggregates.get('citation_count', 0)
+
     messages = []
     if bibcode_replaced:
         # Bibcode was replaced, this is not a simple update
@@ -1134,10 +1333,10 @@ def task_output_results(citation_change, parsed_metadata, citations, db_versions
         delete_parsed_metadata = parsed_metadata.copy()
         delete_parsed_metadata['bibcode'] = bibcode_replaced['previous']
         delete_parsed_metadata['alternate_bibcode'] = [x for x in delete_parsed_metadata.get('alternate_bibcode', []) if x not in (bibcode_replaced['previous'], bibcode_replaced['new'])]
-        delete_record, delete_nonbib_record = forward.build_record(app, custom_citation_change, delete_parsed_metadata, citations, db_versions=parsed_metadata.get('associated',{"":""}), entry_date=entry_date)
+        delete_record, delete_nonbib_record = forward.build_record(app, custom_citation_change, delete_parsed_metadata, citations, db_versions=parsed_metadata.get('associated',{"":""}), entry_date=entry_date, citation_count=citation_count)
         messages.append((delete_record, delete_nonbib_record))
     # Main message:
-    record, nonbib_record = forward.build_record(app, citation_change, parsed_metadata, citations, db_versions, readers=readers, entry_date=entry_date)
+    record, nonbib_record = forward.build_record(app, citation_change, parsed_metadata, citations, db_versions, readers=readers, entry_date=entry_date, citation_count=citation_count)
     messages.append((record, nonbib_record))
 
     for record, nonbib_record in messages:
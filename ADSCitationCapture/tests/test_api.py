@@ -0,0 +1,172 @@
+import json
+import unittest
+import threading
+import time
+import httpretty
+from ADSCitationCapture import app, tasks
+from ADSCitationCapture import api
+from ADSCitationCapture import cache
+from ADSCitationCapture import batcher
+from .test_base import TestBase
+from mock import patch
+
+
+class TestWorkers(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        api.canonical_bibcode_cache.clear()
+        self.bigquery_url = self.app.conf['ADS_API_URL']+"search/bigquery"
+        self.bigquery_response = json.dumps({'response': {'docs': [{'bibcode': '2015MNRAS.453..483K', 'identifier': ['2015MNRAS.453..483K', '2015arXiv150902512A', 'arXiv:1509.02512', '10.1093/mnras/stv1692']}]}})
+        self.bigquery_requests = []
+
+    def _register_bigquery_response(self, body):
+        """
+        Answer BigQuery requests with body and record the bibcodes requested by each of them
+        """
+        def request_callback(request, uri, response_headers):
+            self.bigquery_requests.append(request.body.decode('utf-8').split('\n')[1:])
+            return [200, response_headers, body]
+        httpretty.register_uri(httpretty.POST, self.bigquery_url, body=request_callback)
+
+    def tearDown(self):
+        api.canonical_bibcode_cache.clear()
+        TestBase.tearDown(self)
+
+    def test_get_canonical_bibcodes_cached(self):
+        httpretty.enable()  # enable HTTPretty so that it will monkey patch the socket module
+        self._register_bigquery_response(self.bigquery_response)
+        canonical_bibcodes = api.get_canonical_bibcodes(self.app, ['2015arXiv150902512A', '2019zzzz.soft.....X'])
+        self.assertEqual(canonical_bibcodes, ['2015MNRAS.453..483K'])
+        self.assertEqual(len(self.bigquery_requests), 1)
+        # Both the alternate and the unknown (negative caching) bibcodes are served from the cache
+        canonical_bibcodes = api.get_canonical_bibcodes(self.app, ['2015arXiv150902512A', '2019zzzz.soft.....X'])
+        self.assertEqual(canonical_bibcodes, ['2015MNRAS.453..483K'])
+        self.assertEqual(len(self.bigquery_requests), 1)
+        self.assertEqual(api.get_canonical_bibcode(self.app, '2019zzzz.soft.....X'), None)
+        self.assertEqual(len(self.bigquery_requests), 1)
+        stats = api.canonical_bibcode_cache.stats()
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['negative_hits'], 2)
+        # Bypassing the cache always reaches the API
+        canonical_bibcodes = api.get_canonical_bibcodes(self.app, ['2015arXiv150902512A'], use_cache=False)
+        self.assertEqual(canonical_bibcodes, ['2015MNRAS.453..483K'])
+        self.assertEqual(len(self.bigquery_requests), 2)
+        httpretty.disable()
+        httpretty.reset()   # clean up registered urls and request history
+
+    def test_get_canonical_bibcodes_identifiers(self):
+        httpretty.enable()  # enable HTTPretty so that it will monkey patch the socket module
+        self._register_bigquery_response(self.bigquery_response)
+        # Matched through an identifier that is not a bibcode
+        canonical_bibcodes = api.get_canonical_bibcodes(self.app, ['arXiv:1509.02512', '2019zzzz.soft.....X'])
+        self.assertEqual(canonical_bibcodes, ['2015MNRAS.453..483K'])
+        self.assertEqual(api.canonical_bibcode_cache.get('arXiv:1509.02512'), (True, '2015MNRAS.453..483K'))
+        self.assertEqual(api.canonical_bibcode_cache.get('2019zzzz.soft.....X'), (True, None))
+        # Answer that cannot be matched: the unknown bibcodes of the chunk are not cached
+        self._register_bigquery_response(json.dumps({'response': {'docs': [{'bibcode': '2015MNRAS.453..483K', 'identifier': ['2015MNRAS.453..483K']}]}}))
+        for i in range(2):
+            canonical_bibcodes = api.get_canonical_bibcodes(self.app, ['2015MNRAS.453..483x', '2019yyyy.soft.....X'])
+            self.assertEqual(canonical_bibcodes, ['2015MNRAS.453..483K'])
+            self.assertEqual(len(self.bigquery_requests), 2+i)
+        self.assertEqual(api.canonical_bibcode_cache.get('2015MNRAS.453..483x'), (False, None))
+        self.assertEqual(api.canonical_bibcode_cache.get('2019yyyy.soft.....X'), (False, None))
+        httpretty.disable()
+        httpretty.reset()   # clean up registered urls and request history
+
+    def test_get_canonical_bibcode_different_canonical(self):
+        httpretty.enable()  # enable HTTPretty so that it will monkey patch the socket module
+        # The API answers with a canonical bibcode that cannot be matched with the requested one
+        unmatched_response = json.dumps({'response': {'docs': [{'bibcode': '2015MNRAS.453..483K', 'identifier': ['2015MNRAS.453..483K']}]}})
+        self._register_bigquery_response(unmatched_response)
+        for i in range(2):
+            self.assertEqual(api.get_canonical_bibcode(self.app, '2015MNRAS.453..483x'), '2015MNRAS.453..483K')
+        self.assertEqual(api.canonical_bibcode_cache.get('2015MNRAS.453..483x'), (True, '2015MNRAS.453..483K'))
+        self.assertEqual(len(self.bigquery_requests), 1)
+        httpretty.disable()
+        httpretty.reset()   # clean up registered urls and request history
+
+    def test_resolve_canonical_bibcodes_bounded_disambiguation(self):
+        # Only one of the requested bibcodes exists, its answer cannot be matched
+        bibcodes = ["2019zzzz.soft{:05d}X".format(i) for i in range(1024)]
+        def get_canonical_bibcodes(app, n_chunk, total_n_chunks, bibcodes_chunk, timeout):
+            if "2019zzzz.soft00777X" in bibcodes_chunk:
+                return [{'bibcode': '2019ZZZZ.soft00777X', 'identifier': ['2019ZZZZ.soft00777X']}]
+            return []
+        with patch.object(api, '_get_canonical_bibcodes', side_effect=get_canonical_bibcodes) as mocked:
+            resolved = api._resolve_canonical_bibcodes(bibcodes, self.app)
+            # The uncertain bibcodes are split in halves instead of being requested one by one
+            self.assertLessEqual(mocked.call_count, 1 + 2 * 10)
+        self.assertEqual(resolved, dict(dict.fromkeys(bibcodes), **{'2019zzzz.soft00777X': '2019ZZZZ.soft00777X'}))
+        # Every answer is final and cached
+        self.assertEqual(api.canonical_bibcode_cache.get('2019zzzz.soft00777X'), (True, '2019ZZZZ.soft00777X'))
+        self.assertEqual(api.canonical_bibcode_cache.get('2019zzzz.soft00000X'), (True, None))
+
+    def test_get_canonical_bibcode_alone(self):
+        httpretty.enable()  # enable HTTPretty so that it will monkey patch the socket module
+        httpretty.register_uri(httpretty.POST, self.bigquery_url, status=200, body=self.bigquery_response)
+        # A caller alone (e.g., prefork pool) does not wait for the window
+        start = time.time()
+        with patch.object(api.canonical_bibcode_batcher, 'window', 10):
+            self.assertEqual(api.get_canonical_bibcode(self.app, '2015arXiv150902512A'), '2015MNRAS.453..483K')
+        self.assertLess(time.time() - start, 5)
+        httpretty.disable()
+        httpretty.reset()   # clean up registered urls and request history
+
+    def test_micro_batcher(self):
+        release = threading.Event()
+        requested = []
+        def fetch_many(keys, suffix):
+            requested.append((sorted(keys), suffix))
+            if 'blocker' in keys:
+                release.wait(5)
+            return {key: key + suffix for key in keys}
+        micro_batcher = batcher.MicroBatcher('test', fetch_many, window=1)
+        results = {}
+        def get(key, suffix):
+            results[(key, suffix)] = micro_batcher.get(key, suffix)
+        # The blocked request keeps a caller in flight: the following ones
+        # wait for each other and the ones with the same arguments are coalesced
+        threads = [threading.Thread(target=get, args=('blocker', '!'))]
+        threads[0].start()
+        time.sleep(0.1)
+        for key, suffix in (('a', '!'), ('b', '!'), ('c', '?')):
+            threads.append(threading.Thread(target=get, args=(key, suffix)))
+            threads[-1].start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {('blocker', '!'): 'blocker!', ('a', '!'): 'a!', ('b', '!'): 'b!', ('c', '?'): 'c?'})
+        self.assertEqual(sorted(requested), [(['a', 'b'], '!'), (['blocker'], '!'), (['c'], '?')])
+        self.assertEqual(micro_batcher.stats()['batches'], 3)
+
+    def test_get_canonical_bibcodes_parallel_chunks(self):
+        bibcodes = ["2019zzzz.soft{:05d}X".format(i) for i in range(4500)]
+        def get_canonical_bibcodes(app, n_chunk, total_n_chunks, bibcodes_chunk, timeout):
+            # Answer the last chunk first
+            time.sleep(0.1 * (total_n_chunks - n_chunk))
+            return [{'bibcode': bibcode.replace('zzzz', 'ZZZZ'), 'identifier': [bibcode]} for bibcode in bibcodes_chunk]
+        with patch.object(api, '_get_canonical_bibcodes', side_effect=get_canonical_bibcodes) as mocked:
+            canonical_bibcodes = api.get_canonical_bibcodes(self.app, bibcodes)
+            self.assertEqual(mocked.call_count, 3)
+        self.assertEqual(canonical_bibcodes, [bibcode.replace('zzzz', 'ZZZZ') for bibcode in bibcodes])
+
+    def test_lru_cache_expiration_and_eviction(self):
+        lru_cache = cache.LRUCache('test', maxsize=2, ttl=60, negative_ttl=0, shared_backend=cache.LocalCacheBackend())
+        lru_cache.set('a', 'A')
+        lru_cache.set('b', 'B', ttl=-1) # already expired
+        lru_cache.set('c', None) # negative caching disabled
+        self.assertEqual(lru_cache.get('a'), (True, 'A'))
+        self.assertEqual(lru_cache.get('b'), (False, None))
+        self.assertEqual(lru_cache.get('c'), (False, None))
+        lru_cache.set('d', 'D')
+        lru_cache.set('e', 'E')
+        self.assertEqual(lru_cache.stats()['size'], 2)
+        # Evicted from memory but still available in the shared backend
+        self.assertEqual(lru_cache.get('a'), (True, 'A'))
+        self.assertEqual(lru_cache.stats()['shared_hits'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
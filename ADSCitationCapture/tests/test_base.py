@@ -4,6 +4,7 @@ import mock
 from sqlalchemy import create_engine
 from adsputils import load_config
 from ADSCitationCapture import app, tasks
+from ADSCitationCapture import http_client
 from ADSCitationCapture.models import Base
 
 class TestBase(unittest.TestCase):
@@ -20,15 +21,20 @@ class TestBase(unittest.TestCase):
         Based on: https://gist.github.com/msabramo/dffa53e4f29ec2e3682e
         """
         mocks = {}
+        started_patches = []
 
-        for mock_name, mock_patch in mock_patches.items():
-            _mock = mock_patch.start()
-            mocks[mock_name] = _mock
-
-        yield mocks
+        try:
+            for mock_name, mock_patch in mock_patches.items():
+                _mock = mock_patch.start()
+                started_patches.append(mock_patch)
+                mocks[mock_name] = _mock
 
-        for mock_name, mock_patch in mock_patches.items():
-            mock_patch.stop()
+            yield mocks
+        finally:
+            # Stop them even if an assertion failed, otherwise the mocks leak
+            # into the following tests
+            for mock_patch in reversed(started_patches):
+                mock_patch.stop()
 
 
     def setUp(self):
@@ -55,6 +61,10 @@ class TestBase(unittest.TestCase):
 
     def tearDown(self):
         unittest.TestCase.tearDown(self)
+        # Never let the patches of a test leak into the following ones
+        mock.patch.stopall()
+        # Do not re-use pooled connections (potentially mocked) between tests
+        http_client.close_session()
         # A CASCADE drop is required because sometimes drop_all tries to delete
         # ENUM before tables that depend on it and it raises and exception:
         for table_name in Base.metadata.tables.keys():
@@ -1,10 +1,14 @@
 import os
 import re
 import json
+import shutil
+import tempfile
 import unittest
 import httpretty
+from mock import patch
 from ADSCitationCapture import app, tasks
 from ADSCitationCapture import doi
+from ADSCitationCapture import cache
 from .test_base import TestBase
 
 
@@ -42,6 +46,51 @@ class TestWorkers(TestBase):
         httpretty.disable()
         httpretty.reset()   # clean up registered urls and request history
 
+    def test_fetch_metadata_many(self):
+        dois = ["10.5281/zenodo.{}".format(i) for i in range(20)]
+        def fetch_metadata(base_doi_url, base_datacite_url, doi_id, limiter=None, max_age=None):
+            if doi_id == dois[5]:
+                raise Exception("HTTP request to DOI service failed: {}".format(doi_id))
+            return "<resource>{}</resource>".format(doi_id)
+        results = {}
+        with patch.object(doi, 'fetch_metadata', side_effect=fetch_metadata) as mocked:
+            with self.assertRaises(Exception):
+                for doi_id, raw_metadata in doi.fetch_metadata_many(self.app.conf['DOI_URL'], self.app.conf['DATACITE_URL'], dois, max_workers=4, max_per_host=2):
+                    results[doi_id] = raw_metadata
+            self.assertEqual(mocked.call_count, len(dois))
+        # The failure is raised only after the rest of results are generated
+        self.assertEqual(len(results), len(dois)-1)
+        self.assertEqual(results[dois[0]], "<resource>{}</resource>".format(dois[0]))
+
+    def test_fetch_metadata_cached(self):
+        doi_id = "10.5281/zenodo.11020" # software
+        expected_response_content = self.mock_data[doi_id]['raw']
+        cache_dir = tempfile.mkdtemp()
+        httpretty.enable()  # enable HTTPretty so that it will monkey patch the socket module
+        httpretty.register_uri(httpretty.GET, self.app.conf['DOI_URL']+doi_id, responses=[
+                                    httpretty.Response(body=expected_response_content, status=200, adding_headers={'ETag': '"v1"'}),
+                                    httpretty.Response(body="", status=304),
+                                ])
+        with patch.object(doi, 'raw_metadata_cache', cache.RawContentCache(cache_dir)) as raw_metadata_cache:
+            # Download
+            raw_metadata = doi.fetch_metadata(self.app.conf['DOI_URL'], self.app.conf['DATACITE_URL'], doi_id)
+            self.assertEqual(raw_metadata, expected_response_content)
+            # Served locally
+            raw_metadata = doi.fetch_metadata(self.app.conf['DOI_URL'], self.app.conf['DATACITE_URL'], doi_id)
+            self.assertEqual(raw_metadata, expected_response_content)
+            self.assertEqual(len(httpretty.latest_requests()), 1)
+            # Revalidated
+            raw_metadata = doi.fetch_metadata(self.app.conf['DOI_URL'], self.app.conf['DATACITE_URL'], doi_id, max_age=0)
+            self.assertEqual(raw_metadata, expected_response_content)
+            self.assertEqual(len(httpretty.latest_requests()), 2)
+            self.assertEqual(httpretty.last_request().headers.get('If-None-Match'), '"v1"')
+            stats = raw_metadata_cache.stats()
+            self.assertEqual((stats['misses'], stats['hits'], stats['revalidations']), (1, 1, 1))
+            self.assertEqual(stats['bytes_saved'], 2*len(expected_response_content.encode('utf-8')))
+        shutil.rmtree(cache_dir)
+        httpretty.disable()
+        httpretty.reset()   # clean up registered urls and request history
+
     def test_decode_datacite_content(self):
         content_filename = os.path.join(self.app.conf['PROJ_HOME'], "ADSCitationCapture/tests/data/datacite.json")
         expected_decoded_content_filename = os.path.join(self.app.conf['PROJ_HOME'], "ADSCitationCapture/tests/data/datacite_decoded.xml")
@@ -72,6 +121,20 @@ class TestWorkers(TestBase):
         parsed_metadata = doi.dc.parse(raw_metadata)
         self.assertEqual(parsed_metadata, expected_parsed_metadata)
 
+    def test_parse_metadata_memoized(self):
+        doi_id = "10.5281/zenodo.11020" # software
+        raw_metadata = self.mock_data[doi_id]['raw']
+        expected_parsed_metadata = self.mock_data[doi_id]['parsed']
+        doi.parsed_metadata_cache.clear()
+        with patch.object(doi, '_parse_metadata_zenodo_doi', wraps=doi._parse_metadata_zenodo_doi) as mocked:
+            parsed_metadata = doi.parse_metadata(raw_metadata)
+            parsed_metadata['bibcode'] = "Modified by the caller"
+            parsed_metadata = doi.parse_metadata(raw_metadata)
+            self.assertEqual(parsed_metadata, expected_parsed_metadata)
+            self.assertEqual(mocked.call_count, 1)
+        self.assertEqual(doi.raw_metadata_hash(raw_metadata), doi.raw_metadata_hash(raw_metadata.encode('utf-8')))
+        doi.parsed_metadata_cache.clear()
+
     def test_build_bibcode(self):
         expected_bibcode = "2007zndo.....48535G"
         datacite_parsed_metadata_filename = os.path.join(self.app.conf['PROJ_HOME'], "ADSCitationCapture/tests/data/datacite_parsed_metadata_and_authors.json")
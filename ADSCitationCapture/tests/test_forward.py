@@ -70,5 +70,15 @@ class TestWorkers(TestBase):
         
         self.assertEqual(bib_record.toJSON(),expect_bib_record)
         self.assertEqual(nonbib_record.toJSON(),expect_nonbib_record)
+
+    def test_build_nonbib_record_citation_count(self):
+        citation_changes = self._common_citation_changes_doi(adsmsg.Status.updated)
+        citation_change = tasks._protobuf_to_adsmsg_citation_change(citation_changes.changes[0])
+        doi_id = "10.5281/zenodo.11020" # software
+        parsed_metadata = self.mock_data[doi_id]['parsed']
+        # Number of citations given by the aggregates without their list
+        bib_record, nonbib_record = forward.build_record(self.app, citation_change, parsed_metadata, [], {"":""}, citation_count=3)
+        self.assertEqual(bib_record.citation_count, 3)
+        self.assertEqual(nonbib_record.citation_count, 3)
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+import httpretty
+import requests
+from mock import patch
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from ADSCitationCapture import app, tasks
+from ADSCitationCapture import http_client
+from .test_base import TestBase
+
+
+class TestWorkers(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        http_client.reset_latency_stats()
+
+    def tearDown(self):
+        TestBase.tearDown(self)
+
+    def test_retry_after(self):
+        test_url = "https://zenodo.org/record/1011088"
+        httpretty.enable()  # enable HTTPretty so that it will monkey patch the socket module
+        httpretty.register_uri(httpretty.GET, test_url, responses=[
+                                    httpretty.Response(body="", status=503, adding_headers={'Retry-After': '2'}),
+                                    httpretty.Response(body="", status=200),
+                                ])
+        with patch.object(http_client.time, 'sleep', return_value=None) as sleep:
+            response = http_client.get(test_url, endpoint='zenodo')
+            self.assertTrue(response.ok)
+            sleep.assert_called_once_with(2.)
+        self.assertEqual(len(httpretty.latest_requests()), 2)
+        stats = http_client.latency_stats()['zenodo']
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['errors'], 1)
+        httpretty.disable()
+        httpretty.reset()   # clean up registered urls and request history
+
+    def test_retries_exhausted(self):
+        test_url = "https://zenodo.org/record/1011088"
+        httpretty.enable()  # enable HTTPretty so that it will monkey patch the socket module
+        httpretty.register_uri(httpretty.GET, test_url, status=504, body="")
+        with patch.object(http_client.time, 'sleep', return_value=None) as sleep:
+            response = http_client.get(test_url, retries=2)
+            self.assertFalse(response.ok)
+            self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(len(httpretty.latest_requests()), 3)
+        self.assertEqual(http_client.latency_stats()['zenodo.org']['errors'], 3)
+        httpretty.disable()
+        httpretty.reset()   # clean up registered urls and request history
+
+    def test_non_idempotent_requests_not_retried(self):
+        test_url = "https://api.adsabs.harvard.edu/v1/webhook"
+        httpretty.enable()  # enable HTTPretty so that it will monkey patch the socket module
+        httpretty.register_uri(httpretty.POST, test_url, status=504, body="")
+        with patch.object(http_client.time, 'sleep', return_value=None) as sleep:
+            response = http_client.post(test_url, data="{}", retries=2)
+            self.assertFalse(response.ok)
+            self.assertEqual(sleep.call_count, 0)
+        self.assertEqual(http_client.latency_stats()['api.adsabs.harvard.edu']['requests'], 1)
+        httpretty.disable()
+        httpretty.reset()   # clean up registered urls and request history
+        session = http_client.get_session()
+        not_sent = requests.exceptions.ConnectionError(MaxRetryError(None, test_url, NewConnectionError(None, "Connection refused")))
+        response = requests.Response()
+        response.status_code = 200
+        with patch.object(http_client.time, 'sleep', return_value=None), \
+                patch.object(session, 'request', side_effect=[not_sent, response]) as mocked:
+            # Never received by the server, it is sent again
+            self.assertTrue(http_client.post(test_url, data="{}", retries=2).ok)
+            self.assertEqual(mocked.call_count, 2)
+        with patch.object(http_client.time, 'sleep', return_value=None), \
+                patch.object(session, 'request', side_effect=requests.exceptions.ReadTimeout()) as mocked:
+            # It may have been received by the server
+            with self.assertRaises(requests.exceptions.ReadTimeout):
+                http_client.post(test_url, data="{}", retries=2)
+            self.assertEqual(mocked.call_count, 1)
+            with self.assertRaises(requests.exceptions.ReadTimeout):
+                http_client.post(test_url, data="{}", retries=2, idempotent=True)
+            self.assertEqual(mocked.call_count, 4)
+
+    def test_session_is_reused(self):
+        self.assertIs(http_client.get_session(), http_client.get_session())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import gzip
+import json
+import hashlib
+import shutil
+import tempfile
+import unittest
+from ADSCitationCapture import output_files
+from .test_base import TestBase
+
+
+class TestWorkers(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+        TestBase.tearDown(self)
+
+    def test_publish_with_manifest(self):
+        path = os.path.join(self.output_dir, 'citations_CC.list')
+        output_file = output_files.OutputFile('citations', path, compression='gzip').open()
+        output_file.write("2019zzzz.soft.....X\t2015MNRAS.453..483K\n")
+        output_file.write("2019zzzz.soft.....X\t2016MNRAS.456.1234A\n")
+        # Nothing is visible before publishing
+        self.assertFalse(os.path.exists(path))
+        output_file.publish()
+        with open(path) as f:
+            content = f.read()
+        with gzip.open(path+'.gz', 'rt') as f:
+            self.assertEqual(f.read(), content)
+        manifest_path = os.path.join(self.output_dir, 'manifest_CC.json')
+        output_files.write_manifest(manifest_path, [output_file])
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        entry = manifest['files']['citations']
+        self.assertEqual(entry['rows'], 2)
+        self.assertEqual(entry['bytes'], len(content.encode('utf-8')))
+        self.assertEqual(entry['sha256'], hashlib.sha256(content.encode('utf-8')).hexdigest())
+        with open(path+'.gz', 'rb') as f:
+            self.assertEqual(entry['compressed']['sha256'], hashlib.sha256(f.read()).hexdigest())
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ['citations_CC.list', 'citations_CC.list.gz', 'manifest_CC.json'])
+
+    def test_discard_keeps_published_file(self):
+        path = os.path.join(self.output_dir, 'bibcodes_CC.list.can')
+        with open(path, 'w') as f:
+            f.write("2019zzzz.soft.....X")
+        output_file = output_files.OutputFile('bibcode', path).open()
+        output_file.write("2020zzzz.soft.....X")
+        output_file.discard()
+        with open(path) as f:
+            self.assertEqual(f.read(), "2019zzzz.soft.....X")
+        self.assertEqual(os.listdir(self.output_dir), ['bibcodes_CC.list.can'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -90,7 +90,7 @@ class TestWorkers(TestBase):
             i = 0
             with TestBase.mock_multiple_targets({
                     'task_process_citation_changes': patch.object(tasks.task_process_citation_changes, 'delay', wraps=tasks.task_process_citation_changes.delay), \
-                    'citation_already_exists': patch.object(db, 'citation_already_exists', wraps=db.citation_already_exists), \
+                    'citations_already_exist': patch.object(db, 'citations_already_exist', wraps=db.citations_already_exist), \
                     'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', wraps=db.get_citation_target_metadata), \
                     'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', wraps=db.get_citations_by_bibcode), \
                     'store_citation_target': patch.object(db, 'store_citation_target', wraps=db.store_citation_target), \
@@ -121,7 +121,7 @@ class TestWorkers(TestBase):
                     'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
 
                 self.process(first_refids_filename, sqlalchemy_url=self.sqlalchemy_url, schema_prefix=self.schema_prefix)
-                self.assertTrue(mocked['citation_already_exists'].called)
+                self.assertTrue(mocked['citations_already_exist'].called)
                 self.assertTrue(mocked['get_citation_target_metadata'].called)
                 self.assertTrue(mocked['fetch_metadata'].called)
                 self.assertTrue(mocked['parse_metadata'].called)
@@ -162,7 +162,7 @@ class TestWorkers(TestBase):
             i = 0
             with TestBase.mock_multiple_targets({
                     'task_process_citation_changes': patch.object(tasks.task_process_citation_changes, 'delay', wraps=tasks.task_process_citation_changes.delay), \
-                    'citation_already_exists': patch.object(db, 'citation_already_exists', wraps=db.citation_already_exists), \
+                    'citations_already_exist': patch.object(db, 'citations_already_exist', wraps=db.citations_already_exist), \
                     'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', wraps=db.get_citation_target_metadata), \
                     'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', wraps=db.get_citations_by_bibcode), \
                     'store_citation_target': patch.object(db, 'store_citation_target', wraps=db.store_citation_target), \
@@ -193,7 +193,7 @@ class TestWorkers(TestBase):
                     'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
 
                 self.process(second_refids_filename, sqlalchemy_url=self.sqlalchemy_url, schema_prefix=self.schema_prefix)
-                self.assertTrue(mocked['citation_already_exists'].called)
+                self.assertTrue(mocked['citations_already_exist'].called)
                 self.assertTrue(mocked['get_citation_target_metadata'].called)
                 self.assertTrue(mocked['fetch_metadata'].called)
                 self.assertTrue(mocked['parse_metadata'].called)
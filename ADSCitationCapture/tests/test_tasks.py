@@ -1,6 +1,8 @@
 import sys
 import os
 import json
+import contextlib
+import threading
 import adsmsg
 from datetime import datetime
 from ADSCitationCapture import webhook
@@ -8,10 +10,12 @@ from ADSCitationCapture import doi
 from ADSCitationCapture import url
 from ADSCitationCapture import db
 from ADSCitationCapture import api
+from ADSCitationCapture import forward
 from .test_base import TestBase
 import unittest
 from ADSCitationCapture import app, tasks
-from mock import patch
+from mock import patch, MagicMock
+from sqlalchemy_continuum.unit_of_work import UnitOfWork
 
 class TestWorkers(TestBase):
 
@@ -36,7 +40,7 @@ class TestWorkers(TestBase):
         citation_changes = self._common_citation_changes_doi(adsmsg.Status.new)
         doi_id = "10.5281/zenodo.11020" # software
         with TestBase.mock_multiple_targets({
-                'citation_already_exists': patch.object(db, 'citation_already_exists', return_value=False), \
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[False]), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value={}), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
@@ -66,7 +70,7 @@ class TestWorkers(TestBase):
                 'webhook_emit_event': patch.object(webhook, 'emit_event', return_value=True), \
                 'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_citation_changes(citation_changes)
-            self.assertTrue(mocked['citation_already_exists'].called)
+            self.assertTrue(mocked['citations_already_exist'].called)
             self.assertTrue(mocked['get_citation_target_metadata'].called)
             self.assertTrue(mocked['fetch_metadata'].called)
             self.assertTrue(mocked['parse_metadata'].called)
@@ -101,7 +105,7 @@ class TestWorkers(TestBase):
         citation_changes = self._common_citation_changes_doi(adsmsg.Status.updated)
         doi_id = "10.5281/zenodo.11020" # software
         with TestBase.mock_multiple_targets({
-                'citation_already_exists': patch.object(db, 'citation_already_exists', return_value=True), \
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[True]), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value=self.mock_data[doi_id]), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
@@ -131,7 +135,7 @@ class TestWorkers(TestBase):
                 'webhook_emit_event': patch.object(webhook, 'emit_event', return_value=True), \
                 'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_citation_changes(citation_changes)
-            self.assertTrue(mocked['citation_already_exists'].called)
+            self.assertTrue(mocked['citations_already_exist'].called)
             self.assertTrue(mocked['get_citation_target_metadata'].called)
             self.assertFalse(mocked['fetch_metadata'].called)
             self.assertFalse(mocked['parse_metadata'].called)
@@ -165,7 +169,7 @@ class TestWorkers(TestBase):
         citation_changes = self._common_citation_changes_doi(adsmsg.Status.new)
         doi_id = "10.5281/zenodo.4475376" # software
         with TestBase.mock_multiple_targets({
-                'citation_already_exists': patch.object(db, 'citation_already_exists', return_value=False), \
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[False]), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value={}), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
@@ -197,7 +201,7 @@ class TestWorkers(TestBase):
                 'webhook_emit_event': patch.object(webhook, 'emit_event', return_value=True), \
                 'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_citation_changes(citation_changes)
-            self.assertTrue(mocked['citation_already_exists'].called)
+            self.assertTrue(mocked['citations_already_exist'].called)
             self.assertTrue(mocked['get_citation_target_metadata'].called)
             self.assertTrue(mocked['fetch_metadata'].called)
             self.assertTrue(mocked['parse_metadata'].called)
@@ -233,7 +237,7 @@ class TestWorkers(TestBase):
         citation_changes = self._common_citation_changes_doi(adsmsg.Status.deleted)
         doi_id = "10.5281/zenodo.11020" # software
         with TestBase.mock_multiple_targets({
-                'citation_already_exists': patch.object(db, 'citation_already_exists', return_value=True), \
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[True]), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value=self.mock_data[doi_id]), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
@@ -263,7 +267,7 @@ class TestWorkers(TestBase):
                 'webhook_emit_event': patch.object(webhook, 'emit_event', return_value=True), \
                 'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_citation_changes(citation_changes)
-            self.assertTrue(mocked['citation_already_exists'].called)
+            self.assertTrue(mocked['citations_already_exist'].called)
             self.assertTrue(mocked['get_citation_target_metadata'].called)
             self.assertFalse(mocked['fetch_metadata'].called)
             self.assertFalse(mocked['parse_metadata'].called)
@@ -297,7 +301,7 @@ class TestWorkers(TestBase):
         citation_changes = self._common_citation_changes_doi(adsmsg.Status.new)
         doi_id = "10.5281/zenodo.11020" # software
         with TestBase.mock_multiple_targets({
-                'citation_already_exists': patch.object(db, 'citation_already_exists', return_value=False), \
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[False]), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value=self.mock_data[doi_id]), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
@@ -327,7 +331,7 @@ class TestWorkers(TestBase):
                 'webhook_emit_event': patch.object(webhook, 'emit_event', return_value=True), \
                 'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_citation_changes(citation_changes)
-            self.assertTrue(mocked['citation_already_exists'].called)
+            self.assertTrue(mocked['citations_already_exist'].called)
             self.assertTrue(mocked['get_citation_target_metadata'].called)
             self.assertFalse(mocked['fetch_metadata'].called)
             self.assertFalse(mocked['parse_metadata'].called)
@@ -361,7 +365,7 @@ class TestWorkers(TestBase):
         citation_changes = self._common_citation_changes_doi(adsmsg.Status.updated)
         doi_id = "10.5281/zenodo.11020" # software
         with TestBase.mock_multiple_targets({
-                'citation_already_exists': patch.object(db, 'citation_already_exists', return_value=False), \
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[False]), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value=self.mock_data[doi_id]), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
@@ -391,7 +395,7 @@ class TestWorkers(TestBase):
                 'webhook_emit_event': patch.object(webhook, 'emit_event', return_value=True), \
                 'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_citation_changes(citation_changes)
-            self.assertTrue(mocked['citation_already_exists'].called)
+            self.assertTrue(mocked['citations_already_exist'].called)
             self.assertFalse(mocked['get_citation_target_metadata'].called)
             self.assertFalse(mocked['fetch_metadata'].called)
             self.assertFalse(mocked['parse_metadata'].called)
@@ -425,7 +429,7 @@ class TestWorkers(TestBase):
         citation_changes = self._common_citation_changes_doi(adsmsg.Status.deleted)
         doi_id = "10.5281/zenodo.11020" # software
         with TestBase.mock_multiple_targets({
-                'citation_already_exists': patch.object(db, 'citation_already_exists', return_value=False), \
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[False]), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value=self.mock_data[doi_id]), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
@@ -455,7 +459,7 @@ class TestWorkers(TestBase):
                 'webhook_emit_event': patch.object(webhook, 'emit_event', return_value=True), \
                 'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_citation_changes(citation_changes)
-            self.assertTrue(mocked['citation_already_exists'].called)
+            self.assertTrue(mocked['citations_already_exist'].called)
             self.assertFalse(mocked['get_citation_target_metadata'].called)
             self.assertFalse(mocked['fetch_metadata'].called)
             self.assertFalse(mocked['parse_metadata'].called)
@@ -489,7 +493,7 @@ class TestWorkers(TestBase):
         citation_changes = self._common_citation_changes_doi(adsmsg.Status.new)
         doi_id = "10.5281/zenodo.11020" # software
         with TestBase.mock_multiple_targets({
-                'citation_already_exists': patch.object(db, 'citation_already_exists', return_value=True), \
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[True]), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value=self.mock_data[doi_id]), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
@@ -519,7 +523,7 @@ class TestWorkers(TestBase):
                 'webhook_emit_event': patch.object(webhook, 'emit_event', return_value=True), \
                 'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_citation_changes(citation_changes)
-            self.assertTrue(mocked['citation_already_exists'].called)
+            self.assertTrue(mocked['citations_already_exist'].called)
             self.assertFalse(mocked['get_citation_target_metadata'].called)
             self.assertFalse(mocked['fetch_metadata'].called)
             self.assertFalse(mocked['parse_metadata'].called)
@@ -553,7 +557,7 @@ class TestWorkers(TestBase):
         citation_changes = self._common_citation_changes_doi(adsmsg.Status.updated)
         doi_id = "10.5281/zenodo.11020" # software
         with TestBase.mock_multiple_targets({
-                'citation_already_exists': patch.object(db, 'citation_already_exists', return_value=False), \
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[False]), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value=self.mock_data[doi_id]), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
@@ -583,7 +587,7 @@ class TestWorkers(TestBase):
                 'webhook_emit_event': patch.object(webhook, 'emit_event', return_value=True), \
                 'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_citation_changes(citation_changes)
-            self.assertTrue(mocked['citation_already_exists'].called)
+            self.assertTrue(mocked['citations_already_exist'].called)
             self.assertFalse(mocked['get_citation_target_metadata'].called)
             self.assertFalse(mocked['fetch_metadata'].called)
             self.assertFalse(mocked['parse_metadata'].called)
@@ -617,7 +621,7 @@ class TestWorkers(TestBase):
         citation_changes = self._common_citation_changes_doi(adsmsg.Status.deleted)
         doi_id = "10.5281/zenodo.11020" # software
         with TestBase.mock_multiple_targets({
-                'citation_already_exists': patch.object(db, 'citation_already_exists', return_value=False), \
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[False]), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value=self.mock_data[doi_id]), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
@@ -647,7 +651,7 @@ class TestWorkers(TestBase):
                 'webhook_emit_event': patch.object(webhook, 'emit_event', return_value=True), \
                 'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_citation_changes(citation_changes)
-            self.assertTrue(mocked['citation_already_exists'].called)
+            self.assertTrue(mocked['citations_already_exist'].called)
             self.assertFalse(mocked['get_citation_target_metadata'].called)
             self.assertFalse(mocked['fetch_metadata'].called)
             self.assertFalse(mocked['parse_metadata'].called)
@@ -687,7 +691,7 @@ class TestWorkers(TestBase):
         citation_change.resolved = False
         citation_change.status = adsmsg.Status.new
         with TestBase.mock_multiple_targets({
-                'citation_already_exists': patch.object(db, 'citation_already_exists', return_value=False), \
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[False]), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value={}), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
@@ -717,13 +721,14 @@ class TestWorkers(TestBase):
                 'webhook_emit_event': patch.object(webhook, 'emit_event', return_value=True), \
                 'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_citation_changes(citation_changes)
-            self.assertTrue(mocked['citation_already_exists'].called)
+            self.assertTrue(mocked['citations_already_exist'].called)
             self.assertTrue(mocked['get_citation_target_metadata'].called)
             self.assertFalse(mocked['fetch_metadata'].called)
             self.assertFalse(mocked['parse_metadata'].called)
             self.assertTrue(mocked['url_is_alive'].called)
             self.assertTrue(mocked['get_canonical_bibcode'].called)
-            self.assertFalse(mocked['get_canonical_bibcodes'].called)
+            # The citing bibcodes of the batch are resolved up-front in a single request
+            mocked['get_canonical_bibcodes'].assert_called_once_with(self.app, [citation_changes.changes[0].citing])
             self.assertFalse(mocked['get_citations_by_bibcode'].called)
             self.assertFalse(mocked['store_citation_target'].called)
             self.assertFalse(mocked['store_citation'].called)
@@ -757,7 +762,7 @@ class TestWorkers(TestBase):
         citation_change.resolved = False
         citation_change.status = adsmsg.Status.new
         with TestBase.mock_multiple_targets({
-                'citation_already_exists': patch.object(db, 'citation_already_exists', return_value=False), \
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[False]), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value={}), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
@@ -787,13 +792,14 @@ class TestWorkers(TestBase):
                 'webhook_emit_event': patch.object(webhook, 'emit_event', return_value=True), \
                 'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_citation_changes(citation_changes)
-            self.assertTrue(mocked['citation_already_exists'].called)
+            self.assertTrue(mocked['citations_already_exist'].called)
             self.assertTrue(mocked['get_citation_target_metadata'].called)
             self.assertFalse(mocked['fetch_metadata'].called)
             self.assertFalse(mocked['parse_metadata'].called)
             self.assertTrue(mocked['url_is_alive'].called)
             self.assertTrue(mocked['get_canonical_bibcode'].called)
-            self.assertFalse(mocked['get_canonical_bibcodes'].called)
+            # The citing bibcodes of the batch are resolved up-front in a single request
+            mocked['get_canonical_bibcodes'].assert_called_once_with(self.app, [citation_changes.changes[0].citing])
             self.assertFalse(mocked['get_citations_by_bibcode'].called)
             self.assertTrue(mocked['store_citation_target'].called)
             self.assertTrue(mocked['store_citation'].called)
@@ -827,7 +833,7 @@ class TestWorkers(TestBase):
         citation_change.resolved = False
         citation_change.status = adsmsg.Status.new
         with TestBase.mock_multiple_targets({
-                'citation_already_exists': patch.object(db, 'citation_already_exists', return_value=False), \
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[False]), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value={}), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
@@ -857,13 +863,14 @@ class TestWorkers(TestBase):
                 'webhook_emit_event': patch.object(webhook, 'emit_event', return_value=True), \
                 'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_citation_changes(citation_changes)
-            self.assertTrue(mocked['citation_already_exists'].called)
+            self.assertTrue(mocked['citations_already_exist'].called)
             self.assertTrue(mocked['get_citation_target_metadata'].called)
             self.assertFalse(mocked['fetch_metadata'].called)
             self.assertFalse(mocked['parse_metadata'].called)
             self.assertTrue(mocked['url_is_alive'].called)
             self.assertTrue(mocked['get_canonical_bibcode'].called)
-            self.assertFalse(mocked['get_canonical_bibcodes'].called)
+            # The citing bibcodes of the batch are resolved up-front in a single request
+            mocked['get_canonical_bibcodes'].assert_called_once_with(self.app, [citation_changes.changes[0].citing])
             self.assertFalse(mocked['get_citations_by_bibcode'].called)
             self.assertTrue(mocked['store_citation_target'].called)
             self.assertTrue(mocked['store_citation'].called)
@@ -897,7 +904,7 @@ class TestWorkers(TestBase):
         citation_change.resolved = False
         citation_change.status = adsmsg.Status.new
         with TestBase.mock_multiple_targets({
-                'citation_already_exists': patch.object(db, 'citation_already_exists', return_value=False), \
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[False]), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value={}), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
@@ -927,13 +934,14 @@ class TestWorkers(TestBase):
                 'webhook_emit_event': patch.object(webhook, 'emit_event', return_value=True), \
                 'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_citation_changes(citation_changes)
-            self.assertTrue(mocked['citation_already_exists'].called)
+            self.assertTrue(mocked['citations_already_exist'].called)
             self.assertTrue(mocked['get_citation_target_metadata'].called)
             self.assertFalse(mocked['fetch_metadata'].called)
             self.assertFalse(mocked['parse_metadata'].called)
             self.assertFalse(mocked['url_is_alive'].called) # Not executed because content is empty
             self.assertTrue(mocked['get_canonical_bibcode'].called)
-            self.assertFalse(mocked['get_canonical_bibcodes'].called)
+            # The citing bibcodes of the batch are resolved up-front in a single request
+            mocked['get_canonical_bibcodes'].assert_called_once_with(self.app, [citation_changes.changes[0].citing])
             self.assertFalse(mocked['get_citations_by_bibcode'].called)
             self.assertFalse(mocked['store_citation_target'].called)
             self.assertFalse(mocked['store_citation'].called)
@@ -957,10 +965,295 @@ class TestWorkers(TestBase):
             self.assertFalse(mocked['webhook_dump_event'].called)
             self.assertFalse(mocked['webhook_emit_event'].called) # because we don't know if an URL is software
 
+    def test_process_citation_changes_batched_dispatch(self):
+        citation_changes = self._common_citation_changes_doi(adsmsg.Status.new)
+        citation_change = citation_changes.changes.add()
+        citation_change.CopyFrom(citation_changes.changes[0])
+        citation_change.citing = '2017arXiv170610086M'
+        citation_change = citation_changes.changes.add()
+        citation_change.CopyFrom(citation_changes.changes[0])
+        citation_change.status = adsmsg.Status.deleted
+        with TestBase.mock_multiple_targets({
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[False, False, True]), \
+                'task_process_new_citation': patch.object(tasks.task_process_new_citation, 'delay', return_value=None), \
+                'task_process_new_citations': patch.object(tasks.task_process_new_citations, 'delay', return_value=None), \
+                'task_process_updated_citations': patch.object(tasks.task_process_updated_citations, 'delay', return_value=None), \
+                'task_process_deleted_citations': patch.object(tasks.task_process_deleted_citations, 'delay', return_value=None)}) as mocked:
+            tasks.task_process_citation_changes(citation_changes)
+            self.assertEqual(mocked['citations_already_exist'].call_count, 1)
+            self.assertFalse(mocked['task_process_new_citation'].called)
+            self.assertEqual(mocked['task_process_new_citations'].call_count, 1)
+            new_citation_changes = mocked['task_process_new_citations'].call_args[0][0]
+            self.assertEqual([c.citing for c in new_citation_changes.changes], ['2005CaJES..42.1987P', '2017arXiv170610086M'])
+            self.assertFalse(mocked['task_process_updated_citations'].called)
+            self.assertEqual(mocked['task_process_deleted_citations'].call_count, 1)
+            self.assertEqual(len(mocked['task_process_deleted_citations'].call_args[0][0].changes), 1)
+
+    def test_write_nonbib_files_incremental(self):
+        with TestBase.mock_multiple_targets({
+                'write_citation_target_data': patch.object(db, 'write_citation_target_data', return_value=None), \
+                'write_citation_target_delta_data': patch.object(db, 'write_citation_target_delta_data', return_value=None)}) as mocked:
+            tasks.task_write_nonbib_files(None)
+            self.assertEqual(mocked['write_citation_target_data'].call_count, 1)
+            self.assertFalse(mocked['write_citation_target_delta_data'].called)
+            # The app is re-created for every test
+            self.app.conf['NONBIB_EXPORT_MODE'] = 'incremental'
+            tasks.task_write_nonbib_files(None)
+            self.assertEqual(mocked['write_citation_target_data'].call_count, 1)
+            self.assertEqual(mocked['write_citation_target_delta_data'].call_count, 1)
+
+    def test_write_nonbib_delta_snapshot(self):
+        # The export state is kept in the database instead of a local file
+        with TestBase.mock_multiple_targets({
+                'get_nonbib_export_state': patch.object(db, 'get_nonbib_export_state', return_value=None), \
+                'write_citation_target_snapshot': patch.object(db, 'write_citation_target_snapshot', return_value=None)}) as mocked:
+            # No previous export
+            db.write_citation_target_delta_data(self.app)
+            self.assertEqual(mocked['write_citation_target_snapshot'].call_count, 1)
+            # Compaction
+            mocked['get_nonbib_export_state'].return_value = {'sequence': 30, 'watermark': datetime.now(), 'deltas_since_snapshot': 24}
+            db.write_citation_target_delta_data(self.app)
+            self.assertEqual(mocked['write_citation_target_snapshot'].call_count, 2)
+
+    def test_process_updated_citation_in_unit_of_work(self):
+        citation_changes = self._common_citation_changes_doi(adsmsg.Status.updated)
+        citation_change = tasks._protobuf_to_adsmsg_citation_change(citation_changes.changes[0])
+        doi_id = "10.5281/zenodo.11020" # software
+        in_unit_of_work = []
+        def update_citation(app, citation_change):
+            in_unit_of_work.append(db._unit_of_work.session is not None)
+            return True
+        def output_results(*args, **kwargs):
+            # Only queued once the unit of work has been committed
+            in_unit_of_work.append(db._unit_of_work.session is not None)
+        with TestBase.mock_multiple_targets({
+                'update_citation': patch.object(db, 'update_citation', side_effect=update_citation), \
+                'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value=self.mock_data[doi_id]), \
+                'get_citation_target_readers': patch.object(db, 'get_citation_target_readers', return_value=[]), \
+                'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
+                'collect_associated_works': patch.object(tasks, '_collect_associated_works', return_value=None), \
+                'get_canonical_bibcodes': patch.object(api, 'get_canonical_bibcodes', return_value=[]), \
+                'task_output_results': patch.object(tasks.task_output_results, 'delay', side_effect=output_results), \
+                'task_emit_event': patch.object(tasks.task_emit_event, 'delay', return_value=None)}) as mocked:
+            tasks.task_process_updated_citation(citation_change)
+            self.assertEqual(mocked['task_output_results'].call_count, 1)
+        self.assertEqual(in_unit_of_work, [True, False])
+
+    def test_process_new_citations_buffered_writes(self):
+        citation_changes = self._common_citation_changes_doi(adsmsg.Status.new)
+        citation_change = citation_changes.changes.add()
+        citation_change.CopyFrom(citation_changes.changes[0])
+        citation_change.citing = '2017arXiv170610086M'
+        in_unit_of_work = []
+        session = MagicMock(info={})
+        def process_new_citation(citation_change, **kwargs):
+            # The write buffer of the batch is active: the citation is only buffered
+            self.assertIsNotNone(db._citation_write_buffer.buffer)
+            tasks._delay_after_commit(tasks.task_output_results, citation_change, {}, [])
+            tasks._delay_after_commit(tasks.task_emit_event, {}, "")
+            self.assertIsNone(db.store_citation(self.app, citation_change, "DOI", None, {}, "REGISTERED"))
+        def store_citations(app, citations):
+            in_unit_of_work.append(db._unit_of_work.session is not None)
+            return [True, False]
+        def output_results(*args, **kwargs):
+            # Only queued once the unit of work has been committed
+            in_unit_of_work.append(db._unit_of_work.session is not None)
+        with TestBase.mock_multiple_targets({
+                'session_scope': patch.object(self.app, 'session_scope', side_effect=lambda: contextlib.nullcontext(session)), \
+                'get_canonical_bibcodes': patch.object(api, 'get_canonical_bibcodes', return_value=[]), \
+                'task_process_new_citation': patch.object(tasks, 'task_process_new_citation', side_effect=process_new_citation), \
+                'store_citations': patch.object(db, 'store_citations', side_effect=store_citations), \
+                'task_output_results': patch.object(tasks.task_output_results, 'delay', side_effect=output_results), \
+                'task_emit_event': patch.object(tasks.task_emit_event, 'delay', return_value=None)}) as mocked:
+            tasks.task_process_new_citations(citation_changes)
+            self.assertEqual(mocked['task_process_new_citation'].call_count, 2)
+            # A single bulk write for the whole batch, within its unit of work
+            self.assertEqual(mocked['store_citations'].call_count, 1)
+            buffered_citations = mocked['store_citations'].call_args[0][1]
+            self.assertEqual([c.citing for c, status in buffered_citations], ['2005CaJES..42.1987P', '2017arXiv170610086M'])
+            # The citation that already existed is neither emitted nor forwarded
+            self.assertEqual(mocked['task_output_results'].call_count, 1)
+            self.assertEqual(mocked['task_output_results'].call_args[0][0].citing, '2005CaJES..42.1987P')
+            self.assertEqual(mocked['task_emit_event'].call_count, 1)
+        self.assertEqual(in_unit_of_work, [True, False])
+
+    def test_process_new_citations_failed_change(self):
+        citation_changes = self._common_citation_changes_doi(adsmsg.Status.new)
+        citation_change = citation_changes.changes.add()
+        citation_change.CopyFrom(citation_changes.changes[0])
+        citation_change.citing = '2017arXiv170610086M'
+        session = MagicMock(info={})
+        session.transaction = session.begin_nested.return_value
+        def process_new_citation(citation_change, **kwargs):
+            tasks._delay_after_commit(tasks.task_emit_event, {}, "")
+            db.store_citation(self.app, citation_change, "DOI", None, {}, "REGISTERED")
+            if citation_change.citing == '2005CaJES..42.1987P':
+                raise Exception("Failed processing citation change")
+        with TestBase.mock_multiple_targets({
+                'session_scope': patch.object(self.app, 'session_scope', side_effect=lambda: contextlib.nullcontext(session)), \
+                'get_canonical_bibcodes': patch.object(api, 'get_canonical_bibcodes', return_value=[]), \
+                'task_process_new_citation': patch.object(tasks, 'task_process_new_citation', side_effect=process_new_citation), \
+                'store_citations': patch.object(db, 'store_citations', return_value=[True]), \
+                'task_emit_event': patch.object(tasks.task_emit_event, 'delay', return_value=None)}) as mocked:
+            tasks.task_process_new_citations(citation_changes)
+            # The rest of the batch is stored and emitted without the failed change
+            self.assertEqual(mocked['task_process_new_citation'].call_count, 2)
+            self.assertEqual([c.citing for c, status in mocked['store_citations'].call_args[0][1]], ['2017arXiv170610086M'])
+            self.assertEqual(mocked['task_emit_event'].call_count, 1)
+            # Its savepoint is rolled back and only the failed change is re-queued
+            self.assertEqual(session.begin_nested.return_value.rollback.call_count, 1)
+            self.assertEqual(mocked['task_process_new_citation'].delay.call_count, 1)
+            self.assertEqual(mocked['task_process_new_citation'].delay.call_args[0][0].citing, '2005CaJES..42.1987P')
+
+    def test_process_new_citations_failed_write(self):
+        citation_changes = self._common_citation_changes_doi(adsmsg.Status.new)
+        session = MagicMock(info={})
+        def process_new_citation(citation_change, **kwargs):
+            tasks._delay_after_commit(tasks.task_emit_event, {}, "")
+            db.store_citation(self.app, citation_change, "DOI", None, {}, "REGISTERED")
+        with TestBase.mock_multiple_targets({
+                'session_scope': patch.object(self.app, 'session_scope', side_effect=lambda: contextlib.nullcontext(session)), \
+                'get_canonical_bibcodes': patch.object(api, 'get_canonical_bibcodes', return_value=[]), \
+                'task_process_new_citation': patch.object(tasks, 'task_process_new_citation', side_effect=process_new_citation), \
+                'store_citations': patch.object(db, 'store_citations', side_effect=Exception("Failed bulk write")), \
+                'task_emit_event': patch.object(tasks.task_emit_event, 'delay', return_value=None)}) as mocked:
+            tasks.task_process_new_citations(citation_changes)
+            # Nothing is emitted for the failed batch, the change is only re-queued on its own
+            self.assertEqual(mocked['task_process_new_citation'].call_count, 1)
+            self.assertEqual(mocked['task_process_new_citation'].delay.call_count, 1)
+            self.assertEqual(mocked['task_emit_event'].call_count, 0)
+
+    def test_process_deleted_citations_in_bulk(self):
+        citation_changes = self._common_citation_changes_doi(adsmsg.Status.deleted)
+        citation_change = citation_changes.changes.add()
+        citation_change.CopyFrom(citation_changes.changes[0])
+        citation_change.citing = '2017arXiv170610086M'
+        doi_id = "10.5281/zenodo.11020" # software
+        with TestBase.mock_multiple_targets({
+                'mark_citations_as_deleted': patch.object(db, 'mark_citations_as_deleted', return_value=[(True, 'REGISTERED'), (False, 'REGISTERED')]), \
+                'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value=self.mock_data[doi_id]), \
+                'get_citation_target_readers': patch.object(db, 'get_citation_target_readers', return_value=[]), \
+                'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
+                'get_citation_targets_by_doi': patch.object(db, 'get_citation_targets_by_doi', return_value=[{}]), \
+                'get_canonical_bibcodes': patch.object(api, 'get_canonical_bibcodes', return_value=[]), \
+                'task_output_results': patch.object(tasks.task_output_results, 'delay', return_value=None), \
+                'task_emit_event': patch.object(tasks.task_emit_event, 'delay', return_value=None)}) as mocked:
+            tasks.task_process_deleted_citations(citation_changes)
+            # A single set-based statement for the whole batch
+            self.assertEqual(mocked['mark_citations_as_deleted'].call_count, 1)
+            self.assertEqual(len(mocked['mark_citations_as_deleted'].call_args[0][1]), 2)
+            # Only the citation that was marked as deleted is forwarded
+            self.assertEqual(mocked['task_output_results'].call_count, 1)
+            self.assertEqual(mocked['task_output_results'].call_args[0][0].citing, '2005CaJES..42.1987P')
+
+    def test_maintenance_metadata_history_mode(self):
+        history_modes = []
+        def get_citation_targets(app, only_status='REGISTERED'):
+            history_modes.append((db._get_history_mode(app), db.versioning_manager.options['versioning']))
+            return []
+        # The app is re-created for every test
+        self.app.conf['HISTORY_MAINTENANCE_MODE'] = 'off'
+        with TestBase.mock_multiple_targets({
+                'get_citation_targets': patch.object(db, 'get_citation_targets', side_effect=get_citation_targets), \
+                'fetch_metadata_many': patch.object(doi, 'fetch_metadata_many', return_value=[])}) as mocked:
+            tasks.task_maintenance_metadata([], [])
+            self.assertTrue(mocked['get_citation_targets'].called)
+        # History suspended during the maintenance task and restored afterwards,
+        # SQLAlchemy-Continuum is never disabled for the whole process
+        self.assertEqual(history_modes, [('off', True)])
+        self.assertEqual(db._get_history_mode(self.app), 'orm')
+        self.assertTrue(db.versioning_manager.options['versioning'])
+
+    def test_history_mode_per_session(self):
+        sessions = {}
+        def configure_session(mode):
+            with db.history_mode(self.app, mode):
+                session = sessions[mode] = self.app._session()
+                db._configure_history_session(self.app, session)
+        # Sessions configured concurrently by other threads keep their own mode
+        threads = [threading.Thread(target=configure_session, args=(mode,)) for mode in db.HISTORY_MODES]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # SQLAlchemy-Continuum only versions the flushes of the session in 'orm' mode
+        versioned_sessions = []
+        with patch.object(UnitOfWork, 'process_before_flush', side_effect=lambda uow, session: versioned_sessions.append(session)):
+            uow = db.versioning_manager.uow_class(db.versioning_manager)
+            for mode in db.HISTORY_MODES:
+                uow.process_before_flush(sessions[mode])
+        self.assertEqual(versioned_sessions, [sessions['orm']])
+        self.assertTrue(db.versioning_manager.options['versioning'])
+
+    def test_maintenance_repopulate_bibcode_columns_resumes(self):
+        # Progress recorded in the database by an interrupted run
+        progress = {'last_content': '10.5281/zenodo.1', 'rows': 1, 'updated': 1}
+        chunks = [('10.5281/zenodo.3', 2, 1), ('10.5281/zenodo.3', 0, 0)]
+        with TestBase.mock_multiple_targets({
+                'get_maintenance_progress': patch.object(db, '_get_maintenance_progress', return_value=progress), \
+                'set_maintenance_progress': patch.object(db, '_set_maintenance_progress', return_value=None), \
+                'clear_maintenance_progress': patch.object(db, '_clear_maintenance_progress', return_value=None), \
+                'populate_bibcode_column_chunk': patch.object(db, '_populate_bibcode_column_chunk', side_effect=chunks)}) as mocked:
+            tasks.task_maintenance_repopulate_bibcode_columns()
+            self.assertEqual(mocked['populate_bibcode_column_chunk'].call_count, 2)
+            self.assertEqual(mocked['populate_bibcode_column_chunk'].call_args_list[0][0][1], '10.5281/zenodo.1')
+            self.assertEqual(mocked['populate_bibcode_column_chunk'].call_args_list[1][0][1], '10.5281/zenodo.3')
+            # The progress is recorded after every chunk and removed once the job is completed
+            mocked['set_maintenance_progress'].assert_called_once_with(self.app, 'populate_bibcode_column', {'last_content': '10.5281/zenodo.3', 'rows': 3, 'updated': 2})
+            mocked['clear_maintenance_progress'].assert_called_once_with(self.app, 'populate_bibcode_column')
+
+    def test_maintenance_show_metadata_counts(self):
+        registered_record = {'content': '10.5281/zenodo.11020', 'content_type': 'DOI', 'bibcode': '2017zndo....248351D'}
+        aggregates = {'citation_count': 2, 'read_count': 5}
+        with TestBase.mock_multiple_targets({
+                'get_citation_targets_by_doi': patch.object(db, 'get_citation_targets_by_doi', return_value=[registered_record]), \
+                'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value={'parsed': {'bibcode': registered_record['bibcode']}, 'curated': {}}), \
+                'get_citation_target_aggregates': patch.object(db, 'get_citation_target_aggregates', return_value={registered_record['content']: aggregates}), \
+                'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
+                'get_citation_target_readers': patch.object(db, 'get_citation_target_readers', return_value=[]), \
+                'print': patch('builtins.print')}) as mocked:
+            tasks.maintenance_show_metadata([{'doi': registered_record['content']}])
+            mocked['get_citation_target_aggregates'].assert_called_once_with(self.app, [registered_record['content']])
+            mocked['print'].assert_any_call("Citations: 2, reads: 5", file=sys.stderr)
+            # Counts are read without fetching the citations and readers
+            self.assertFalse(mocked['get_citations_by_bibcode'].called)
+            self.assertFalse(mocked['get_citation_target_readers'].called)
+
+    def test_read_replica_routing(self):
+        primary_session, replica_session = MagicMock(), MagicMock()
+        replica_session.query.return_value.filter.return_value.filter.return_value.all.return_value = []
+        primary_session.query.return_value.filter.return_value.filter.return_value.all.return_value = []
+        citation_change = adsmsg.CitationChange(content='10.5281/zenodo.11020')
+        with TestBase.mock_multiple_targets({
+                'session_scope': patch.object(self.app, 'session_scope', side_effect=lambda: contextlib.nullcontext(primary_session)), \
+                'replica_session_scope': patch.object(self.app, 'replica_session_scope', side_effect=lambda: contextlib.nullcontext(replica_session))}) as mocked:
+            # Writes outside of tasks are not tracked
+            db.store_event(self.app, {})
+            self.assertEqual(mocked['session_scope'].call_count, 1)
+            db.begin_task_reads()
+            try:
+                db.get_citations(self.app, citation_change)
+                self.assertEqual(mocked['replica_session_scope'].call_count, 1)
+                self.assertEqual(mocked['session_scope'].call_count, 1)
+                db.store_event(self.app, {})
+                # Read-your-writes: the rest of the task reads from the primary
+                db.get_citations(self.app, citation_change)
+                self.assertEqual(mocked['replica_session_scope'].call_count, 1)
+                self.assertEqual(mocked['session_scope'].call_count, 3)
+            finally:
+                db.end_task_reads()
+            # The next task starts reading from the replica again
+            db.begin_task_reads()
+            try:
+                db.get_citations(self.app, citation_change)
+                self.assertEqual(mocked['replica_session_scope'].call_count, 2)
+            finally:
+                db.end_task_reads()
+
     def test_process_new_citation_changes_doi_unparsable_http_response(self):
         citation_changes = self._common_citation_changes_doi(adsmsg.Status.new)
         with TestBase.mock_multiple_targets({
-                'citation_already_exists': patch.object(db, 'citation_already_exists', return_value=False), \
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[False]), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value={}), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
@@ -990,13 +1283,14 @@ class TestWorkers(TestBase):
                 'webhook_emit_event': patch.object(webhook, 'emit_event', return_value=True), \
                 'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_citation_changes(citation_changes)
-            self.assertTrue(mocked['citation_already_exists'].called)
+            self.assertTrue(mocked['citations_already_exist'].called)
             self.assertTrue(mocked['get_citation_target_metadata'].called)
             self.assertTrue(mocked['fetch_metadata'].called)
             self.assertTrue(mocked['parse_metadata'].called)
             self.assertFalse(mocked['url_is_alive'].called)
             self.assertTrue(mocked['get_canonical_bibcode'].called)
-            self.assertFalse(mocked['get_canonical_bibcodes'].called)
+            # The citing bibcodes of the batch are resolved up-front in a single request
+            mocked['get_canonical_bibcodes'].assert_called_once_with(self.app, [citation_changes.changes[0].citing])
             self.assertFalse(mocked['get_citations_by_bibcode'].called)
             self.assertTrue(mocked['store_citation_target'].called)
             self.assertTrue(mocked['store_citation'].called)
@@ -1023,7 +1317,7 @@ class TestWorkers(TestBase):
     def test_process_new_citation_changes_doi_http_error(self):
         citation_changes = self._common_citation_changes_doi(adsmsg.Status.new)
         with TestBase.mock_multiple_targets({
-                'citation_already_exists': patch.object(db, 'citation_already_exists', return_value=False), \
+                'citations_already_exist': patch.object(db, 'citations_already_exist', return_value=[False]), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value={}), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
@@ -1068,13 +1362,16 @@ class TestWorkers(TestBase):
                 'get_citation_targets_by_bibcode': patch.object(db, 'get_citation_targets_by_bibcode', return_value=[registered_record]), \
                 'get_citation_target_readers': patch.object(db, 'get_citation_target_readers', return_value=[]), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
+                'get_citation_target_aggregates': patch.object(db, 'get_citation_target_aggregates', return_value={}), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value=self.mock_data[doi_id]), \
                 'store_reader_data': patch.object(db, 'store_reader_data', return_value=True), \
                 'mark_reader_as_deleted': patch.object(db, 'mark_reader_as_deleted', return_value=True), \
                'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_reader_updates(reader_changes)
             self.assertTrue(mocked['get_citation_target_metadata'].called)
-            self.assertTrue(mocked['get_citations_by_bibcode'].called)
+            # Only the nonbib record is forwarded, the citations are counted by the aggregates
+            self.assertFalse(mocked['get_citations_by_bibcode'].called)
+            self.assertTrue(mocked['get_citation_target_aggregates'].called)
             self.assertTrue(mocked['get_citation_target_readers'].called)
             self.assertTrue(mocked['forward_message'].called)
             self.assertTrue(mocked['get_citation_targets_by_bibcode'].called)
@@ -1096,13 +1393,16 @@ class TestWorkers(TestBase):
                 'get_citation_targets_by_bibcode': patch.object(db, 'get_citation_targets_by_alt_bibcode', return_value=[registered_record]), \
                 'get_citation_target_readers': patch.object(db, 'get_citation_target_readers', return_value=[]), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
+                'get_citation_target_aggregates': patch.object(db, 'get_citation_target_aggregates', return_value={}), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value=self.mock_data[doi_id]), \
                 'store_reader_data': patch.object(db, 'store_reader_data', return_value=True), \
                 'mark_reader_as_deleted': patch.object(db, 'mark_reader_as_deleted', return_value=True), \
                'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_reader_updates(reader_changes)
             self.assertTrue(mocked['get_citation_target_metadata'].called)
-            self.assertTrue(mocked['get_citations_by_bibcode'].called)
+            # Only the nonbib record is forwarded, the citations are counted by the aggregates
+            self.assertFalse(mocked['get_citations_by_bibcode'].called)
+            self.assertTrue(mocked['get_citation_target_aggregates'].called)
             self.assertTrue(mocked['get_citation_target_readers'].called)
             self.assertTrue(mocked['forward_message'].called)
             self.assertTrue(mocked['get_citation_targets_by_bibcode'].called)
@@ -1123,13 +1423,16 @@ class TestWorkers(TestBase):
                 'get_citation_targets_by_bibcode': patch.object(db, 'get_citation_targets_by_bibcode', return_value=[registered_record]), \
                 'get_citation_target_readers': patch.object(db, 'get_citation_target_readers', return_value=[]), \
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
+                'get_citation_target_aggregates': patch.object(db, 'get_citation_target_aggregates', return_value={}), \
                 'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value=self.mock_data[doi_id]), \
                 'store_reader_data': patch.object(db, 'store_reader_data', return_value=True), \
                 'mark_reader_as_deleted': patch.object(db, 'mark_reader_as_deleted', return_value=True), \
                'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=True)}) as mocked:
             tasks.task_process_reader_updates(reader_changes)
             self.assertTrue(mocked['get_citation_target_metadata'].called)
-            self.assertTrue(mocked['get_citations_by_bibcode'].called)
+            # Only the nonbib record is forwarded, the citations are counted by the aggregates
+            self.assertFalse(mocked['get_citations_by_bibcode'].called)
+            self.assertTrue(mocked['get_citation_target_aggregates'].called)
             self.assertTrue(mocked['get_citation_target_readers'].called)
             self.assertTrue(mocked['forward_message'].called)
             self.assertTrue(mocked['get_citation_targets_by_bibcode'].called)
@@ -1265,6 +1568,24 @@ class TestWorkers(TestBase):
             self.assertTrue(forward_message.called)
             self.assertEqual(forward_message.call_count, 2)
 
+    def test_task_output_results_only_nonbib(self):
+        citation_change = adsmsg.CitationChange(content='10.5281/zenodo.11020', content_type=adsmsg.CitationChangeContentType.doi, status=adsmsg.Status.updated)
+        parsed_metadata = {
+                'bibcode': 'test123456789012345',
+                'authors': ['Test, Unit'],
+                'normalized_authors': ['Test, U']
+                }
+        with TestBase.mock_multiple_targets({
+                'get_citation_target_entry_date': patch.object(db, 'get_citation_target_entry_date', return_value=None), \
+                'get_citation_target_aggregates': patch.object(db, 'get_citation_target_aggregates', return_value={'10.5281/zenodo.11020': {'citation_count': 3, 'read_count': 1}}), \
+                'build_record': patch.object(forward, 'build_record', wraps=forward.build_record), \
+                'forward_message': patch.object(app.ADSCitationCaptureCelery, 'forward_message', return_value=None)}) as mocked:
+            tasks.task_output_results(citation_change, parsed_metadata, [], readers=['XYZ1243BAY'], only_nonbib=True)
+            # Only the nonbib record is forwarded, with the number of citations of the aggregates
+            mocked['get_citation_target_aggregates'].assert_called_once_with(self.app, ['10.5281/zenodo.11020'])
+            self.assertEqual(mocked['build_record'].call_count, 1)
+            self.assertEqual(mocked['build_record'].call_args[1]['citation_count'], 3)
+
     def test_task_output_results_if_bibcode_replaced(self):
         with patch('ADSCitationCapture.app.ADSCitationCaptureCelery.forward_message', return_value=None) as forward_message:
             citation_change = adsmsg.CitationChange(content_type=adsmsg.CitationChangeContentType.doi, status=adsmsg.Status.active)
@@ -1,5 +1,5 @@
 import os
-import requests
+import ADSCitationCapture.http_client as http_client
 import urllib.request, urllib.parse, urllib.error
 import re
 from adsputils import setup_logging
@@ -32,7 +32,7 @@ def is_url(text):
 def is_alive(url):
     if is_url(url):
         try:
-            request = requests.get(url)
+            request = http_client.get(url, endpoint='url.is_alive')
         except:
             logger.exception("Failed URL: %s", url)
             raise
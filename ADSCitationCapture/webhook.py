@@ -1,4 +1,4 @@
-import requests
+import ADSCitationCapture.http_client as http_client
 import json
 from adsputils import setup_logging
 import adsmsg
@@ -152,7 +152,8 @@ def emit_event(ads_webhook_url, ads_webhook_auth_token, event_data, timeout=30):
         headers = {}
         headers["Content-Type"] = "application/json"
         headers["Authorization"] = "Bearer {}".format(ads_webhook_auth_token)
-        r = requests.post(ads_webhook_url, data=json.dumps(data), headers=headers, timeout=timeout)
+        # Only re-tried if it could not be sent, the broker would get duplicated events otherwise
+        r = http_client.post(ads_webhook_url, data=json.dumps(data), headers=headers, timeout=timeout, endpoint='ads_webhook', idempotent=False)
         if not r.ok:
             logger.error("Emit event failed with status code '{}': {}".format(r.status_code, r.content))
             raise Exception("HTTP Post to '{}' failed: {}".format(ads_webhook_url, json.dumps(data)))
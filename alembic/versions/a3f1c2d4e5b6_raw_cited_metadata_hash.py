@@ -0,0 +1,31 @@
+"""raw_cited_metadata_hash
+
+Revision ID: a3f1c2d4e5b6
+Revises: eb2407373369
+Create Date: 2026-10-18 09:12:31.402215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f1c2d4e5b6'
+down_revision = 'eb2407373369'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('citation_target', sa.Column('raw_cited_metadata_hash', sa.String(length=32), nullable=True))
+    op.add_column('citation_target_version', sa.Column('raw_cited_metadata_hash', sa.String(length=32), nullable=True))
+
+    pgrsql_populate_raw_cited_metadata_hash = "UPDATE public.citation_target \
+    SET raw_cited_metadata_hash = md5(raw_cited_metadata) \
+    WHERE raw_cited_metadata is not NULL"
+    op.execute(pgrsql_populate_raw_cited_metadata_hash)
+
+
+def downgrade():
+    op.drop_column('citation_target', 'raw_cited_metadata_hash')
+    op.drop_column('citation_target_version', 'raw_cited_metadata_hash')
@@ -0,0 +1,32 @@
+"""nonbib_export_state
+
+Revision ID: a7b8c9d0e1f2
+Revises: f3a4b5c6d7e8
+Create Date: 2026-10-18 21:12:37.419856
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import adsputils
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7b8c9d0e1f2'
+down_revision = 'f3a4b5c6d7e8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('nonbib_export_state',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('sequence', sa.Integer(), nullable=False),
+    sa.Column('watermark', adsputils.UTCDateTime(timezone=True), nullable=False),
+    sa.Column('deltas_since_snapshot', sa.Integer(), server_default='0', nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    schema='public'
+    )
+
+
+def downgrade():
+    op.drop_table('nonbib_export_state', schema='public')
@@ -0,0 +1,33 @@
+"""maintenance_progress
+
+Revision ID: b8c9d0e1f2a3
+Revises: a7b8c9d0e1f2
+Create Date: 2026-10-18 22:03:51.772604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import adsputils
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8c9d0e1f2a3'
+down_revision = 'a7b8c9d0e1f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('maintenance_progress',
+    sa.Column('job', sa.Text(), nullable=False),
+    sa.Column('last_content', sa.Text(), nullable=True),
+    sa.Column('rows', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('updated_rows', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('updated', adsputils.UTCDateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('job'),
+    schema='public'
+    )
+
+
+def downgrade():
+    op.drop_table('maintenance_progress', schema='public')
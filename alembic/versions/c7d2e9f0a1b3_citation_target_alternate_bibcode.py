@@ -0,0 +1,38 @@
+"""citation_target_alternate_bibcode
+
+Revision ID: c7d2e9f0a1b3
+Revises: a3f1c2d4e5b6
+Create Date: 2026-10-18 10:02:47.118093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d2e9f0a1b3'
+down_revision = 'a3f1c2d4e5b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('citation_target_alternate_bibcode',
+    sa.Column('alternate_bibcode', sa.Text(), nullable=False),
+    sa.Column('content', sa.Text(), nullable=False),
+    sa.ForeignKeyConstraint(['content'], ['public.citation_target.content'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('alternate_bibcode', 'content'),
+    schema='public'
+    )
+    op.create_index(op.f('ix_public_citation_target_alternate_bibcode_content'), 'citation_target_alternate_bibcode', ['content'], unique=False, schema='public')
+
+    pgrsql_populate_alternate_bibcodes = "INSERT INTO public.citation_target_alternate_bibcode (alternate_bibcode, content) \
+    SELECT DISTINCT jsonb_array_elements_text(parsed_cited_metadata->'alternate_bibcode'), content \
+    FROM public.citation_target \
+    WHERE jsonb_typeof(parsed_cited_metadata->'alternate_bibcode') = 'array'"
+    op.execute(pgrsql_populate_alternate_bibcodes)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_public_citation_target_alternate_bibcode_content'), table_name='citation_target_alternate_bibcode', schema='public')
+    op.drop_table('citation_target_alternate_bibcode', schema='public')
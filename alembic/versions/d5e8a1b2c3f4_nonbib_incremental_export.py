@@ -0,0 +1,33 @@
+"""nonbib_incremental_export
+
+Revision ID: d5e8a1b2c3f4
+Revises: c7d2e9f0a1b3
+Create Date: 2026-10-18 11:24:09.531872
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e8a1b2c3f4'
+down_revision = 'c7d2e9f0a1b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('nonbib_export_target',
+    sa.Column('content', sa.Text(), nullable=False),
+    sa.Column('bibcode', sa.Text(), nullable=True),
+    sa.PrimaryKeyConstraint('content'),
+    schema='public'
+    )
+    op.create_index('ix_public_citation_modified', 'citation', [sa.text('coalesce(updated, created)')], unique=False, schema='public')
+    op.create_index('ix_public_citation_target_modified', 'citation_target', [sa.text('coalesce(updated, created)')], unique=False, schema='public')
+
+
+def downgrade():
+    op.drop_index('ix_public_citation_target_modified', table_name='citation_target', schema='public')
+    op.drop_index('ix_public_citation_modified', table_name='citation', schema='public')
+    op.drop_table('nonbib_export_target', schema='public')
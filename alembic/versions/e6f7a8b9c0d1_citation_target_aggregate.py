@@ -0,0 +1,47 @@
+"""citation_target_aggregate
+
+Revision ID: e6f7a8b9c0d1
+Revises: d5e8a1b2c3f4
+Create Date: 2026-10-18 15:02:41.208315
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import adsputils
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6f7a8b9c0d1'
+down_revision = 'd5e8a1b2c3f4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('citation_target_aggregate',
+    sa.Column('content', sa.Text(), nullable=False),
+    sa.Column('citation_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('read_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('updated', adsputils.UTCDateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['content'], ['public.citation_target.content'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('content'),
+    schema='public'
+    )
+    # Backfill the counts of the existing citation targets
+    op.execute("""
+        INSERT INTO public.citation_target_aggregate (content, citation_count, read_count, updated)
+        SELECT t.content,
+               (SELECT count(*) FROM public.citation c
+                 WHERE c.content = t.content AND c.status = 'REGISTERED'),
+               (SELECT count(DISTINCT r.reader) FROM public.readers r
+                 WHERE r.status = 'REGISTERED'
+                   AND (r.bibcode = t.bibcode
+                        OR r.bibcode IN (SELECT a.alternate_bibcode FROM public.citation_target_alternate_bibcode a
+                                          WHERE a.content = t.content))),
+               now()
+          FROM public.citation_target t
+    """)
+
+
+def downgrade():
+    op.drop_table('citation_target_aggregate', schema='public')
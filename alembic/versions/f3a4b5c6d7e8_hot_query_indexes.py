@@ -0,0 +1,28 @@
+"""hot_query_indexes
+
+Revision ID: f3a4b5c6d7e8
+Revises: e6f7a8b9c0d1
+Create Date: 2026-10-18 17:41:12.604193
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a4b5c6d7e8'
+down_revision = 'e6f7a8b9c0d1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_public_citation_content_status', 'citation', ['content', 'status'], unique=False, schema='public')
+    op.create_index('ix_public_citation_target_bibcode', 'citation_target', ['bibcode'], unique=False, schema='public')
+    op.create_index('ix_public_readers_bibcode_status', 'readers', ['bibcode', 'status'], unique=False, schema='public')
+
+
+def downgrade():
+    op.drop_index('ix_public_readers_bibcode_status', table_name='readers', schema='public')
+    op.drop_index('ix_public_citation_target_bibcode', table_name='citation_target', schema='public')
+    op.drop_index('ix_public_citation_content_status', table_name='citation', schema='public')
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Memory used by the citation target helpers of db.py when loading full ORM
+rows (including the raw XML metadata) versus the projected queries.
+
+Usage (requires a PostgreSQL benchmark database, see support.create_app):
+
+    python -m benchmarks.bench_projection --targets 5000 --raw-size 20000
+"""
+import argparse
+from ADSCitationCapture import db
+from ADSCitationCapture.models import Citation, CitationTarget
+from benchmarks import support
+
+
+def full_rows_get_citation_targets(benchmark_app):
+    """
+    Previous implementation of db.get_citation_targets (full ORM rows)
+    """
+    with benchmark_app.session_scope() as session:
+        records_db = session.query(CitationTarget).filter_by(status='REGISTERED').all()
+        return db._extract_key_citation_target_data(records_db)
+
+def full_rows_get_citations(benchmark_app, contents):
+    """
+    Previous implementation of db.get_citations (full ORM rows)
+    """
+    with benchmark_app.session_scope() as session:
+        return [[r.citing for r in session.query(Citation).filter_by(content=content, status="REGISTERED").all()] for content in contents]
+
+def run(benchmark_app):
+    results = {}
+    with support.measure(results, 'get_citation_targets (full rows)'):
+        full_records = full_rows_get_citation_targets(benchmark_app)
+    with support.measure(results, 'get_citation_targets (projection)'):
+        records = db.get_citation_targets(benchmark_app)
+    assert full_records == records, "Projected records differ from full records"
+    contents = [record['content'] for record in records[:min(len(records), 200)]]
+    with support.measure(results, 'get_citations (full rows)'):
+        full_rows_get_citations(benchmark_app, contents)
+    with support.measure(results, 'get_citations (projection)'):
+        for content in contents:
+            db.get_citations(benchmark_app, db.CitationChange(content=content))
+    print("{:<40} {:>12} {:>14}".format("query", "seconds", "peak MiB"))
+    for name, result in results.items():
+        print("{:<40} {:>12.3f} {:>14.2f}".format(name, result['seconds'], result['peak_bytes'] / 2.**20))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark projected queries against full ORM rows')
+    parser.add_argument('--targets', dest='targets', type=int, default=5000, help='Number of synthetic citation targets')
+    parser.add_argument('--raw-size', dest='raw_size', type=int, default=20000, help='Bytes of raw metadata per citation target')
+    parser.add_argument('--sqlalchemy-url', dest='sqlalchemy_url', default=None, help='Benchmark database (it will be wiped)')
+    parser.add_argument('--keep', dest='keep', action='store_true', default=False, help='Do not drop the seeded tables')
+    args = parser.parse_args()
+    benchmark_app = support.create_app(args.sqlalchemy_url)
+    support.create_schema(benchmark_app)
+    try:
+        support.seed(benchmark_app, args.targets, raw_metadata_size=args.raw_size)
+        run(benchmark_app)
+    finally:
+        if not args.keep:
+            support.drop_schema(benchmark_app)
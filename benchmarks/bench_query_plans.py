@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+Query plans of the hot queries of db.py and delta_computation.py: every
+helper is run against a seeded database, the SQL statements that it executes
+are captured and explained with EXPLAIN (ANALYZE, BUFFERS) (in a transaction
+that is rolled back). The benchmark fails if a plan reads with a sequential
+scan a table that should be reached through an index, or if a statement
+goes over the latency budget.
+
+Usage (requires a PostgreSQL benchmark database, see support.create_app):
+
+    python -m benchmarks.bench_query_plans --targets 20000 --budget-ms 50
+    # Small databases: sequential scans are disabled so that the planner only
+    # falls back to them if there is no usable index
+    python -m benchmarks.bench_query_plans --targets 1000 --no-seqscan
+"""
+import re
+import sys
+import argparse
+import contextlib
+import datetime
+import adsmsg
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from ADSCitationCapture import db
+from benchmarks import support
+
+
+def explainable_statement(statement):
+    """
+    Statement that can be explained (the query of CREATE TABLE ... AS
+    SELECT), or None
+    """
+    sql = statement.strip()
+    if sql.split(None, 1)[0].upper() in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE'):
+        return sql
+    match = re.match(r'CREATE\s+TABLE\s+\S+\s+AS\s+(SELECT\s.*)', sql, re.IGNORECASE | re.DOTALL)
+    return match.group(1) if match else None
+
+@contextlib.contextmanager
+def capture_statements(statements):
+    """
+    Collect the (statement, parameters) executed by any engine within the block
+    """
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and explainable_statement(statement) is not None:
+            statements.append((explainable_statement(statement), parameters))
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+
+def explain(benchmark_app, statement, parameters, no_seqscan=False):
+    """
+    EXPLAIN (ANALYZE, BUFFERS) of a statement, rolled back so that writes are
+    not applied twice
+
+    :return: plan (as returned by FORMAT JSON)
+    """
+    connection = benchmark_app._engine.connect()
+    transaction = connection.begin()
+    try:
+        if no_seqscan:
+            connection.execute("SET LOCAL enable_seqscan = off")
+        cursor = connection.connection.cursor()
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement, parameters)
+        return cursor.fetchone()[0][0]
+    finally:
+        transaction.rollback()
+        connection.close()
+
+def plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        for descendant in plan_nodes(child):
+            yield descendant
+
+def sample(benchmark_app):
+    """
+    Identifiers of seeded records used as arguments of the helpers
+    """
+    records = db.get_citation_targets(benchmark_app)
+    record = records[len(records) // 2]
+    citations = db.get_citations(benchmark_app, db.CitationChange(content=record['content']))
+    citation_changes = []
+    for citing in citations:
+        citation_change = adsmsg.CitationChange(citing=citing, content=record['content'], cited=record['content'], resolved=False)
+        citation_change.timestamp.FromDatetime(datetime.datetime.utcnow() + datetime.timedelta(days=1))
+        citation_changes.append(citation_change)
+    return {
+        'content': record['content'],
+        'bibcode': record['bibcode'],
+        'alternate_bibcodes': record['alternate_bibcode'],
+        'contents': [r['content'] for r in records[:100]],
+        'bibcodes': [r['bibcode'] for r in records[:100]],
+        'citation_changes': citation_changes,
+    }
+
+def reconstruct_previous_expanded_raw_data(benchmark_app):
+    """
+    Consistency check run by DeltaComputation before importing a new file
+    (full join of the citation and citation target tables)
+    """
+    from ADSCitationCapture.delta_computation import DeltaComputation
+    delta_computation = DeltaComputation(str(benchmark_app._engine.url), schema_prefix="benchmark_citation_capture_")
+    delta_computation.previous_schema_name = "benchmark_citation_capture_previous"
+    delta_computation._execute_sql("CREATE SCHEMA IF NOT EXISTS {0};", delta_computation.previous_schema_name)
+    try:
+        delta_computation._reconstruct_previous_expanded_raw_data()
+    finally:
+        delta_computation._execute_sql("DROP SCHEMA {0} CASCADE;", delta_computation.previous_schema_name)
+        delta_computation.connection.close()
+
+def cases(values):
+    """
+    (name, helper call, tables that must be read through an index or None
+    for whole-table queries, which only have the full scan latency budget)
+    """
+    reader_change = {'bibcode': values['bibcode'], 'reader': "0123456789abcdef", 'timestamp': datetime.datetime.utcnow().isoformat()}
+    return [
+        ('citations_already_exist', lambda app: db.citations_already_exist(app, values['citation_changes']), ('citation',)),
+        ('get_citations', lambda app: db.get_citations(app, db.CitationChange(content=values['content'])), ('citation',)),
+        ('get_citations_by_bibcode', lambda app: db.get_citations_by_bibcode(app, values['bibcode']), ('citation', 'citation_target')),
+        ('get_citation_targets_by_bibcode', lambda app: db.get_citation_targets_by_bibcode(app, values['bibcodes']), ('citation_target',)),
+        ('get_citation_targets_by_alt_bibcode', lambda app: db.get_citation_targets_by_alt_bibcode(app, values['alternate_bibcodes']), ('citation_target', 'citation_target_alternate_bibcode')),
+        ('get_citation_targets_by_doi', lambda app: db.get_citation_targets_by_doi(app, values['contents']), ('citation_target',)),
+        ('get_citation_target_metadata', lambda app: db.get_citation_target_metadata(app, values['content']), ('citation_target',)),
+        ('get_citation_target_readers', lambda app: db.get_citation_target_readers(app, values['bibcode'], values['alternate_bibcodes']), ('readers',)),
+        ('get_citation_target_aggregates', lambda app: db.get_citation_target_aggregates(app, values['contents']), ('citation_target_aggregate',)),
+        ('update_citations', lambda app: db.update_citations(app, values['citation_changes']), ('citation',)),
+        ('store_reader_data', lambda app: db.store_reader_data(app, reader_change, 'REGISTERED'), ('readers', 'citation_target', 'citation_target_alternate_bibcode')),
+        ('delta_computation._reconstruct_previous_expanded_raw_data', reconstruct_previous_expanded_raw_data, None),
+    ]
+
+def run(benchmark_app, budget_ms, full_scan_budget_ms, no_seqscan=False):
+    """
+    :return: list of failures (empty if all the plans are fine)
+    """
+    failures = []
+    values = sample(benchmark_app)
+    print("{:<60} {:>10} {:>10} {:>10}  {}".format("helper / statement", "ms", "hit", "read", "sequential scans"))
+    for name, call, indexed_tables in cases(values):
+        statements = []
+        with capture_statements(statements):
+            call(benchmark_app)
+        print(name)
+        for i, (statement, parameters) in enumerate(statements):
+            plan = explain(benchmark_app, statement, parameters, no_seqscan=no_seqscan)
+            nodes = list(plan_nodes(plan['Plan']))
+            seq_scans = sorted(set(node['Relation Name'] for node in nodes if node['Node Type'] == 'Seq Scan'))
+            milliseconds = plan['Execution Time']
+            print("  {:<58} {:>10.2f} {:>10} {:>10}  {}".format("#{} {}".format(i, " ".join(statement.split())[:50]), milliseconds,
+                                                               plan['Plan'].get('Shared Hit Blocks', 0), plan['Plan'].get('Shared Read Blocks', 0),
+                                                               ", ".join(seq_scans)))
+            for table in seq_scans:
+                if indexed_tables is not None and table in indexed_tables:
+                    failures.append("{} #{}: sequential scan on '{}'".format(name, i, table))
+            statement_budget_ms = budget_ms if indexed_tables is not None else full_scan_budget_ms
+            if milliseconds > statement_budget_ms:
+                failures.append("{} #{}: {:.2f} ms over the {:.2f} ms budget".format(name, i, milliseconds, statement_budget_ms))
+    for failure in failures:
+        print("FAILED: " + failure)
+    return failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the query plans and latency of the hot db.py queries')
+    parser.add_argument('--targets', dest='targets', type=int, default=20000, help='Number of synthetic citation targets')
+    parser.add_argument('--citations-per-target', dest='citations_per_target', type=int, default=10, help='Citations per citation target')
+    parser.add_argument('--readers-per-target', dest='readers_per_target', type=int, default=5, help='Readers per citation target')
+    parser.add_argument('--raw-size', dest='raw_size', type=int, default=2000, help='Bytes of raw metadata per citation target')
+    parser.add_argument('--budget-ms', dest='budget_ms', type=float, default=50., help='Maximum execution time of a statement (ms)')
+    parser.add_argument('--full-scan-budget-ms', dest='full_scan_budget_ms', type=float, default=5000., help='Maximum execution time of a whole-table statement (ms)')
+    parser.add_argument('--no-seqscan', dest='no_seqscan', action='store_true', default=False, help='Disable sequential scans when explaining (small databases)')
+    parser.add_argument('--sqlalchemy-url', dest='sqlalchemy_url', default=None, help='Benchmark database (it will be wiped)')
+    parser.add_argument('--keep', dest='keep', action='store_true', default=False, help='Do not drop the seeded tables')
+    args = parser.parse_args()
+    benchmark_app = support.create_app(args.sqlalchemy_url)
+    support.create_schema(benchmark_app)
+    try:
+        support.seed(benchmark_app, args.targets, citations_per_target=args.citations_per_target,
+                     readers_per_target=args.readers_per_target, raw_metadata_size=args.raw_size)
+        failures = run(benchmark_app, args.budget_ms, args.full_scan_budget_ms, no_seqscan=args.no_seqscan)
+    finally:
+        if not args.keep:
+            support.drop_schema(benchmark_app)
+    sys.exit(1 if failures else 0)
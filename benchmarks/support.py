@@ -0,0 +1,121 @@
+import os
+import time
+import random
+import hashlib
+import tracemalloc
+import contextlib
+from adsputils import load_config, get_date
+from ADSCitationCapture import app
+from ADSCitationCapture.models import Base, Citation, CitationTarget, CitationTargetAggregate, CitationTargetAlternateBibcode, Reader
+
+# ============================= INITIALIZATION ==================================== #
+
+from adsputils import setup_logging
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+config = load_config(proj_home=proj_home)
+logger = setup_logging('benchmarks', proj_home=proj_home,
+                        level=config.get('LOGGING_LEVEL', 'INFO'),
+                        attach_stdout=config.get('LOG_STDOUT', False))
+
+# =============================== FUNCTIONS ======================================= #
+
+
+def create_app(sqlalchemy_url=None):
+    """
+    Application connected to the benchmark database (it will be modified, never
+    use the production one): '<SQLALCHEMY_URL>_benchmark' by default
+    """
+    if sqlalchemy_url is None:
+        sqlalchemy_url = config.get('BENCHMARK_SQLALCHEMY_URL', "{}_benchmark".format(config.get('SQLALCHEMY_URL')))
+    local_config = {
+        "TESTING_MODE": True,
+        "SQLALCHEMY_URL": sqlalchemy_url,
+    }
+    return app.ADSCitationCaptureCelery('benchmark', proj_home=proj_home, local_config=local_config)
+
+def create_schema(benchmark_app):
+    drop_schema(benchmark_app)
+    Base.metadata.create_all(bind=benchmark_app._engine)
+
+def drop_schema(benchmark_app):
+    # Same as the unit tests: ENUMs may be dropped before the tables that use them
+    for table_name in Base.metadata.tables.keys():
+        benchmark_app._engine.execute("DROP TABLE IF EXISTS {0} CASCADE;".format(table_name))
+    Base.metadata.drop_all(bind=benchmark_app._engine)
+
+def synthetic_raw_metadata(doi, size):
+    """
+    DataCite-like XML of (approximately) the requested size in bytes
+    """
+    header = '<?xml version="1.0" encoding="UTF-8"?><resource xmlns="http://datacite.org/schema/kernel-4"><identifier identifierType="DOI">{}</identifier><descriptions><description descriptionType="Abstract">'.format(doi)
+    footer = '</description></descriptions></resource>'
+    return header + "x" * max(0, size - len(header) - len(footer)) + footer
+
+def seed(benchmark_app, n_targets, citations_per_target=10, readers_per_target=5, raw_metadata_size=20000, batch_size=1000, seed_value=42):
+    """
+    Insert synthetic citation targets (with raw metadata of raw_metadata_size
+    bytes), alternate bibcodes, citations, readers and their aggregated
+    counts. Rows are inserted directly (bypassing versioning) to keep seeding
+    fast.
+    """
+    rnd = random.Random(seed_value)
+    statuses = ['REGISTERED'] * 8 + ['DISCARDED', 'EMITTABLE']
+    now = get_date()
+    start = time.time()
+    for first in range(0, n_targets, batch_size):
+        targets, alternate_bibcodes, citations, readers, aggregates = [], [], [], [], []
+        for i in range(first, min(first + batch_size, n_targets)):
+            content = "10.5281/zenodo.{}".format(1000000 + i)
+            bibcode = "2019zndo.{:010d}X".format(i)
+            alternate_bibcode = "2019zndo.{:010d}Y".format(i)
+            raw_metadata = synthetic_raw_metadata(content, raw_metadata_size)
+            status = rnd.choice(statuses)
+            targets.append({
+                'content': content,
+                'content_type': 'DOI',
+                'bibcode': bibcode,
+                'raw_cited_metadata': raw_metadata,
+                'raw_cited_metadata_hash': hashlib.md5(raw_metadata.encode('utf-8')).hexdigest(),
+                'parsed_cited_metadata': {'bibcode': bibcode, 'alternate_bibcode': [alternate_bibcode], 'version': '1.0',
+                                          'authors': ['Doe, John'], 'normalized_authors': ['Doe, J'], 'title': 'Software {}'.format(i)},
+                'curated_metadata': {},
+                'status': status,
+                'created': now,
+            })
+            alternate_bibcodes.append({'alternate_bibcode': alternate_bibcode, 'content': content})
+            citation_statuses = [rnd.choice(statuses) for j in range(citations_per_target)]
+            for j, citation_status in enumerate(citation_statuses):
+                citations.append({'content': content, 'citing': "2020ApJ...{:05d}..{:04d}A".format(i % 100000, j), 'cited': content,
+                                  'resolved': False, 'timestamp': now, 'status': citation_status, 'created': now})
+            for j in range(readers_per_target):
+                readers.append({'bibcode': bibcode, 'reader': "{:016x}".format(rnd.getrandbits(64)), 'timestamp': now,
+                                'status': 'REGISTERED', 'created': now})
+            aggregates.append({'content': content, 'citation_count': citation_statuses.count('REGISTERED'),
+                               'read_count': readers_per_target, 'updated': now})
+        with benchmark_app.session_scope() as session:
+            session.execute(CitationTarget.__table__.insert(), targets)
+            session.execute(CitationTargetAlternateBibcode.__table__.insert(), alternate_bibcodes)
+            if citations:
+                session.execute(Citation.__table__.insert(), citations)
+            if readers:
+                session.execute(Reader.__table__.insert(), readers)
+            session.execute(CitationTargetAggregate.__table__.insert(), aggregates)
+            session.commit()
+    with benchmark_app.session_scope() as session:
+        session.execute("ANALYZE")
+    logger.info("Seeded %i citation targets in %.1f seconds", n_targets, time.time() - start)
+
+@contextlib.contextmanager
+def measure(results, name):
+    """
+    Record elapsed seconds and peak Python memory of the block
+    """
+    tracemalloc.start()
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = {'seconds': elapsed, 'peak_bytes': peak}
@@ -4,6 +4,8 @@ psql "postgres://$POSTGRES_USER:$POSTGRES_PASSWORD@$POSTGRES_HOST/$POSTGRES_DB?s
     CREATE USER citation_capture_pipeline WITH ENCRYPTED PASSWORD 'citation_capture_pipeline';
     CREATE DATABASE citation_capture_pipeline;
     CREATE DATABASE citation_capture_pipeline_test;
+    CREATE DATABASE citation_capture_pipeline_benchmark;
     GRANT ALL PRIVILEGES ON DATABASE citation_capture_pipeline TO citation_capture_pipeline;
     GRANT ALL PRIVILEGES ON DATABASE citation_capture_pipeline_test TO citation_capture_pipeline;
+    GRANT ALL PRIVILEGES ON DATABASE citation_capture_pipeline_benchmark TO citation_capture_pipeline;
 EOSQL